@@ -1,6 +1,12 @@
 from kahi.KahiBase import KahiBase
-from pymongo import MongoClient
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
 from joblib import Parallel, delayed
+from pymongo import ASCENDING
+from threading import Lock
+from time import time
+import traceback
+from kahi_minciencias_sample.Utils import AsyncEngine, BulkWriter, Checkpoints, SeenIds, chunks, ensure_indexes, get_client, get_refresh_mark, latest_timestamp, match_regex_keys, partition_query, raw_key, set_refresh_mark, unindexed_queries
 import re
 
 
@@ -23,16 +29,27 @@ class Kahi_minciencias_sample(KahiBase):
         self.database_out_name = self.config["minciencias_sample"]['database_out']["database_name"]
         self.database_out_drop_database = self.config["minciencias_sample"]['database_out']["drop_database"]
 
-        self.client = MongoClient(self.database_out_url)
+        self.num_jobs = self.config["minciencias_sample"]["num_jobs"] if "num_jobs" in self.config["minciencias_sample"] else 1
+        # wire compressors, ex: "zstd,snappy"
+        self.compressors = self.config["minciencias_sample"]["compressors"] if "compressors" in self.config["minciencias_sample"] else None
+        self.client = get_client(self.database_out_url, self.num_jobs, self.compressors)
         self.db_out = self.client[self.database_out_name]
 
-        self.num_jobs = self.config["minciencias_sample"]["num_jobs"] if "num_jobs" in self.config["minciencias_sample"] else 1
-        if self.database_out_drop_database:
-            self.client.drop_database(self.database_out_name)
+        # if True the selectors done by an interrupted run are skipped and the partial ones are resumed
+        self.resume = self.config["minciencias_sample"]["resume"] if "resume" in self.config["minciencias_sample"] else False
+        # if True the sample is updated in place with the works changed since the last refresh
+        self.refresh = self.config["minciencias_sample"]["refresh"] if "refresh" in self.config["minciencias_sample"] else False
+        self.timestamp_field = self.config["minciencias_sample"]["timestamp_field"] if "timestamp_field" in self.config["minciencias_sample"] else None
         self.database_in_url = self.config["minciencias_sample"]['database_in']["database_url"]
         self.database_in_name = self.config["minciencias_sample"]['database_in']["database_name"]
-        self.client_in = MongoClient(self.database_in_url)
-        self.db_in = self.client_in[self.database_in_name]
+        self.client_in = get_client(self.database_in_url, self.num_jobs, self.compressors)
+        self.raw = self.config["minciencias_sample"]["raw"] if "raw" in self.config["minciencias_sample"] else False
+        if self.raw:
+            # works are copied as raw bson, without decoding and encoding them again
+            self.db_in = self.client_in.get_database(
+                self.database_in_name, codec_options=CodecOptions(document_class=RawBSONDocument))
+        else:
+            self.db_in = self.client_in[self.database_in_name]
         self.cols_out = {}
         for col in self.config["minciencias_sample"]['database_out']["collection_names"]:
             key = str(next(iter(col.keys())))
@@ -45,6 +62,123 @@ class Kahi_minciencias_sample(KahiBase):
             value = str(next(iter(col.values())))
             self.cols_in[key] = self.db_in[value]
         self.verbose = self.config["minciencias_sample"]["verbose"] if "verbose" in self.config["minciencias_sample"] else 1
+        self.bulk_size = self.config["minciencias_sample"]["bulk_size"] if "bulk_size" in self.config["minciencias_sample"] else 1000
+        self.flush_interval = self.config["minciencias_sample"]["flush_interval"] if "flush_interval" in self.config["minciencias_sample"] else 10
+        self.parallel_scan = self.config["minciencias_sample"]["parallel_scan"] if "parallel_scan" in self.config["minciencias_sample"] else False
+        # collections with fewer documents are scanned with a single cursor, partitioning them costs an extra pass
+        self.parallel_scan_min_size = self.config["minciencias_sample"]["parallel_scan_min_size"] if "parallel_scan_min_size" in self.config["minciencias_sample"] else 100000
+        self.wait_indexes = self.config["minciencias_sample"]["wait_indexes"] if "wait_indexes" in self.config["minciencias_sample"] else True
+        self.chunk_size = self.config["minciencias_sample"]["chunk_size"] if "chunk_size" in self.config["minciencias_sample"] else 1000
+        # ids already seen in the run, the duplicated works are skipped without a round trip to the server
+        self.seen_ids = self.config["minciencias_sample"]["seen_ids"] if "seen_ids" in self.config["minciencias_sample"] else True
+        # bits of the Bloom filter in front of the seen ids, 0 to disable it
+        self.bloom_size = self.config["minciencias_sample"]["bloom_size"] if "bloom_size" in self.config["minciencias_sample"] else 0
+        # number of ids expected in the sample, the seen ids are allocated once for them
+        self.seen_capacity = self.config["minciencias_sample"]["seen_capacity"] if "seen_capacity" in self.config["minciencias_sample"] else 0
+        self.seen = SeenIds(expected=self.seen_capacity, bloom_size=self.bloom_size) if self.seen_ids else None
+        self.writer = BulkWriter(self.cols_out["gruplac_production"], ["id_producto_pd"], batch_size=self.bulk_size,
+                                 flush_interval=self.flush_interval, verbose=self.verbose, seen=self.seen, replace=self.refresh)
+        # distinct persons and groups of the output works, shared by the enrichment stages
+        self.enrichment_ids = None
+        self.enrichment_ids_lock = Lock()
+        # if True the selectors only collect the id_producto_pd of the works, then every work is fetched once
+        self.id_first = self.config["minciencias_sample"]["id_first"] if "id_first" in self.config["minciencias_sample"] else False
+        self.collecting_ids = False
+        self.ids = set()
+        self.ids_lock = Lock()
+        # "threading" (joblib threads) or "async" (asyncio producers and batch writers)
+        self.engine = self.config["minciencias_sample"]["engine"] if "engine" in self.config["minciencias_sample"] else "threading"
+        if self.engine not in ["threading", "async"]:
+            print("ERROR: Invalid engine: ", self.engine)
+            raise Exception("Invalid engine: ", self.engine)
+        # concurrent bulk writes and maximum number of works waiting to be written in the async engine
+        self.sink_jobs = self.config["minciencias_sample"]["sink_jobs"] if "sink_jobs" in self.config["minciencias_sample"] else self.num_jobs
+        self.queue_size = self.config["minciencias_sample"]["queue_size"] if "queue_size" in self.config["minciencias_sample"] else 2 * self.bulk_size
+        # checkpoints of the selectors in the state collection of the output database, required by resume
+        self.checkpoint = self.config["minciencias_sample"]["checkpoint"] if "checkpoint" in self.config["minciencias_sample"] else False
+        self.checkpoint_size = self.config["minciencias_sample"]["checkpoint_size"] if "checkpoint_size" in self.config["minciencias_sample"] else 10 * self.bulk_size
+        self.state_collection = self.config["minciencias_sample"]["state_collection"] if "state_collection" in self.config["minciencias_sample"] else "sample_state"
+        self.checkpoints = Checkpoints(self.db_out[self.state_collection], "minciencias_sample", resume=self.resume,
+                                       verbose=self.verbose) if self.checkpoint or self.resume else None
+        if self.engine == "async" and self.checkpoints is not None:
+            print("ERROR: checkpoint and resume are not supported by the async engine")
+            raise Exception("checkpoint and resume are not supported by the async engine")
+
+    def selector_projection(self):
+        """
+        Returns the projection of the selector queries.
+        In the first phase of id_first only the id_producto_pd is returned,
+        so the selectors served by an index on id_producto_pd are covered, otherwise None (the whole works).
+        """
+        if self.collecting_ids:
+            return {"id_producto_pd": 1, "_id": 0}
+        return None
+
+    def selector_pipeline(self, pipeline):
+        """
+        Returns the pipeline of a selector, in the first phase of id_first
+        a $project stage is appended so only the id_producto_pd of the works is returned.
+
+        Parameters:
+        ----------
+        pipeline: list
+            mongodb pipeline that returns works.
+        """
+        if self.collecting_ids:
+            return pipeline + [{"$project": self.selector_projection()}]
+        return pipeline
+
+    def selector_queries(self):
+        """
+        Returns the queries and pipelines of the selectors in the workflow configuration.
+
+        Returns:
+        ----------
+        list
+            list of tuples (description, collection, query or pipeline).
+        """
+        config = self.config["minciencias_sample"]
+        collection = self.cols_in["gruplac_production"]
+        queries = []
+        if "authors" in config and config["authors"]:
+            queries += [(f"author {author_id}", collection, {"id_persona_pd": author_id})
+                        for author_id in config["authors"]]
+        if "products" in config and config["products"]:
+            queries += [(f"product {product}", collection, {"id_producto_pd": {"$regex": re.compile(product)}})
+                        for product in config["products"]]
+        if "groups" in config and config["groups"]:
+            queries += [(f"group {group_id}", collection, {"cod_grupo_gr": group_id}) for group_id in config["groups"]]
+        if "categories" in config and config["categories"]:
+            queries += [(f"category {category}", collection, {"id_tipo_pd_med": re.compile(category)})
+                        for category in config["categories"]]
+        if "custom_queries" in config and config["custom_queries"]:
+            queries += [(f"custom query {query}", collection, query) for query in config["custom_queries"]]
+        if "custom_pipelines" in config and config["custom_pipelines"]:
+            queries += [(f"custom pipeline {pipeline}", collection, pipeline)
+                        for pipeline in config["custom_pipelines"]]
+        return queries
+
+    def process_indexes(self):
+        """
+        Method to create the indexes of the indeces tag of database_in and database_out
+        in the workflow configuration, the indexes that already exist are skipped.
+        The indeces tag can be a list of indexes for the gruplac_production collection
+        or a dict with the collection key (ex: cvlac_stage) and its list of indexes.
+        With wait_indexes False the indexes are built in background.
+        The selector queries that are still not served by an index are reported.
+        """
+        threads = []
+        for database, cols in [("database_in", self.cols_in), ("database_out", self.cols_out)]:
+            indexes = self.config["minciencias_sample"][database]["indeces"] if "indeces" in self.config["minciencias_sample"][database] else []
+            if not isinstance(indexes, dict):
+                indexes = {"gruplac_production": indexes}
+            for key, fields in indexes.items():
+                threads.append(ensure_indexes(
+                    cols[key], fields, wait=self.wait_indexes, verbose=self.verbose))
+        if self.wait_indexes or not any(threads):
+            for description in unindexed_queries(self.selector_queries()):
+                print(
+                    f"WARNING: {description} is not served by an index in db {self.db_in.name} collection {self.cols_in['gruplac_production'].name}")
 
     def process_authors(self):
         """
@@ -59,57 +193,234 @@ class Kahi_minciencias_sample(KahiBase):
                 if self.verbose > 0:
                     print(
                         f"INFO: Found {self.cols_in['gruplac_production'].count_documents({'id_persona_pd': author_id})} in db {self.db_in.name} collection {self.cols_in['gruplac_production'].name} for id   {author_id}")  # noqa: E501
-                works = self.cols_in["gruplac_production"].find(
-                    {"id_persona_pd": author_id})
-                Parallel(n_jobs=self.num_jobs, backend="threading", verbose=10)(
-                    delayed(self.process_one_work)(work) for work in works)
+                self.process_query(self.cols_in["gruplac_production"], {"id_persona_pd": author_id})
+
+    def process_partition(self, collection, query):
+        """
+        Method to save in the output database the works of one partition of a query.
+        Required for parallel processing.
+
+        Parameters:
+        ----------
+        collection: pymongo.collection.Collection
+            input collection.
+        query: dict
+            mongodb query of the partition.
+        """
+        for work in collection.find(query, self.selector_projection()):
+            self.process_one_work(work)
+
+    def process_query(self, collection, query):
+        """
+        Method to save in the output database all the works that match a query.
+        With parallel_scan the query is split in num_jobs _id range partitions that are scanned in parallel,
+        each one with its own cursor, otherwise the works of a single cursor are processed in parallel.
+        The collections with less than parallel_scan_min_size documents are not partitioned.
+        With checkpoints every partition has its own checkpoint and its own bulk writer,
+        so the flush of a checkpoint does not wait for the writes of the other partitions.
+
+        Parameters:
+        ----------
+        collection: pymongo.collection.Collection
+            input collection.
+        query: dict
+            mongodb query that returns works.
+        """
+        partitions = [query]
+        if self.parallel_scan and self.num_jobs > 1 and collection.estimated_document_count() >= self.parallel_scan_min_size:
+            partitions = partition_query(collection, query, self.num_jobs)
+        checkpointed = self.checkpoints is not None and not self.collecting_ids
+        if checkpointed and len(partitions) > 1:
+            # every partition is checkpointed as a selector, a resumed run finds the same partitions if the input did not change
+            writers = [self.writer.fork() for _ in partitions]
+            Parallel(n_jobs=self.num_jobs, backend="threading", verbose=10)(
+                delayed(self.process_checkpointed)(collection, partition, 1, writer) for partition, writer in zip(partitions, writers))
+            for writer in writers:
+                self.writer.join(writer)
+        elif checkpointed:
+            self.process_checkpointed(collection, query)
+        elif len(partitions) > 1:
+            Parallel(n_jobs=self.num_jobs, backend="threading", verbose=10)(
+                delayed(self.process_partition)(collection, partition) for partition in partitions)
+        else:
+            works = collection.find(query, self.selector_projection())
+            Parallel(n_jobs=self.num_jobs, backend="threading", verbose=10)(
+                delayed(self.process_one_work)(work) for work in works)
+
+    def process_checkpointed(self, collection, query, n_jobs=None, writer=None):
+        """
+        Method to save in the output database all the works that match a query recording checkpoints.
+        The works are read sorted by _id (after the last checkpoint of the selector in a resumed run)
+        in chunks of checkpoint_size, every chunk is processed in parallel and written
+        before its last _id is saved as the checkpoint of the selector.
 
-    def process_one_work(self, work):
+        Parameters:
+        ----------
+        collection: pymongo.collection.Collection
+            input collection.
+        query: dict
+            mongodb query that returns works.
+        n_jobs: int
+            threads processing every chunk, by default num_jobs (1 for the partitions of parallel_scan).
+        writer: BulkWriter
+            writer of the works, by default self.writer (every partition of parallel_scan has its own).
+        """
+        n_jobs = self.num_jobs if n_jobs is None else n_jobs
+        writer = self.writer if writer is None else writer
+        selector = self.checkpoints.selector_id(collection, query)
+        if self.checkpoints.is_done(selector):
+            if self.verbose > 0:
+                print(f"INFO: Skipping {selector}, done in a previous run")
+            return
+        works = collection.find(self.checkpoints.resume_query(selector, query), None,
+                                allow_disk_use=True).sort("_id", ASCENDING)
+        for chunk in chunks(works, self.checkpoint_size):
+            Parallel(n_jobs=n_jobs, backend="threading")(
+                delayed(self.process_one_work)(work, writer) for work in chunk)
+            writer.flush()
+            last = chunk[-1]
+            self.checkpoints.save(selector, raw_key(last.raw, ["_id"])["_id"] if isinstance(last, RawBSONDocument) else last["_id"])
+        self.checkpoints.save(selector, done=True)
+
+    def pipeline_done(self, collection, pipeline):
+        """
+        Checks if a pipeline (or a streamed query) selector was finished by a previous run,
+        they can not be resumed from a checkpoint, they are only marked as done.
+
+        Parameters:
+        ----------
+        collection: pymongo.collection.Collection
+            input collection.
+        pipeline: list or dict
+            mongodb pipeline or query of the selector.
+        """
+        if self.checkpoints is None or self.collecting_ids:
+            return False
+        selector = self.checkpoints.selector_id(collection, pipeline)
+        if self.checkpoints.is_done(selector):
+            if self.verbose > 0:
+                print(f"INFO: Skipping {selector}, done in a previous run")
+            return True
+        return False
+
+    def finish_pipeline(self, collection, pipeline):
+        """
+        Marks a pipeline (or a streamed query) selector as done, after writing all its works.
+
+        Parameters:
+        ----------
+        collection: pymongo.collection.Collection
+            input collection.
+        pipeline: list or dict
+            mongodb pipeline or query of the selector.
+        """
+        if self.checkpoints is not None and not self.collecting_ids:
+            self.writer.flush()
+            self.checkpoints.save(self.checkpoints.selector_id(collection, pipeline), done=True)
+
+    def process_one_work(self, work, writer=None):
         """
         Method to process one work and save it in the output database.
         Required for parallel processing.
+        The work is buffered in the bulk writer, works already saved are skipped by the writer.
+        In the first phase of id_first only the id_producto_pd of the work is collected.
 
         Parameters:
         ----------
         work: dict
             A dictionary with the work to process.
+        writer: BulkWriter
+            writer of the work, by default self.writer.
         """
-        work_id = {"id_producto_pd": work["id_producto_pd"]}
-        if self.cols_out["gruplac_production"].count_documents(work_id) == 0:
-            self.cols_out["gruplac_production"].insert_one(work)
+        if self.collecting_ids:
+            key = self.writer.key(work)["id_producto_pd"]
+            with self.ids_lock:
+                self.ids.add(key)
         else:
-            if self.verbose > 2:
-                print(
-                    f"INFO: Work {work_id} already exists in db {self.db_out.name} collection {self.cols_out['gruplac_production'].name}")
+            (self.writer if writer is None else writer).add(work)
+
+    def process_ids_chunk(self, ids, query=None):
+        """
+        Method to save a chunk of the works collected by id_first (or refresh), resolved with a single $in query.
+        Required for parallel processing.
+
+        Parameters:
+        ----------
+        ids: list
+            list of id_producto_pd.
+        query: dict
+            additional filter of the works, None to save all of them.
+        """
+        query = {"$and": [{"id_producto_pd": {"$in": ids}}, query]} if query else {"id_producto_pd": {"$in": ids}}
+        for work in self.cols_in["gruplac_production"].find(query):
+            self.writer.add(work)
+
+    def process_ids(self, ids=None, query=None):
+        """
+        Second phase of id_first (and of refresh), the unique works collected by all the selectors
+        are fetched once in chunks of chunk_size ids with $in queries that run in parallel.
+
+        Parameters:
+        ----------
+        ids: set
+            ids of the works to fetch, by default the ids collected by the selectors.
+        query: dict
+            additional filter of the works, None to fetch all of them.
+        """
+        ids = self.ids if ids is None else ids
+        if self.verbose > 0:
+            print(
+                f"INFO: Fetching {len(ids)} works from db {self.db_in.name} collection {self.cols_in['gruplac_production'].name}")
+        ensure_indexes(self.cols_in["gruplac_production"], ["id_producto_pd"], verbose=self.verbose)
+        Parallel(n_jobs=self.num_jobs, backend="threading", verbose=10)(
+            delayed(self.process_ids_chunk)(chunk, query) for chunk in chunks(list(ids), self.chunk_size))
+
+    def process_products_chunk(self, product_ids):
+        """
+        Method to save a chunk of products given their id_producto_pd, resolved with a single $in query.
+        Required for parallel processing.
+
+        Parameters:
+        ----------
+        product_ids: list
+            list of id_producto_pd.
+        """
+        for work in self.cols_in["gruplac_production"].find({"id_producto_pd": {"$in": product_ids}}, self.selector_projection()):
+            self.process_one_work(work)
 
     def process_products(self):
         """
         process products given the COD_RH and COD_PRODUCTO in the workflow configuration.
+        The ids matched by the regex patterns are found with the minimum number of scans (see match_regex_keys),
+        then they are deduplicated with an in memory set of the ids already seen and
+        the new ones are saved in chunks of chunk_size with $in queries that run in parallel.
         """
         if "products" in self.config["minciencias_sample"] and self.config["minciencias_sample"]["products"]:
-            product_ids = []
+            patterns = []
             for product in self.config["minciencias_sample"]["products"]:
                 regex = re.compile(product)
-                product_ids.append(regex)
+                patterns.append(regex.pattern)
             if self.verbose > 0:
-                print("INFO: Processing products regex: ", len(product_ids))
-            total_found = 0
-            for product_id in product_ids:
+                print("INFO: Processing products regex: ", len(patterns))
+            matches = match_regex_keys(self.cols_in["gruplac_production"], "id_producto_pd", patterns)
+            seen = set()
+            product_ids = []
+            for pattern in patterns:
                 found = 0
-                work_cursor = self.cols_in["gruplac_production"].find(
-                    {"id_producto_pd": {"$regex": product_id}})
-                for work in work_cursor:
-                    if self.cols_out["gruplac_production"].count_documents(work) == 0:
+                for key in sorted(matches[pattern]):
+                    if key not in seen:
+                        seen.add(key)
                         found += 1
-                        total_found += 1
-                        self.cols_out["gruplac_production"].insert_one(work)
+                        product_ids.append(key)
                     else:
                         if self.verbose > 2:
                             print(
-                                f"INFO: Product {product_id.pattern} already exists in db {self.db_out.name} collection {self.cols_out['gruplac_production_data'].name}")
+                                f"INFO: Product {key} already processed for db {self.db_out.name} collection {self.cols_out['gruplac_production'].name}")
                 print(
-                    f"INFO: Found {found} works for product {product_id.pattern}")
-            print(f"INFO: Found {total_found} works in total")
+                    f"INFO: Found {found} works for product {pattern}")
+            print(f"INFO: Found {len(product_ids)} works in total")
+            Parallel(n_jobs=self.num_jobs, backend="threading", verbose=10)(
+                delayed(self.process_products_chunk)(chunk) for chunk in chunks(product_ids, self.chunk_size))
 
     def process_groups(self):
         """
@@ -123,30 +434,30 @@ class Kahi_minciencias_sample(KahiBase):
                 if self.verbose > 0:
                     print(
                         f"INFO: Found {self.cols_in['gruplac_production'].count_documents({'cod_grupo_gr': group_id})} in db {self.db_in.name} collection {self.cols_in['gruplac_production'].name} for id {group_id}")  # noqa: E501
-                works = self.cols_in["gruplac_production"].find(
-                    {"cod_grupo_gr": group_id})
-                Parallel(n_jobs=self.num_jobs, backend="threading", verbose=10)(
-                    delayed(self.process_one_work)(work) for work in works)
+                self.process_query(self.cols_in["gruplac_production"], {"cod_grupo_gr": group_id})
 
     def process_categories(self):
         """
         Process categories given the COD_CATEGORY in the workflow configuration.
+        The categories matched by the regex patterns are found with the minimum number of scans (see match_regex_keys),
+        then the works of all of them are saved with a single $in query.
         """
         if "categories" in self.config["minciencias_sample"] and self.config["minciencias_sample"]["categories"]:
             category_ids = []
             for cat in self.config["minciencias_sample"]["categories"]:
                 regex = re.compile(cat)
-                category_ids.append(regex)
+                category_ids.append(regex.pattern)
             if self.verbose > 0:
                 print("INFO: Processing categories: ", len(category_ids))
+            matches = match_regex_keys(self.cols_in["gruplac_production"], "id_tipo_pd_med", category_ids)
+            categories = set()
             for category_id in category_ids:
+                categories.update(matches[category_id])
                 if self.verbose > 0:
                     print(
-                        f"INFO: Found {self.cols_in['gruplac_production'].count_documents({'id_tipo_pd_med': category_id})} in db {self.db_in.name} collection {self.cols_in['gruplac_production'].name} for id {category_id.pattern}")  # noqa: E501
-                works = self.cols_in["gruplac_production"].find(
-                    {"id_tipo_pd_med": category_id})
-                Parallel(n_jobs=self.num_jobs, backend="threading", verbose=10)(
-                    delayed(self.process_one_work)(work) for work in works)
+                        f"INFO: Found {self.cols_in['gruplac_production'].count_documents({'id_tipo_pd_med': {'$in': sorted(matches[category_id])}})} in db {self.db_in.name} collection {self.cols_in['gruplac_production'].name} for id {category_id}")  # noqa: E501
+            if categories:
+                self.process_query(self.cols_in["gruplac_production"], {"id_tipo_pd_med": {"$in": sorted(categories)}})
 
     def process_custom_queries(self):
         """
@@ -160,9 +471,7 @@ class Kahi_minciencias_sample(KahiBase):
                 if self.verbose > 0:
                     print(
                         f"INFO: Found {self.cols_in['gruplac_production'].count_documents(query)} in db {self.db_in.name} collection {self.cols_in['gruplac_production'].name} for query {query}")
-                works = self.cols_in["gruplac_production"].find(query)
-                Parallel(n_jobs=self.num_jobs, backend="threading", verbose=10)(
-                    delayed(self.process_one_work)(work) for work in works)
+                self.process_query(self.cols_in["gruplac_production"], query)
 
     def process_custom_pipelines(self):
         """
@@ -173,101 +482,295 @@ class Kahi_minciencias_sample(KahiBase):
             if self.verbose > 0:
                 print("INFO: Processing custom pipelines: ", len(pipelines))
             for pipeline in pipelines:
-                works = self.cols_in["gruplac_production"].aggregate(pipeline)
+                if self.pipeline_done(self.cols_in["gruplac_production"], pipeline):
+                    continue
+                works = self.cols_in["gruplac_production"].aggregate(self.selector_pipeline(pipeline))
                 Parallel(n_jobs=self.num_jobs, backend="threading", verbose=10)(
                     delayed(self.process_one_work)(work) for work in works)
+                self.finish_pipeline(self.cols_in["gruplac_production"], pipeline)
+
+    def get_enrichment_ids(self):
+        """
+        Returns the distinct person and group ids of the output works,
+        they are streamed from the output works the first time this method is called.
+
+        Returns:
+        ----------
+        dict
+            dictionary with the field (id_persona_pd or cod_grupo_gr) as key and the set of ids as value.
+        """
+        with self.enrichment_ids_lock:
+            if self.enrichment_ids is not None:
+                return self.enrichment_ids
+            enrichment_ids = {}
+            for field in ["id_persona_pd", "cod_grupo_gr"]:
+                pipeline = [
+                    {"$group": {"_id": f"${field}"}},
+                    {"$match": {"_id": {"$ne": None}}}
+                ]
+                ids = self.cols_out["gruplac_production"].aggregate(
+                    pipeline, allowDiskUse=True, batchSize=self.chunk_size)
+                enrichment_ids[field] = set(doc["_id"] for doc in ids)
+            self.enrichment_ids = enrichment_ids
+            return self.enrichment_ids
+
+    def save_entities(self, collection, field, ids, writer):
+        """
+        Utility function to save a chunk of profiles or groups in the output database,
+        resolved with a single $in query. Required for parallel processing.
+
+        Parameters:
+        ----------
+        collection: str
+            key of the collection in collection_names, the same in the input and output databases.
+        field: str
+            id field of the collection, ex: id_persona_pr.
+        ids: list
+            ids of the entities to save.
+        writer: BulkWriter
+            writer of the output collection.
+
+        Returns:
+        ----------
+        set
+            ids found in the input collection.
+        """
+        found = set()
+        for entity in self.cols_in[collection].find({field: {"$in": ids}}):
+            found.add(writer.key(entity)[field])
+            writer.add(entity)
+        return found
+
+    def save_referenced(self, collection, field, ids):
+        """
+        Utility function to save in the output database the entities with the given ids.
+        The ids are resolved in chunks of chunk_size in parallel and written with a bulk writer keyed on the id field.
+        With refresh the saved entities are replaced and the ones that are not in ids are removed.
+
+        Parameters:
+        ----------
+        collection: str
+            key of the collection in collection_names, the same in the input and output databases.
+        field: str
+            id field of the collection, ex: id_persona_pr.
+        ids: iterable
+            ids of the entities to save.
+
+        Returns:
+        ----------
+        set
+            ids found in the input collection.
+        """
+        writer = BulkWriter(self.cols_out[collection], [field], batch_size=self.bulk_size,
+                            flush_interval=self.flush_interval, verbose=self.verbose, replace=self.refresh)
+        found = Parallel(n_jobs=self.num_jobs, backend="threading", verbose=10)(
+            delayed(self.save_entities)(collection, field, chunk, writer) for chunk in chunks(list(ids), self.chunk_size))
+        writer.flush()
+        if self.refresh:
+            deleted = writer.delete(writer.saved_ids() - set(ids), self.chunk_size)
+            if self.verbose > 0:
+                print(
+                    f"INFO: Removed {deleted} documents from db {self.db_out.name} collection {self.cols_out[collection].name} not referenced by the output works")
+        if self.verbose > 0:
+            print(
+                f"INFO: Saved {writer.inserted} documents in db {self.db_out.name} collection {self.cols_out[collection].name}, skipped {writer.skipped} already saved")
+        return set().union(*found)
 
     def process_cvlac_stage(self):
         """
         Process cvlac stage in the workflow configuration.
+        The profiles not found in cvlac_stage are looked in cvlac_stage_private.
         """
-        person_ids = self.cols_out["gruplac_production"].distinct(
-            "id_persona_pd")
+        person_ids = self.get_enrichment_ids()["id_persona_pd"]
         if self.verbose > 0:
             print(
                 f"INFO: Processing cvlac stage, found {len(person_ids)} unique persons: ")
-        for person_id in person_ids:
-            profile = self.cols_in["cvlac_stage"].find_one(
-                {"id_persona_pr": person_id})
-            if profile:
-                if self.cols_out["cvlac_stage"].count_documents({"id_persona_pr": person_id}) == 0:
-                    self.cols_out["cvlac_stage"].insert_one(profile)
-                else:
-                    if self.verbose > 2:
-                        print(
-                            f"INFO: Profile {person_id} already exists in db {self.db_out.name} collection {self.cols_out['cvlac_stage'].name}")
-            else:
+        found = self.save_referenced("cvlac_stage", "id_persona_pr", person_ids)
+        missing = person_ids - found
+        if missing or self.refresh:
+            # with refresh the private profiles found now in cvlac_stage are removed
+            print(
+                f"INFO: {len(missing)} profiles not found in cvlac_stage, looking in {self.cols_out['cvlac_stage_private'].name}")
+            if self.verbose > 1:
+                print(f"INFO: Profiles not found in cvlac_stage: {sorted(missing)}")
+            missing = missing - self.save_referenced("cvlac_stage_private", "id_persona_pr", missing)
+            if missing:
                 print(
-                    f"INFO: Profile {person_id} not found in cvlac_stage, looking in {self.cols_out['cvlac_stage_private'].name}")
-
-                profile = self.cols_in["cvlac_stage_private"].find_one(
-                    {"id_persona_pr": person_id})
-                if profile:
-                    if self.cols_out["cvlac_stage_private"].count_documents({"id_persona_pr": person_id}) == 0:
-                        self.cols_out["cvlac_stage_private"].insert_one(
-                            profile)
-                    else:
-                        if self.verbose > 2:
-                            print(
-                                f"INFO: Profile {person_id} already exists in db {self.db_out.name} collection {self.cols_out['cvlac_stage_private'].name}")
-                else:
-                    print(
-                        f"INFO: Profile {person_id} not found in cvlac_stage_private.")
+                    f"INFO: {len(missing)} profiles not found in cvlac_stage_private.")
+                if self.verbose > 1:
+                    print(f"INFO: Profiles not found in cvlac_stage_private: {sorted(missing)}")
 
     def process_gruplac_groups(self):
         """
         Process gruplac groups in the workflow configuration.
         """
-        group_ids = self.cols_out["gruplac_production"].distinct(
-            "cod_grupo_gr")
+        group_ids = self.get_enrichment_ids()["cod_grupo_gr"]
         if self.verbose > 0:
             print(
                 f"INFO: Processing gruplac groups, found {len(group_ids)} unique groups")
-        for group_id in group_ids:
-            group = self.cols_in["gruplac_groups"].find_one(
-                {"cod_grupo_gr": group_id})
-            if group:
-                if self.cols_out["gruplac_groups"].count_documents({"cod_grupo_gr": group_id}) == 0:
-                    self.cols_out["gruplac_groups"].insert_one(group)
-                else:
-                    if self.verbose > 2:
-                        print(
-                            f"INFO: Group {group_id} already exists in db {self.db_out.name} collection {self.cols_out['gruplac_groups'].name}")
-            else:
-                print(f"INFO: Group {group_id} not found in gruplac_groups.")
+        missing = group_ids - self.save_referenced("gruplac_groups", "cod_grupo_gr", group_ids)
+        if missing:
+            print(f"INFO: {len(missing)} groups not found in gruplac_groups.")
+            if self.verbose > 1:
+                print(f"INFO: Groups not found in gruplac_groups: {sorted(missing)}")
 
     def process_cvlac_data(self):
         """
         Process cvlac data in the workflow configuration taking the person ids from the gruplac_production collection.
         """
-        person_ids = self.cols_out["gruplac_production"].distinct(
-            "id_persona_pd")
+        person_ids = self.get_enrichment_ids()["id_persona_pd"]
         if self.verbose > 0:
             print(
                 f"INFO: Processing cvlac data, found {len(person_ids)} unique persons: ")
+        missing = person_ids - self.save_referenced("cvlac_data", "id_persona_pr", person_ids)
+        if missing:
+            print(f"INFO: {len(missing)} profiles not found in cvlac_data")
+            if self.verbose > 1:
+                print(f"INFO: Profiles not found in cvlac_data: {sorted(missing)}")
 
-        for person_id in person_ids:
-            profile = self.cols_in["cvlac_data"].find_one(
-                {"id_persona_pr": person_id})
-            if profile:
-                if self.cols_out["cvlac_data"].count_documents({"id_persona_pr": person_id}) == 0:
-                    self.cols_out["cvlac_data"].insert_one(profile)
-                else:
-                    if self.verbose > 2:
-                        print(
-                            f"INFO: Profile {person_id} already exists in db {self.db_out.name} collection {self.cols_out['cvlac_data'].name}")
-            else:
-                print(
-                    f"INFO: Profile {person_id} not found in cvlac_data")
+    def run_stage(self, stage):
+        """
+        Method to run one enrichment stage, measuring its wall time and catching its errors.
+        Required for parallel processing.
 
-    def run(self):
+        Parameters:
+        ----------
+        stage: method
+            enrichment method to run.
+
+        Returns:
+        ----------
+        tuple
+            name of the stage, wall time in seconds and the exception raised (None if the stage finished).
+        """
+        start = time()
+        error = None
+        try:
+            stage()
+        except Exception as e:
+            print(f"ERROR: stage {stage.__name__} failed")
+            traceback.print_exc()
+            error = e
+        return stage.__name__, time() - start, error
+
+    def process_enrichment(self):
+        """
+        Method to run the cvlac and gruplac enrichment stages concurrently,
+        the distinct person and group ids of the output works are computed once and shared by them.
+        All the stages run even if one fails, the failed stages are reported and raised at the end.
+        """
+        self.get_enrichment_ids()
+        stages = [self.process_cvlac_stage,
+                  self.process_gruplac_groups,
+                  self.process_cvlac_data]
+        results = Parallel(n_jobs=min(self.num_jobs, len(stages)), backend="threading")(
+            delayed(self.run_stage)(stage) for stage in stages)
+        for name, elapsed, error in results:
+            print(
+                f"INFO: stage {name} {'failed' if error else 'finished'} in {elapsed:.2f} seconds")
+        failed = [(name, error) for name, elapsed, error in results if error]
+        if failed:
+            print(
+                f"ERROR: enrichment stages failed: {[name for name, error in failed]}")
+            raise Exception("Enrichment stages failed: ", failed)
+
+    def async_selectors(self):
+        """
+        Returns the selectors of the workflow configuration for the asyncio engine.
+
+        Returns:
+        ----------
+        list
+            list of tuples (description, url, collection, query or pipeline, projection).
+        """
+        return [(description, self.database_in_url, collection, query, None)
+                for description, collection, query in self.selector_queries()]
+
+    def process_async(self):
+        """
+        Method to save in the output database the works of all the selectors with the asyncio engine (engine: async).
+        Every selector is an async producer and sink_jobs batch writers save the works with the bulk writer keys,
+        so the output is the same of the threading engine. id_first only applies to the threading engine.
+        """
+        engine = AsyncEngine(self.writer, self.database_out_url, self.compressors, source_jobs=self.num_jobs,
+                             sink_jobs=self.sink_jobs, queue_size=self.queue_size,
+                             cursor_batch_size=self.chunk_size, verbose=self.verbose)
+        engine.run(self.async_selectors())
+
+    def process_selectors(self):
+        """
+        Method to run all the selectors of the workflow configuration with the threading engine.
+        """
         self.process_authors()
         self.process_products()
         self.process_groups()
         self.process_categories()
         self.process_custom_queries()
         self.process_custom_pipelines()
-        self.process_cvlac_stage()
-        self.process_gruplac_groups()
-        self.process_cvlac_data()
+
+    def process_refresh(self):
+        """
+        Method to refresh the sample in place (refresh: True) instead of building it again.
+        The selectors collect the ids of the works that match now (like the first phase of id_first),
+        the new works are saved, the works already saved are replaced only if their timestamp_field
+        changed since the last refresh, and the works that do not match anymore are removed.
+        """
+        state = self.db_out[self.state_collection]
+        since = None
+        if self.timestamp_field:
+            # taken before the selectors, so the works changed during the refresh are fetched again by the next one
+            timestamp = latest_timestamp(self.cols_in["gruplac_production"], self.timestamp_field, verbose=self.verbose)
+            since = get_refresh_mark(state, "minciencias_sample", self.cols_in["gruplac_production"])
+        else:
+            print("WARNING: refresh without timestamp_field, all the works are fetched again")
+        self.collecting_ids = True
+        self.process_selectors()
+        self.collecting_ids = False
+        saved = self.writer.saved_ids()
+        new = self.ids - saved
+        kept = self.ids & saved
+        removed = saved - self.ids
+        if self.verbose > 0:
+            print(
+                f"INFO: Refreshing {len(self.ids)} works, {len(new)} new, {len(kept)} already saved and {len(removed)} removed")
+        self.process_ids(new)
+        self.process_ids(kept, {self.timestamp_field: {"$gt": since}} if since is not None else None)
+        self.writer.flush()
+        deleted = self.writer.delete(removed, self.chunk_size)
+        if self.verbose > 0:
+            print(
+                f"INFO: Removed {deleted} works from db {self.writer.collection.database.name} collection {self.writer.collection.name}")
+        if self.timestamp_field and timestamp is not None:
+            set_refresh_mark(state, "minciencias_sample", self.cols_in["gruplac_production"], timestamp)
+
+    def run(self):
+        if not self.selector_queries():
+            # nothing is selected, the output is left as it is and no connection is opened
+            if self.verbose > 0:
+                print("INFO: Nothing selected in the workflow configuration")
+            return 0
+        if self.database_out_drop_database and not self.resume and not self.refresh:
+            self.client.drop_database(self.database_out_name)
+        self.process_indexes()
+        if self.checkpoints is not None:
+            self.checkpoints.start()
+        if self.seen is not None and (self.resume or not self.database_out_drop_database) and not self.refresh:
+            # the works saved by previous runs are skipped too
+            self.writer.warm()
+        if self.refresh:
+            self.process_refresh()
+        elif self.engine == "async":
+            self.process_async()
+        else:
+            # first phase of id_first, the selectors only collect the id_producto_pd
+            self.collecting_ids = self.id_first
+            self.process_selectors()
+            if self.id_first:
+                self.collecting_ids = False
+                self.process_ids()
+        self.writer.flush()
+        if self.verbose > 0:
+            print(
+                f"INFO: Saved {self.writer.inserted} works in db {self.db_out.name} collection {self.cols_out['gruplac_production'].name}, skipped {self.writer.skipped} already saved")
+        self.process_enrichment()
         return 0
@@ -0,0 +1,1144 @@
+from bson import decode
+from bson.raw_bson import RawBSONDocument
+from pymongo import ASCENDING, DESCENDING, IndexModel, MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError
+from array import array
+import asyncio
+from hashlib import blake2b
+from itertools import islice
+from threading import Condition, Lock, Thread
+from time import time
+import re
+import struct
+
+
+clients = {}
+# maxPoolSize of every client of the registry
+pool_sizes = {}
+clients_lock = Lock()
+
+
+def get_client(url, num_jobs=1, compressors=None):
+    """
+    Returns the MongoClient of the url from a process wide registry,
+    so all the plugins and databases with the same url share the same connection pool.
+    The client is created with connect=False, it does not open any connection until the first operation.
+    maxPoolSize is the default of pymongo (100), raised to 2 * num_jobs for more than 50 jobs,
+    and minPoolSize keeps num_jobs connections open once the client is connected.
+    The pool is sized by the first call for the url, the threads of the plugins with more jobs wait for a free connection.
+
+    Parameters:
+    ----------
+    url: str
+        mongodb connection url.
+    num_jobs: int
+        number of threads that use the client.
+    compressors: str
+        wire compressors separated by comma, ex: "zstd,snappy", None to disable compression.
+    """
+    max_pool_size = max(100, 2 * num_jobs)
+    key = (url, compressors)
+    with clients_lock:
+        if key not in clients:
+            options = {"connect": False, "maxPoolSize": max_pool_size, "minPoolSize": min(num_jobs, max_pool_size)}
+            if compressors:
+                options["compressors"] = compressors
+            clients[key] = MongoClient(url, **options)
+            pool_sizes[key] = max_pool_size
+        elif max_pool_size > pool_sizes[key]:
+            print(f"WARNING: {num_jobs} jobs share a pool of {pool_sizes[key]} connections")
+        return clients[key]
+
+
+def chunks(items, size):
+    """
+    Generator that splits a list, a cursor or any iterable in lists of the given size,
+    the items are consumed lazily so cursors are not loaded in memory.
+
+    Parameters:
+    ----------
+    items: iterable
+        items to split.
+    size: int
+        maximum size of every chunk.
+    """
+    items = iter(items)
+    chunk = list(islice(items, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(items, size))
+
+
+def partition_query(collection, query, partitions):
+    """
+    Splits a query in _id range partitions of about the same size using $bucketAuto,
+    every partition can be scanned with its own cursor.
+
+    Parameters:
+    ----------
+    collection: pymongo.collection.Collection
+        collection to query.
+    query: dict
+        mongodb query to split.
+    partitions: int
+        number of partitions.
+
+    Returns:
+    ----------
+    list
+        list of queries, one per partition.
+    """
+    pipeline = [
+        {"$match": query},
+        {"$project": {"_id": 1}},
+        {"$bucketAuto": {"groupBy": "$_id", "buckets": partitions}}
+    ]
+    buckets = list(collection.aggregate(pipeline, allowDiskUse=True))
+    queries = []
+    for i, bucket in enumerate(buckets):
+        # the max of the bucket is exclusive except for the last one
+        if i == len(buckets) - 1:
+            id_range = {"$gte": bucket["_id"]["min"], "$lte": bucket["_id"]["max"]}
+        else:
+            id_range = {"$gte": bucket["_id"]["min"], "$lt": bucket["_id"]["max"]}
+        queries.append({"$and": [query, {"_id": id_range}]})
+    return queries
+
+
+def ensure_indexes(collection, indexes, wait=True, verbose=1):
+    """
+    Creates the indexes of a collection that do not exist yet.
+
+    Parameters:
+    ----------
+    collection: pymongo.collection.Collection
+        collection to index.
+    indexes: list
+        list of fields, a list of fields is a compound index.
+    wait: bool
+        if False the indexes are built in a background thread.
+    verbose: int
+        verbosity level.
+
+    Returns:
+    ----------
+    threading.Thread
+        thread building the indexes when wait is False, None otherwise.
+    """
+    existing = [list(index["key"].keys()) for index in collection.list_indexes()]
+    missing = []
+    for index in indexes:
+        fields = [index] if isinstance(index, str) else list(index)
+        if fields not in existing:
+            missing.append(fields)
+    if not missing:
+        return None
+    if verbose > 0:
+        print(
+            f"INFO: Creating indexes {missing} in db {collection.database.name} collection {collection.name}")
+    models = [IndexModel([(field, ASCENDING) for field in fields]) for fields in missing]
+    if wait:
+        collection.create_indexes(models)
+        return None
+    thread = Thread(target=collection.create_indexes, args=(models,))
+    thread.start()
+    return thread
+
+
+def is_collscan(plan):
+    """
+    Checks if a query plan (or any of its input stages) is a collection scan.
+
+    Parameters:
+    ----------
+    plan: dict
+        query plan, usually explain["queryPlanner"]["winningPlan"].
+    """
+    if isinstance(plan, dict):
+        if plan.get("stage") == "COLLSCAN":
+            return True
+        return any(is_collscan(value) for value in plan.values())
+    if isinstance(plan, list):
+        return any(is_collscan(value) for value in plan)
+    return False
+
+
+def unindexed_queries(queries):
+    """
+    Returns the queries that would run a collection scan according to explain.
+    For pipelines only the leading $match stage is explained, pipelines without it always scan the collection.
+
+    Parameters:
+    ----------
+    queries: list
+        list of tuples (description, collection, query or pipeline).
+
+    Returns:
+    ----------
+    list
+        description of the queries that are not served by an index.
+    """
+    unindexed = []
+    for description, collection, query in queries:
+        if isinstance(query, list):
+            if not query or "$match" not in query[0]:
+                unindexed.append(description)
+                continue
+            query = query[0]["$match"]
+        explain = collection.find(query).explain()
+        if is_collscan(explain["queryPlanner"]["winningPlan"]):
+            unindexed.append(description)
+    return unindexed
+
+
+def latest_timestamp(collection, field, verbose=1):
+    """
+    Returns the greatest value of a timestamp field in a collection, None if no document has it.
+    The field is indexed if it is not yet, so the value is read from the end of the index
+    instead of sorting the whole collection, the index also serves the queries of the changed works.
+    Building the index blocks the first refresh and is always reported, because it changes the input collection.
+
+    Parameters:
+    ----------
+    collection: pymongo.collection.Collection
+        collection to query.
+    field: str
+        timestamp field, ex: updated_date.
+    verbose: int
+        verbosity level.
+    """
+    if not any(list(index["key"].keys())[0] == field for index in collection.list_indexes()):
+        print(
+            f"WARNING: {field} is not indexed in db {collection.database.name} collection {collection.name}, building the index before the refresh")
+        ensure_indexes(collection, [field], verbose=verbose)
+    doc = collection.find_one({field: {"$exists": True}}, {field: 1, "_id": 0}, sort=[(field, DESCENDING)])
+    return doc[field] if doc else None
+
+
+def get_refresh_mark(state, plugin, collection):
+    """
+    Returns the timestamp recorded by the last refresh of a plugin for an input collection, None if there is not.
+
+    Parameters:
+    ----------
+    state: pymongo.collection.Collection
+        state collection in the output database.
+    plugin: str
+        name of the plugin.
+    collection: pymongo.collection.Collection
+        input collection.
+    """
+    doc = state.find_one({"_id": f"{plugin} refresh {collection.database.name}.{collection.name}", "kind": "refresh"})
+    return doc["timestamp"] if doc else None
+
+
+def set_refresh_mark(state, plugin, collection, timestamp):
+    """
+    Records the timestamp of a refresh of a plugin for an input collection,
+    the next refresh only fetches the works changed after it.
+    The marks share the state collection with the checkpoints, they are told apart by the kind field.
+
+    Parameters:
+    ----------
+    state: pymongo.collection.Collection
+        state collection in the output database.
+    plugin: str
+        name of the plugin.
+    collection: pymongo.collection.Collection
+        input collection.
+    timestamp: object
+        greatest value of the timestamp field in the input collection when the refresh started.
+    """
+    state.update_one({"_id": f"{plugin} refresh {collection.database.name}.{collection.name}"},
+                     {"$set": {"plugin": plugin, "kind": "refresh", "timestamp": timestamp, "updated": time()}}, upsert=True)
+
+
+def drop_output_database(client, name, state_collection):
+    """
+    Drops the collections of the output database except the state collection, where only the refresh marks are kept,
+    so the precomputed indexes of the input collections are refreshed instead of rebuilt by the next run.
+
+    Parameters:
+    ----------
+    client: pymongo.MongoClient
+        client of the output database.
+    name: str
+        name of the output database.
+    state_collection: str
+        name of the state collection in the output database.
+    """
+    db = client[name]
+    for collection in db.list_collection_names():
+        if collection != state_collection and not collection.startswith("system."):
+            db.drop_collection(collection)
+    db[state_collection].delete_many({"kind": {"$ne": "refresh"}})
+
+
+def regex_prefix(pattern):
+    """
+    Returns the literal prefix of an anchored regex pattern (ex: "ART" for "^ART-.*"),
+    an empty string if the pattern is not anchored, has alternations or starts with a metacharacter.
+
+    Parameters:
+    ----------
+    pattern: str
+        regex pattern.
+    """
+    if not pattern.startswith("^") or "|" in pattern:
+        return ""
+    prefix = []
+    i = 1
+    while i < len(pattern):
+        if pattern[i] == "\\":
+            # escaped metacharacters are literals, classes like \d are not
+            if i + 1 == len(pattern) or pattern[i + 1].isalnum():
+                break
+            literal, step = pattern[i + 1], 2
+        elif pattern[i] in ".^$*+?{}[]()":
+            break
+        else:
+            literal, step = pattern[i], 1
+        # the last literal is optional if it is followed by ?, * or {
+        if i + step < len(pattern) and pattern[i + step] in "?*{":
+            break
+        prefix.append(literal)
+        i += step
+    return "".join(prefix)
+
+
+def prefix_range(prefix):
+    """
+    Returns the range of the strings that start with the prefix, it can be served by an index.
+
+    Parameters:
+    ----------
+    prefix: str
+        non empty literal prefix.
+    """
+    if ord(prefix[-1]) == 0x10FFFF:
+        return {"$gte": prefix}
+    return {"$gte": prefix, "$lt": prefix[:-1] + chr(ord(prefix[-1]) + 1)}
+
+
+def match_regex_keys(collection, field, patterns):
+    """
+    Returns the distinct values of a field matched by every regex pattern running the minimum number of scans.
+    The anchored patterns with a literal prefix are merged in a single $or query of index range scans.
+    The rest of the patterns share a single query with the alternation of the patterns,
+    evaluated by the server on the keys of the index of the field (covered scan) if the field is indexed.
+    Each pattern is tested in python only on the returned values, so the matches of each pattern are known.
+
+    Parameters:
+    ----------
+    collection: pymongo.collection.Collection
+        collection to query.
+    field: str
+        string field to match.
+    patterns: list
+        list of regex patterns.
+
+    Returns:
+    ----------
+    dict
+        dictionary with the pattern as key and the set of matched values as value.
+    """
+    regexes = {pattern: re.compile(pattern) for pattern in patterns}
+    matches = {pattern: set() for pattern in patterns}
+    prefixes = {pattern: regex_prefix(pattern) for pattern in patterns}
+    anchored = [pattern for pattern in patterns if prefixes[pattern]]
+    unanchored = [pattern for pattern in patterns if not prefixes[pattern]]
+    # an ascending or descending index that starts with the field and has all the documents,
+    # hinted by name because it can be compound
+    indexes = [index for index in collection.list_indexes() if list(index["key"].items())[0] in [(field, 1), (field, -1)]]
+    index = next((index for index in indexes if not index.get("sparse") and "partialFilterExpression" not in index), None)
+    plans = []
+    if anchored:
+        ranges = [{field: prefix_range(prefix)} for prefix in dict.fromkeys(prefixes[pattern] for pattern in anchored)]
+        plans.append(({"$or": ranges}, anchored))
+    if unanchored:
+        alternation = "|".join(f"(?:{pattern})" for pattern in unanchored)
+        plans.append(({field: {"$regex": alternation}}, unanchored))
+    for query, group in plans:
+        cursor = collection.find(query, {field: 1, "_id": 0})
+        if index is not None:
+            # only the index keys are read, the documents are not fetched
+            cursor = cursor.hint(index["name"])
+        for doc in cursor:
+            value = doc.get(field)
+            if not isinstance(value, str):
+                continue
+            for pattern in group:
+                if regexes[pattern].search(value):
+                    matches[pattern].add(value)
+    return matches
+
+
+def raw_element_size(raw, etype, offset):
+    """
+    Returns the size in bytes of the value of a BSON element.
+
+    Parameters:
+    ----------
+    raw: bytes
+        BSON document.
+    etype: int
+        BSON type of the element.
+    offset: int
+        position of the value of the element in the document.
+    """
+    if etype in (0x01, 0x09, 0x11, 0x12):  # double, datetime, timestamp, int64
+        return 8
+    if etype in (0x02, 0x0D, 0x0E):  # string, javascript, symbol
+        return 4 + struct.unpack_from("<i", raw, offset)[0]
+    if etype in (0x03, 0x04, 0x0F):  # document, array, javascript with scope
+        return struct.unpack_from("<i", raw, offset)[0]
+    if etype == 0x05:  # binary
+        return 5 + struct.unpack_from("<i", raw, offset)[0]
+    if etype in (0x06, 0x0A, 0x7F, 0xFF):  # undefined, null, maxkey, minkey
+        return 0
+    if etype == 0x07:  # objectid
+        return 12
+    if etype == 0x08:  # boolean
+        return 1
+    if etype == 0x0B:  # regex, two cstrings
+        end = raw.index(b"\x00", offset)
+        return raw.index(b"\x00", end + 1) + 1 - offset
+    if etype == 0x0C:  # dbpointer
+        return 4 + struct.unpack_from("<i", raw, offset)[0] + 12
+    if etype == 0x10:  # int32
+        return 4
+    if etype == 0x13:  # decimal128
+        return 16
+    raise ValueError(f"Unknown BSON type {etype}")
+
+
+def raw_key(raw, keys):
+    """
+    Decodes only the given top level fields of a BSON document,
+    the rest of the document is skipped without being decoded.
+
+    Parameters:
+    ----------
+    raw: bytes
+        BSON document.
+    keys: list
+        top level fields to decode.
+
+    Returns:
+    ----------
+    dict
+        dictionary with the decoded fields.
+    """
+    key = {}
+    offset = 4
+    end = len(raw) - 1
+    while offset < end and len(key) < len(keys):
+        etype = raw[offset]
+        name_end = raw.index(b"\x00", offset + 1)
+        name = raw[offset + 1:name_end].decode("utf-8")
+        size = raw_element_size(raw, etype, name_end + 1)
+        if name in keys:
+            element = raw[offset:name_end + 1 + size]
+            key.update(decode(struct.pack("<i", len(element) + 5) + element + b"\x00"))
+        offset = name_end + 1 + size
+    return key
+
+
+class SeenIds:
+    """
+    Compact thread safe set of the natural ids already seen in a run.
+    Only a 64 bits blake2b hash of every id is kept, in an open addressing table (array of unsigned 64 bits integers)
+    that uses about 16 bytes per id, so tens of millions of ids fit in a few hundred MB.
+    An optional Bloom filter in front of the table answers most of the lookups of new ids without probing the table.
+    Two different ids with the same 64 bits hash are taken as the same id, that is negligible for the sizes of the samples.
+
+    Parameters:
+    ----------
+    capacity: int
+        initial number of slots of the table, it is doubled when it is 3/4 full.
+    expected: int
+        number of ids expected, the table is allocated once for them instead of doubling while it grows.
+    bloom_size: int
+        number of bits of the Bloom filter, 0 to disable it.
+    bloom_hashes: int
+        number of hash functions of the Bloom filter.
+    """
+
+    def __init__(self, capacity=1 << 16, expected=0, bloom_size=0, bloom_hashes=4):
+        size = 1
+        while size < capacity or 4 * expected > 3 * size:
+            size <<= 1
+        self.table = array("Q", bytes(8 * size))
+        self.mask = size - 1
+        self.count = 0
+        self.bloom = bytearray((bloom_size + 7) // 8) if bloom_size > 0 else None
+        self.bloom_size = bloom_size
+        self.bloom_hashes = bloom_hashes
+        self.lock = Lock()
+
+    def __len__(self):
+        return self.count
+
+    def hash(self, key):
+        """
+        Returns the 64 bits hash of an id, 0 is reserved for the empty slots.
+        """
+        digest = int.from_bytes(blake2b(repr(key).encode("utf-8"), digest_size=8).digest(), "little")
+        return digest or 1
+
+    def bloom_bits(self, digest):
+        """
+        Returns the positions of the bits of a hash in the Bloom filter (double hashing).
+        """
+        h1 = digest & 0xFFFFFFFF
+        h2 = (digest >> 32) | 1
+        return [(h1 + i * h2) % self.bloom_size for i in range(self.bloom_hashes)]
+
+    def resize(self, size=None):
+        """
+        Grows the table, inserting again all the hashes.
+        Old and new tables are both allocated meanwhile, so growing once to the final size saves memory.
+
+        Parameters:
+        ----------
+        size: int
+            new number of slots, a power of two, None to double it.
+        """
+        table = self.table
+        self.table = array("Q", bytes(8 * (size or 2 * len(table))))
+        self.mask = len(self.table) - 1
+        for digest in table:
+            if digest:
+                i = digest & self.mask
+                while self.table[i]:
+                    i = (i + 1) & self.mask
+                self.table[i] = digest
+
+    def add(self, key):
+        """
+        Adds an id to the set.
+
+        Parameters:
+        ----------
+        key: object
+            natural id of a document, any value with a stable repr (ex: the dict returned by BulkWriter.key).
+
+        Returns:
+        ----------
+        bool
+            True if the id was not seen before.
+        """
+        digest = self.hash(key)
+        with self.lock:
+            if self.bloom is not None:
+                bits = self.bloom_bits(digest)
+                new = not all(self.bloom[bit >> 3] & (1 << (bit & 7)) for bit in bits)
+                for bit in bits:
+                    self.bloom[bit >> 3] |= 1 << (bit & 7)
+            else:
+                new = False
+            i = digest & self.mask
+            if not new:
+                # the Bloom filter can not tell if the id was seen, the table is probed
+                while self.table[i]:
+                    if self.table[i] == digest:
+                        return False
+                    i = (i + 1) & self.mask
+            else:
+                while self.table[i]:
+                    i = (i + 1) & self.mask
+            self.table[i] = digest
+            self.count += 1
+            if 4 * self.count > 3 * len(self.table):
+                self.resize()
+            return True
+
+    def reserve(self, count):
+        """
+        Grows the table once so count ids fit without more resizes.
+
+        Parameters:
+        ----------
+        count: int
+            number of ids expected in the set, including the ones already added.
+        """
+        with self.lock:
+            size = len(self.table)
+            while 4 * count > 3 * size:
+                size <<= 1
+            if size > len(self.table):
+                self.resize(size)
+
+    def __contains__(self, key):
+        digest = self.hash(key)
+        with self.lock:
+            i = digest & self.mask
+            while self.table[i]:
+                if self.table[i] == digest:
+                    return True
+                i = (i + 1) & self.mask
+            return False
+
+
+class BulkWriter:
+    """
+    Buffered writer that accumulates documents and flushes them to the output collection
+    as unordered bulk upserts keyed on the natural id of the source.
+    Documents already present in the output collection are left untouched (skipped).
+    The writer is thread safe, so it can be shared by the joblib threading workers.
+    RawBSONDocument works are supported, only the key fields are decoded and the bytes are sent as they are.
+    With a SeenIds set the documents already seen in the run are skipped without sending them to the server.
+    With replace the documents are upserted replacing the saved version instead of being skipped.
+
+    Parameters:
+    ----------
+    collection: pymongo.collection.Collection
+        output collection.
+    keys: list
+        fields that compose the natural id of the documents, a unique index is created on them before the first write.
+    batch_size: int
+        number of documents buffered before a flush.
+    flush_interval: float
+        maximum number of seconds a document can stay in the buffer before a flush.
+    verbose: int
+        verbosity level, with verbose > 0 a report is printed per flush.
+    seen: SeenIds
+        set of the ids already seen, shared by all the selectors of the run, None to disable it.
+    replace: bool
+        if True the saved documents are replaced keeping their _id (refresh), the replaced documents are counted as skipped.
+    """
+
+    def __init__(self, collection, keys, batch_size=1000, flush_interval=10, verbose=1, seen=None, replace=False):
+        self.collection = collection
+        self.keys = keys
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.verbose = verbose
+        self.buffer = []
+        self.inserted = 0
+        self.skipped = 0
+        self.lock = Lock()
+        self.last_flush = time()
+        self.indexed = False
+        self.seen = seen
+        self.replace = replace
+        # number of bulk writes in progress, flush waits for all of them
+        self.writing = 0
+        self.idle = Condition(self.lock)
+
+    def create_index(self):
+        """
+        Creates the unique index of the natural id in the output collection if it was not created yet.
+        """
+        with self.lock:
+            if not self.indexed:
+                self.collection.create_index(
+                    [(key, ASCENDING) for key in self.keys], unique=True)
+                self.indexed = True
+
+    def key(self, doc):
+        """
+        Returns the natural id of the document as a mongodb filter.
+        """
+        if isinstance(doc, RawBSONDocument):
+            key = raw_key(doc.raw, self.keys)
+            return {k: key[k] for k in self.keys}
+        return {key: doc[key] for key in self.keys}
+
+    def warm(self, batch_size=10000):
+        """
+        Adds to the seen ids the ids of the documents already saved in the output collection,
+        they are read with a query covered by the unique index of the natural id.
+        The seen ids are grown once for the estimated number of documents before loading them.
+
+        Parameters:
+        ----------
+        batch_size: int
+            batch size of the cursor.
+        """
+        self.create_index()
+        self.seen.reserve(len(self.seen) + self.collection.estimated_document_count())
+        projection = {key: 1 for key in self.keys}
+        projection["_id"] = 0
+        for doc in self.collection.find({}, projection, batch_size=batch_size).hint([(key, ASCENDING) for key in self.keys]):
+            self.seen.add(self.key(doc))
+        if self.verbose > 0:
+            print(
+                f"INFO: Loaded {len(self.seen)} ids from db {self.collection.database.name} collection {self.collection.name}")
+
+    def saved_ids(self):
+        """
+        Returns the natural ids of the documents saved in the output collection,
+        read with a query covered by the unique index of the natural id.
+        The ids are single values for one key and tuples for compound keys.
+        """
+        self.create_index()
+        projection = {key: 1 for key in self.keys}
+        projection["_id"] = 0
+        ids = set()
+        for doc in self.collection.find({}, projection).hint([(key, ASCENDING) for key in self.keys]):
+            key = self.key(doc)
+            ids.add(key[self.keys[0]] if len(self.keys) == 1 else tuple(key[k] for k in self.keys))
+        return ids
+
+    def delete(self, ids, size=1000):
+        """
+        Deletes from the output collection the documents with the given natural ids.
+
+        Parameters:
+        ----------
+        ids: iterable
+            natural ids, single values for one key and tuples for compound keys.
+        size: int
+            number of ids deleted per query.
+
+        Returns:
+        ----------
+        int
+            number of deleted documents.
+        """
+        deleted = 0
+        for chunk in chunks(ids, size):
+            if len(self.keys) == 1:
+                query = {self.keys[0]: {"$in": chunk}}
+            else:
+                query = {"$or": [dict(zip(self.keys, key)) for key in chunk]}
+            deleted += self.collection.delete_many(query).deleted_count
+        return deleted
+
+    def replace_op(self, key, doc):
+        """
+        Returns the upsert that replaces the saved document with the given one keeping the _id of the saved document,
+        the _id of the source is only used when the document is inserted.
+        A reloaded source has new _ids, and the _id of a saved document can not be changed by a replacement.
+
+        Parameters:
+        ----------
+        key: dict
+            natural id of the document as a mongodb filter.
+        doc: dict or RawBSONDocument
+            new version of the document.
+        """
+        doc = decode(doc.raw) if isinstance(doc, RawBSONDocument) else dict(doc)
+        source_id = doc.pop("_id", None)
+        # $literal keeps the values starting with $ as they are
+        new_id = {"$ifNull": ["$_id", {"$literal": source_id}]} if source_id is not None else "$_id"
+        return UpdateOne(key, [{"$replaceWith": {"$mergeObjects": [{"$literal": doc}, {"_id": new_id}]}}], upsert=True)
+
+    def fork(self):
+        """
+        Returns a writer with the same output collection, options and seen ids but its own buffer,
+        so its flush only waits for its own bulk writes (ex: a partition of a checkpointed query).
+        Its counters are added to this writer by join.
+        """
+        writer = BulkWriter(self.collection, self.keys, batch_size=self.batch_size, flush_interval=self.flush_interval,
+                            verbose=self.verbose, seen=self.seen, replace=self.replace)
+        writer.indexed = self.indexed
+        return writer
+
+    def join(self, writer):
+        """
+        Flushes a writer returned by fork and adds its counters to this writer.
+
+        Parameters:
+        ----------
+        writer: BulkWriter
+            writer returned by fork.
+        """
+        writer.flush()
+        with self.lock:
+            self.inserted += writer.inserted
+            self.skipped += writer.skipped
+
+    def add(self, doc):
+        """
+        Adds a document to the buffer, flushing it if the batch size or the flush interval is reached.
+        """
+        ops = None
+        key = self.key(doc)
+        if self.seen is not None and not self.seen.add(key):
+            with self.lock:
+                self.skipped += 1
+            return
+        if self.replace:
+            op = self.replace_op(key, doc)
+        else:
+            op = UpdateOne(key, {"$setOnInsert": doc}, upsert=True)
+        with self.lock:
+            self.buffer.append(op)
+            if len(self.buffer) >= self.batch_size or time() - self.last_flush >= self.flush_interval:
+                ops = self.buffer
+                self.buffer = []
+                self.last_flush = time()
+                self.writing += 1
+        if ops:
+            self.send(ops)
+
+    def flush(self):
+        """
+        Writes all the buffered documents in the output collection
+        and waits for the bulk writes in progress in other threads,
+        so all the documents added before the flush are saved when it returns.
+        """
+        with self.lock:
+            ops = self.buffer
+            self.buffer = []
+            self.last_flush = time()
+            if ops:
+                self.writing += 1
+        if ops:
+            self.send(ops)
+        with self.lock:
+            while self.writing:
+                self.idle.wait()
+
+    def send(self, ops):
+        """
+        Writes the operations taken from the buffer, keeping the count of the bulk writes in progress.
+        """
+        try:
+            self.write(ops)
+        finally:
+            with self.lock:
+                self.writing -= 1
+                self.idle.notify_all()
+
+    def write(self, ops):
+        """
+        Sends the operations to the server as an unordered bulk write.
+        Duplicated key errors are counted as skipped documents,
+        they happen when two flushes upsert the same id at the same time.
+        """
+        self.create_index()
+        try:
+            result = self.collection.bulk_write(ops, ordered=False)
+            inserted = result.upserted_count
+        except BulkWriteError as e:
+            errors = [error for error in e.details["writeErrors"]
+                      if error["code"] != 11000]
+            if errors:
+                raise
+            inserted = e.details["nUpserted"]
+        self.report(len(ops), inserted)
+
+    def report(self, written, inserted):
+        """
+        Updates the counters of the writer after a bulk write and prints the report of the flush.
+
+        Parameters:
+        ----------
+        written: int
+            number of operations sent in the bulk write.
+        inserted: int
+            number of documents inserted, the rest were already saved.
+        """
+        skipped = written - inserted
+        with self.lock:
+            self.inserted += inserted
+            self.skipped += skipped
+        if self.verbose > 0:
+            print(
+                f"INFO: Flushed {written} documents to db {self.collection.database.name} collection {self.collection.name}, inserted {inserted} skipped {skipped}")
+
+
+class Checkpoints:
+    """
+    Checkpoints of the selectors of a plugin, saved in a small state collection of the output database.
+    Every selector is identified by its input collection and its query or pipeline and has a state document
+    with the last _id processed and if it is done, a resumed run skips the selectors done
+    and restarts the partial ones after their last _id.
+    The state documents have kind "checkpoint", the other documents of the state collection
+    (ex: the refresh marks) are neither loaded nor removed.
+
+    Parameters:
+    ----------
+    collection: pymongo.collection.Collection
+        state collection in the output database.
+    plugin: str
+        name of the plugin, the state of every plugin is independent.
+    resume: bool
+        if True the state of the previous run is loaded, otherwise it is removed.
+    verbose: int
+        verbosity level.
+    """
+
+    def __init__(self, collection, plugin, resume=False, verbose=1):
+        self.collection = collection
+        self.plugin = plugin
+        self.resume = resume
+        self.verbose = verbose
+        self.state = {}
+        self.lock = Lock()
+
+    def start(self):
+        """
+        Loads the state of the previous run if resume is True, otherwise the state is removed.
+        """
+        if self.resume:
+            self.state = {doc["selector"]: doc for doc in self.collection.find({"plugin": self.plugin, "kind": "checkpoint"})}
+            if self.verbose > 0:
+                done = len([doc for doc in self.state.values() if doc["done"]])
+                print(
+                    f"INFO: Resuming {self.plugin}, {done} selectors done and {len(self.state) - done} partial in db {self.collection.database.name} collection {self.collection.name}")
+        else:
+            self.collection.delete_many({"plugin": self.plugin, "kind": "checkpoint"})
+            self.state = {}
+
+    def selector_id(self, collection, query):
+        """
+        Returns the id of a selector, the input collection with the query or pipeline.
+
+        Parameters:
+        ----------
+        collection: pymongo.collection.Collection
+            input collection.
+        query: dict or list
+            mongodb query or pipeline.
+        """
+        return f"{collection.database.name}.{collection.name} {query}"
+
+    def key(self, selector):
+        """
+        Returns the _id of the state document of a selector.
+        """
+        return blake2b(f"{self.plugin} {selector}".encode("utf-8"), digest_size=16).hexdigest()
+
+    def is_done(self, selector):
+        """
+        Checks if a selector was finished by the previous run.
+        """
+        with self.lock:
+            return selector in self.state and self.state[selector]["done"]
+
+    def resume_query(self, selector, query):
+        """
+        Returns the query of a selector restricted to the _ids after its last checkpoint.
+
+        Parameters:
+        ----------
+        selector: str
+            selector id.
+        query: dict
+            mongodb query of the selector.
+        """
+        with self.lock:
+            last_id = self.state[selector]["last_id"] if selector in self.state else None
+        if last_id is None:
+            return query
+        if self.verbose > 0:
+            print(f"INFO: Resuming {selector} after _id {last_id}")
+        return {"$and": [query, {"_id": {"$gt": last_id}}]}
+
+    def save(self, selector, last_id=None, done=False):
+        """
+        Saves the checkpoint of a selector, the works up to last_id must be already written.
+
+        Parameters:
+        ----------
+        selector: str
+            selector id.
+        last_id: object
+            last _id processed, None for the selectors that can not be resumed (pipelines).
+        done: bool
+            True if the selector finished.
+        """
+        with self.lock:
+            if last_id is None and selector in self.state:
+                last_id = self.state[selector]["last_id"]
+            state = {"plugin": self.plugin, "kind": "checkpoint", "selector": selector, "last_id": last_id, "done": done, "updated": time()}
+            self.state[selector] = state
+        self.collection.update_one({"_id": self.key(selector)}, {"$set": state}, upsert=True)
+
+
+class AsyncEngine:
+    """
+    asyncio producer/consumer engine, an alternative to the joblib threading workers.
+    Every selector is an async producer that streams its cursor into a bounded queue,
+    at most source_jobs selectors of the same input collection run at the same time.
+    sink_jobs batch writers drain the queue and send the works to the output collection as unordered bulk upserts,
+    with the natural id, seen ids and counters of the BulkWriter, so the output is the same of the threading engine.
+    It requires pymongo >= 4.10 (AsyncMongoClient), that is imported only when the engine is used.
+
+    Parameters:
+    ----------
+    writer: BulkWriter
+        writer of the output collection, its keys, seen ids and counters are used by the engine.
+    url_out: str
+        mongodb connection url of the output database.
+    compressors: str
+        wire compressors separated by comma, ex: "zstd,snappy", None to disable compression.
+    source_jobs: int
+        maximum number of selectors running at the same time on every input collection.
+    sink_jobs: int
+        number of batch writers, the maximum number of bulk writes running at the same time.
+    queue_size: int
+        maximum number of works waiting in the queue, the producers wait when it is full.
+    cursor_batch_size: int
+        batch size of the cursors of the selectors.
+    verbose: int
+        verbosity level.
+    """
+
+    def __init__(self, writer, url_out, compressors=None, source_jobs=1, sink_jobs=1, queue_size=1000,
+                 cursor_batch_size=1000, verbose=1):
+        self.writer = writer
+        self.url_out = url_out
+        self.compressors = compressors
+        self.source_jobs = source_jobs
+        self.sink_jobs = sink_jobs
+        self.queue_size = queue_size
+        self.cursor_batch_size = cursor_batch_size
+        self.verbose = verbose
+        self.clients = {}
+
+    def client(self, url):
+        """
+        Returns the AsyncMongoClient of the url, the clients are bound to the event loop of the run.
+        """
+        if url not in self.clients:
+            try:
+                from pymongo import AsyncMongoClient
+            except ImportError:
+                print("ERROR: engine async requires pymongo >= 4.10")
+                raise
+            options = {"maxPoolSize": max(100, 2 * max(self.source_jobs, self.sink_jobs))}
+            if self.compressors:
+                options["compressors"] = self.compressors
+            self.clients[url] = AsyncMongoClient(url, **options)
+        return self.clients[url]
+
+    def collection(self, url, collection):
+        """
+        Returns the async collection of the url with the same database, name and codec options of a collection.
+        """
+        database = self.client(url).get_database(
+            collection.database.name, codec_options=collection.codec_options)
+        return database[collection.name]
+
+    async def produce(self, description, url, collection, query, projection, semaphores):
+        """
+        Producer of one selector, streams the works of a query or a pipeline into the queue.
+
+        Parameters:
+        ----------
+        description: str
+            description of the selector for the logs.
+        url: str
+            mongodb connection url of the input database.
+        collection: pymongo.collection.Collection
+            input collection.
+        query: dict or list
+            mongodb query or pipeline that returns works.
+        projection: dict
+            projection of the query, None to return the whole works.
+        semaphores: dict
+            semaphores of the input collections.
+        """
+        source = (url, collection.database.name, collection.name)
+        if source not in semaphores:
+            semaphores[source] = asyncio.Semaphore(self.source_jobs)
+        count = 0
+        async with semaphores[source]:
+            async_collection = self.collection(url, collection)
+            if isinstance(query, list):
+                cursor = await async_collection.aggregate(query, allowDiskUse=True, batchSize=self.cursor_batch_size)
+            else:
+                cursor = async_collection.find(query, projection, batch_size=self.cursor_batch_size)
+            async for work in cursor:
+                await self.queue.put(work)
+                count += 1
+        if self.verbose > 0:
+            print(
+                f"INFO: Found {count} in db {collection.database.name} collection {collection.name} for {description}")
+
+    async def consume(self):
+        """
+        Batch writer, drains the queue until it gets None and writes the works in batches of the writer batch size.
+        A batch is also written when no work arrives in flush_interval seconds.
+        """
+        ops = []
+        last_flush = time()
+        while True:
+            try:
+                work = await asyncio.wait_for(self.queue.get(), timeout=self.writer.flush_interval)
+            except asyncio.TimeoutError:
+                if ops:
+                    await self.write(ops)
+                    ops = []
+                last_flush = time()
+                continue
+            if work is None:
+                break
+            key = self.writer.key(work)
+            if self.writer.seen is not None and not self.writer.seen.add(key):
+                with self.writer.lock:
+                    self.writer.skipped += 1
+                continue
+            ops.append(UpdateOne(key, {"$setOnInsert": work}, upsert=True))
+            if len(ops) >= self.writer.batch_size or time() - last_flush >= self.writer.flush_interval:
+                await self.write(ops)
+                ops = []
+                last_flush = time()
+        if ops:
+            await self.write(ops)
+
+    async def write(self, ops):
+        """
+        Sends the operations to the output collection as an unordered bulk write,
+        duplicated key errors are counted as skipped documents like in BulkWriter.write.
+        """
+        collection = self.collection(self.url_out, self.writer.collection)
+        try:
+            result = await collection.bulk_write(ops, ordered=False)
+            inserted = result.upserted_count
+        except BulkWriteError as e:
+            errors = [error for error in e.details["writeErrors"]
+                      if error["code"] != 11000]
+            if errors:
+                raise
+            inserted = e.details["nUpserted"]
+        self.writer.report(len(ops), inserted)
+
+    async def produce_all(self, selectors):
+        """
+        Runs the producers of all the selectors and then stops the batch writers.
+        """
+        semaphores = {}
+        await asyncio.gather(*(self.produce(*selector, semaphores) for selector in selectors))
+        for i in range(self.sink_jobs):
+            await self.queue.put(None)
+
+    async def main(self, selectors):
+        """
+        Runs the producers of all the selectors and the batch writers until all the works are written.
+        If a producer or a batch writer fails the other tasks are cancelled and the error is raised,
+        otherwise the producers would wait forever on the full queue of a failed writer.
+        """
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        tasks = [asyncio.create_task(self.produce_all(selectors))]
+        tasks += [asyncio.create_task(self.consume()) for i in range(self.sink_jobs)]
+        try:
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                if task.exception() is not None:
+                    raise task.exception()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for client in self.clients.values():
+                await client.close()
+            self.clients = {}
+
+    def run(self, selectors):
+        """
+        Saves in the output collection the works of all the selectors.
+
+        Parameters:
+        ----------
+        selectors: list
+            list of tuples (description, url, collection, query or pipeline, projection),
+            the collection is the synchronous input collection, the async one is derived from it.
+        """
+        self.writer.create_index()
+        asyncio.run(self.main(selectors))
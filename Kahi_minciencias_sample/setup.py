@@ -82,7 +82,7 @@ def main():
         install_requires=[
             'kahi',
             'joblib',
-            'pymongo'
+            'pymongo>=4.10'
         ],
     )
 
@@ -0,0 +1,65 @@
+from datetime import datetime, timezone
+
+from bson import decode, encode
+from bson.binary import Binary
+from bson.code import Code
+from bson.dbref import DBRef
+from bson.decimal128 import Decimal128
+from bson.int64 import Int64
+from bson.max_key import MaxKey
+from bson.min_key import MinKey
+from bson.objectid import ObjectId
+from bson.regex import Regex
+from bson.timestamp import Timestamp
+
+from kahi_minciencias_sample.Utils import raw_key
+
+
+def mixed_document():
+    return {
+        "_id": ObjectId("65a1b2c3d4e5f60718293a4b"),
+        "double": 1.5,
+        "string": "producto ñ",
+        "document": {"nested": {"deep": [1, {"a": "b"}]}},
+        "array": [1, "dos", [3.0, None], {"cuatro": 4}],
+        "binary": Binary(b"\x00\x01\x02", 0),
+        "objectid": ObjectId(),
+        "boolean": True,
+        "datetime": datetime(2024, 1, 2, 3, 4, 5, tzinfo=timezone.utc),
+        "null": None,
+        "regex": Regex("^ART-.*", "i"),
+        "dbref": DBRef("works", 1),
+        "code": Code("function() {}"),
+        "code_with_scope": Code("function() { return x; }", {"x": 1}),
+        "int32": 7,
+        "timestamp": Timestamp(1, 2),
+        "int64": Int64(1 << 40),
+        "decimal": Decimal128("3.14"),
+        "minkey": MinKey(),
+        "maxkey": MaxKey(),
+        "id_producto_pd": "0000536237-12",
+    }
+
+
+def test_raw_key_decodes_the_given_fields():
+    doc = mixed_document()
+    decoded = decode(encode(doc))
+    for key in doc:
+        assert raw_key(encode(doc), [key]) == {key: decoded[key]}
+
+
+def test_raw_key_skips_the_fields_before_and_between():
+    doc = mixed_document()
+    keys = ["_id", "regex", "id_producto_pd"]
+    assert raw_key(encode(doc), keys) == {key: doc[key] for key in keys}
+
+
+def test_raw_key_nested_values():
+    doc = {"skip": {"id": "no"}, "id": {"cid": [1, {"x": None}]}, "after": [{"id": "no"}]}
+    assert raw_key(encode(doc), ["id"]) == {"id": {"cid": [1, {"x": None}]}}
+
+
+def test_raw_key_missing_fields():
+    doc = {"_id": 1, "doi": "10.1/x"}
+    assert raw_key(encode(doc), ["cid", "doi"]) == {"doi": "10.1/x"}
+    assert raw_key(encode({}), ["_id"]) == {}
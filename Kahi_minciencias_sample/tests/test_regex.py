@@ -0,0 +1,91 @@
+import re
+
+import pytest
+
+from kahi_minciencias_sample.Utils import match_regex_keys, prefix_range, regex_prefix
+
+
+@pytest.mark.parametrize("pattern, prefix", [
+    ("^ART-.*", "ART-"),
+    ("^0000536237-", "0000536237-"),
+    ("ART-.*", ""),
+    (".*-0000536237-.*", ""),
+    ("^ART|^LIB", ""),
+    ("^(ART)", ""),
+    ("^[A]RT", ""),
+    ("^.RT", ""),
+    ("^ARTS?", "ART"),
+    ("^ARTS*", "ART"),
+    ("^ARTS+", "ARTS"),
+    ("^ARTS{2}", "ART"),
+    ("^A\\.B", "A.B"),
+    ("^A\\-B\\*", "A-B*"),
+    ("^A\\.?", "A"),
+    ("^A\\d+", "A"),
+    ("^A\\", "A"),
+    ("^", ""),
+    ("^A$", "A"),
+])
+def test_regex_prefix(pattern, prefix):
+    assert regex_prefix(pattern) == prefix
+
+
+@pytest.mark.parametrize("pattern", ["^ART-.*", "^ARTS?", "^ARTS*", "^A\\.?", "^A\\-B\\*", "^A\\d+"])
+def test_regex_prefix_is_a_prefix_of_every_match(pattern):
+    values = ["ART-1", "ART", "ARTS", "A", "A.", "A-B*", "A1", "A-B", "B"]
+    prefix = regex_prefix(pattern)
+    for value in values:
+        if re.search(pattern, value):
+            assert value.startswith(prefix)
+
+
+def test_prefix_range():
+    assert prefix_range("ART") == {"$gte": "ART", "$lt": "ARU"}
+    assert prefix_range("A-") == {"$gte": "A-", "$lt": "A."}
+    assert prefix_range("A\U0010FFFF") == {"$gte": "A\U0010FFFF"}
+
+
+class FakeCursor(list):
+    def hint(self, index):
+        self.index = index
+        return self
+
+
+class FakeCollection:
+    """
+    Collection with an index on the field that records the queries.
+    """
+
+    def __init__(self, field, values):
+        self.field = field
+        self.values = values
+        self.queries = []
+
+    def list_indexes(self):
+        return [{"name": f"{self.field}_1_x_1", "key": {self.field: 1, "x": 1}}]
+
+    def find(self, query, projection):
+        self.queries.append(query)
+        if "$or" in query:
+            ranges = [condition[self.field] for condition in query["$or"]]
+            values = [value for value in self.values if any(value >= r["$gte"] and ("$lt" not in r or value < r["$lt"]) for r in ranges)]
+        else:
+            values = [value for value in self.values if re.search(query[self.field]["$regex"], value)]
+        return FakeCursor({self.field: value} for value in values)
+
+
+def test_match_regex_keys():
+    collection = FakeCollection("id", ["ART-1", "ART-2", "LIB-0000536237-3", "X-9", "Y-0000536237-9"])
+    patterns = ["^ART-.*", "^ART-2", ".*-0000536237-.*", "9$"]
+    matches = match_regex_keys(collection, "id", patterns)
+    assert matches == {
+        "^ART-.*": {"ART-1", "ART-2"},
+        "^ART-2": {"ART-2"},
+        ".*-0000536237-.*": {"LIB-0000536237-3", "Y-0000536237-9"},
+        "9$": {"X-9", "Y-0000536237-9"},
+    }
+    # one range query for the anchored patterns and one alternation for the rest
+    assert collection.queries == [
+        {"$or": [{"id": {"$gte": "ART-", "$lt": "ART."}}, {"id": {"$gte": "ART-2", "$lt": "ART-3"}}]},
+        {"id": {"$regex": "(?:.*-0000536237-.*)|(?:9$)"}},
+    ]
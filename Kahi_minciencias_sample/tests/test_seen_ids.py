@@ -0,0 +1,107 @@
+from threading import Thread
+
+from kahi_minciencias_sample.Utils import SeenIds, chunks
+
+
+class CollidingIds(SeenIds):
+    """
+    SeenIds whose hashes share the low bits, so every id probes the same slots.
+    """
+
+    def hash(self, key):
+        return (key << 32) | 1
+
+
+def test_add_and_contains():
+    seen = SeenIds(capacity=8)
+    assert seen.add({"id": "W1"})
+    assert not seen.add({"id": "W1"})
+    assert seen.add({"id": "W2"})
+    assert {"id": "W1"} in seen
+    assert {"id": "W3"} not in seen
+    assert len(seen) == 2
+
+
+def test_collisions_are_probed():
+    seen = CollidingIds(capacity=64)
+    assert all(seen.add(key) for key in range(1, 40))
+    assert not any(seen.add(key) for key in range(1, 40))
+    assert all(key in seen for key in range(1, 40))
+    assert 40 not in seen
+    assert len(seen) == 39
+
+
+def test_resize_keeps_the_ids():
+    seen = SeenIds(capacity=4)
+    for key in range(1000):
+        seen.add(key)
+    assert len(seen.table) == 2048
+    assert 4 * len(seen) <= 3 * len(seen.table)
+    assert all(key in seen for key in range(1000))
+    assert 1000 not in seen
+
+
+def test_resize_with_collisions():
+    seen = CollidingIds(capacity=4)
+    for key in range(1, 100):
+        seen.add(key)
+    assert all(key in seen for key in range(1, 100))
+    assert not seen.add(50)
+
+
+def test_expected_and_reserve_allocate_once():
+    seen = SeenIds(capacity=4, expected=1000)
+    size = len(seen.table)
+    assert 4 * 1000 <= 3 * size
+    for key in range(1000):
+        seen.add(key)
+    assert len(seen.table) == size
+    seen.reserve(5000)
+    assert 4 * 5000 <= 3 * len(seen.table)
+    assert all(key in seen for key in range(1000))
+    size = len(seen.table)
+    seen.reserve(10)
+    assert len(seen.table) == size
+
+
+def test_bloom_filter():
+    seen = SeenIds(capacity=8, bloom_size=1 << 12)
+    assert all(seen.add(key) for key in range(200))
+    assert not any(seen.add(key) for key in range(200))
+    assert len(seen) == 200
+
+
+def test_concurrent_adds():
+    seen = SeenIds(capacity=8)
+    added = []
+
+    def add(keys):
+        added.append(sum(seen.add(key) for key in keys))
+
+    threads = [Thread(target=add, args=(range(2000),)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sum(added) == 2000
+    assert len(seen) == 2000
+
+
+def test_chunks():
+    assert list(chunks([1, 2, 3, 4, 5], 2)) == [[1, 2], [3, 4], [5]]
+    assert list(chunks([1, 2, 3, 4], 2)) == [[1, 2], [3, 4]]
+    assert list(chunks([], 2)) == []
+    assert list(chunks(range(3), 10)) == [[0, 1, 2]]
+
+
+def test_chunks_is_lazy():
+    consumed = []
+
+    def items():
+        for item in range(10):
+            consumed.append(item)
+            yield item
+
+    generator = chunks(items(), 3)
+    assert next(generator) == [0, 1, 2]
+    assert consumed == [0, 1, 2]
@@ -1,6 +1,12 @@
 from kahi.KahiBase import KahiBase
-from pymongo import MongoClient
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
 from joblib import Parallel, delayed
+from pymongo import ASCENDING
+from threading import Lock
+from time import time
+import traceback
+from kahi_openalex_sample.Utils import AsyncEngine, BulkWriter, Checkpoints, SeenIds, chunks, ensure_indexes, get_client, get_refresh_mark, latest_timestamp, partition_query, raw_key, set_refresh_mark, unindexed_queries
 
 
 class Kahi_openalex_sample(KahiBase):
@@ -13,6 +19,13 @@ class Kahi_openalex_sample(KahiBase):
 
     config = {}
 
+    # fields removed from the works by every projection profile
+    projection_profiles = {
+        "full": [],
+        "no_abstract": ["abstract_inverted_index"],
+        "minimal": ["abstract_inverted_index", "counts_by_year", "referenced_works", "related_works"],
+    }
+
     def __init__(self, config):
         """
         Initialize the Kahi_openalex_sample plugin.
@@ -30,45 +43,237 @@ class Kahi_openalex_sample(KahiBase):
         self.database_collection_publishers = "publishers"
         self.database_collection_sources = "sources"
 
-        self.client = MongoClient(self.database_out_url)
+        self.num_jobs = self.config["openalex_sample"]["num_jobs"] if "num_jobs" in self.config["openalex_sample"] else 1
+        # wire compressors, ex: "zstd,snappy"
+        self.compressors = self.config["openalex_sample"]["compressors"] if "compressors" in self.config["openalex_sample"] else None
+        self.client = get_client(self.database_out_url, self.num_jobs, self.compressors)
         self.db_out = self.client[self.database_out_name]
         self.collection_works_out = self.db_out[self.database_collection_works]
 
-        self.num_jobs = self.config["openalex_sample"]["num_jobs"] if "num_jobs" in self.config["openalex_sample"] else 1
-        if self.database_out_drop_database:
-            self.client.drop_database(self.database_out_name)
+        # if True the selectors done by an interrupted run are skipped and the partial ones are resumed
+        self.resume = self.config["openalex_sample"]["resume"] if "resume" in self.config["openalex_sample"] else False
+        # if True the sample is updated in place with the works changed since the last refresh
+        self.refresh = self.config["openalex_sample"]["refresh"] if "refresh" in self.config["openalex_sample"] else False
+        self.timestamp_field = self.config["openalex_sample"]["timestamp_field"] if "timestamp_field" in self.config["openalex_sample"] else "updated_date"
         self.database_in_url = self.config["openalex_sample"]['database_in']["database_url"]
         self.database_in_name = self.config["openalex_sample"]['database_in']["database_name"]
-        self.client_in = MongoClient(self.database_in_url)
-        self.db_in = self.client_in[self.database_in_name]
+        self.client_in = get_client(self.database_in_url, self.num_jobs, self.compressors)
+        self.raw = self.config["openalex_sample"]["raw"] if "raw" in self.config["openalex_sample"] else False
+        if self.raw:
+            # works are copied as raw bson, without decoding and encoding them again
+            self.db_in = self.client_in.get_database(
+                self.database_in_name, codec_options=CodecOptions(document_class=RawBSONDocument))
+        else:
+            self.db_in = self.client_in[self.database_in_name]
         self.collection_in = self.db_in["works"]
         self.verbose = self.config["openalex_sample"]["verbose"] if "verbose" in self.config["openalex_sample"] else 1
+        self.bulk_size = self.config["openalex_sample"]["bulk_size"] if "bulk_size" in self.config["openalex_sample"] else 1000
+        self.flush_interval = self.config["openalex_sample"]["flush_interval"] if "flush_interval" in self.config["openalex_sample"] else 10
+        self.parallel_scan = self.config["openalex_sample"]["parallel_scan"] if "parallel_scan" in self.config["openalex_sample"] else False
+        # collections with fewer documents are scanned with a single cursor, partitioning them costs an extra pass
+        self.parallel_scan_min_size = self.config["openalex_sample"]["parallel_scan_min_size"] if "parallel_scan_min_size" in self.config["openalex_sample"] else 100000
+        self.wait_indexes = self.config["openalex_sample"]["wait_indexes"] if "wait_indexes" in self.config["openalex_sample"] else True
+        self.chunk_size = self.config["openalex_sample"]["chunk_size"] if "chunk_size" in self.config["openalex_sample"] else 1000
+        # ids already seen in the run, the duplicated works are skipped without a round trip to the server
+        self.seen_ids = self.config["openalex_sample"]["seen_ids"] if "seen_ids" in self.config["openalex_sample"] else True
+        # bits of the Bloom filter in front of the seen ids, 0 to disable it
+        self.bloom_size = self.config["openalex_sample"]["bloom_size"] if "bloom_size" in self.config["openalex_sample"] else 0
+        # number of ids expected in the sample, the seen ids are allocated once for them
+        self.seen_capacity = self.config["openalex_sample"]["seen_capacity"] if "seen_capacity" in self.config["openalex_sample"] else 0
+        self.seen = SeenIds(expected=self.seen_capacity, bloom_size=self.bloom_size) if self.seen_ids else None
+        self.writer = BulkWriter(self.collection_works_out, ["id"], batch_size=self.bulk_size,
+                                 flush_interval=self.flush_interval, verbose=self.verbose, seen=self.seen, replace=self.refresh)
+        # options are: "full" (copy the whole collections) or "referenced" (copy only the entities referenced by the works)
+        self.post_process_mode = self.config["openalex_sample"]["post_process_mode"] if "post_process_mode" in self.config["openalex_sample"] else "full"
+        if self.post_process_mode not in ["full", "referenced"]:
+            print("ERROR: Invalid post_process_mode: ", self.post_process_mode)
+            raise Exception("Invalid post_process_mode: ", self.post_process_mode)
+        self.references = None
+        self.references_lock = Lock()
+        self.set_projection(self.config["openalex_sample"]["projection"]
+                            if "projection" in self.config["openalex_sample"] else "full")
+        # if True the selectors only collect the ids of the works, then every work is fetched once
+        self.id_first = self.config["openalex_sample"]["id_first"] if "id_first" in self.config["openalex_sample"] else False
+        self.collecting_ids = False
+        self.ids = set()
+        self.ids_lock = Lock()
+        # "threading" (joblib threads) or "async" (asyncio producers and batch writers)
+        self.engine = self.config["openalex_sample"]["engine"] if "engine" in self.config["openalex_sample"] else "threading"
+        if self.engine not in ["threading", "async"]:
+            print("ERROR: Invalid engine: ", self.engine)
+            raise Exception("Invalid engine: ", self.engine)
+        # concurrent bulk writes and maximum number of works waiting to be written in the async engine
+        self.sink_jobs = self.config["openalex_sample"]["sink_jobs"] if "sink_jobs" in self.config["openalex_sample"] else self.num_jobs
+        self.queue_size = self.config["openalex_sample"]["queue_size"] if "queue_size" in self.config["openalex_sample"] else 2 * self.bulk_size
+        # checkpoints of the selectors in the state collection of the output database, required by resume
+        self.checkpoint = self.config["openalex_sample"]["checkpoint"] if "checkpoint" in self.config["openalex_sample"] else False
+        self.checkpoint_size = self.config["openalex_sample"]["checkpoint_size"] if "checkpoint_size" in self.config["openalex_sample"] else 10 * self.bulk_size
+        self.state_collection = self.config["openalex_sample"]["state_collection"] if "state_collection" in self.config["openalex_sample"] else "sample_state"
+        self.checkpoints = Checkpoints(self.db_out[self.state_collection], "openalex_sample", resume=self.resume,
+                                       verbose=self.verbose) if self.checkpoint or self.resume else None
+        if self.engine == "async" and self.checkpoints is not None:
+            print("ERROR: checkpoint and resume are not supported by the async engine")
+            raise Exception("checkpoint and resume are not supported by the async engine")
+
+    def set_projection(self, projection):
+        """
+        Method to set the projection applied to the works and to the post processed entities.
+        self.projection is used for the works and self.entities_projection for the other collections,
+        the include lists are applied only to the works. Both are None when nothing is removed.
+
+        Parameters:
+        ----------
+        projection: str or dict
+            name of a projection profile ("full", "no_abstract" or "minimal")
+            or a dict with an "include" or "exclude" list of fields.
+        """
+        if isinstance(projection, str):
+            if projection not in self.projection_profiles:
+                print("ERROR: Invalid projection profile: ", projection)
+                raise Exception("Invalid projection profile: ", projection)
+            projection = {"exclude": self.projection_profiles[projection]}
+        if "include" in projection and projection["include"]:
+            # the id is always required to deduplicate the works
+            self.projection = {field: 1 for field in ["id"] + list(projection["include"])}
+            self.entities_projection = None
+        elif "exclude" in projection and projection["exclude"]:
+            self.projection = {field: 0 for field in projection["exclude"]}
+            self.entities_projection = self.projection
+        else:
+            self.projection = None
+            self.entities_projection = None
+
+    def selector_projection(self):
+        """
+        Returns the projection of the selector queries.
+        In the first phase of id_first only the id is returned, so the selectors served by an index
+        on the id are covered, otherwise the works projection is returned.
+        """
+        if self.collecting_ids:
+            return {"id": 1, "_id": 0}
+        return self.projection
+
+    def project_pipeline(self, pipeline, projection):
+        """
+        Returns the pipeline with a $project stage for the given projection,
+        the $project is added before a final $out or $merge stage.
+
+        Parameters:
+        ----------
+        pipeline: list
+            mongodb pipeline.
+        projection: dict
+            mongodb projection, the pipeline is returned as it is if None.
+        """
+        if not projection:
+            return pipeline
+        if pipeline and ("$out" in pipeline[-1] or "$merge" in pipeline[-1]):
+            return pipeline[:-1] + [{"$project": projection}, pipeline[-1]]
+        return pipeline + [{"$project": projection}]
+
+    def selector_queries(self):
+        """
+        Returns the queries and pipelines of the selectors in the workflow configuration.
+
+        Returns:
+        ----------
+        list
+            list of tuples (description, collection, query or pipeline).
+        """
+        config = self.config["openalex_sample"]
+        queries = []
+        if "authors" in config and config["authors"]:
+            queries += [(f"author {author_id}", self.collection_in, {"authorships.author.id": author_id})
+                        for author_id in config["authors"]]
+        if "products" in config and config["products"]:
+            queries.append(("products", self.collection_in, {"id": {"$in": config["products"]}}))
+        if "types" in config and config["types"]:
+            queries += [(f"type {type_id}", self.collection_in, type_id) for type_id in config["types"]]
+        if "institutions" in config and config["institutions"]:
+            queries += [(f"institution {institution_id}", self.collection_in, {"authorships.institutions.id": institution_id})
+                        for institution_id in config["institutions"]]
+        if "custom_queries" in config and config["custom_queries"]:
+            queries += [(f"custom query {query}", self.collection_in, query) for query in config["custom_queries"]]
+        if "custom_pipelines" in config and config["custom_pipelines"]:
+            queries += [(f"custom pipeline {pipeline}", self.collection_in, pipeline)
+                        for pipeline in config["custom_pipelines"]]
+        return queries
+
+    def validate_selectors(self):
+        """
+        Method to check the openalex ids of the products, authors and institutions in the workflow configuration,
+        it is called by both engines before any selector runs.
+        """
+        config = self.config["openalex_sample"]
+        prefixes = [("products", "https://openalex.org/W", "product"),
+                    ("authors", "https://openalex.org/A", "author"),
+                    ("institutions", "https://openalex.org/I", "institution")]
+        for selector, prefix, name in prefixes:
+            if selector in config and config[selector]:
+                for entity_id in config[selector]:
+                    if not entity_id.startswith(prefix):
+                        print(f"ERROR: Invalid {name} id: ", entity_id)
+                        raise Exception(f"Invalid {name} id: ", entity_id)
+
+    def process_indexes(self):
+        """
+        Method to create the indexes of the indeces tag of database_in (works) and database_out (works)
+        in the workflow configuration, the indexes that already exist are skipped.
+        With wait_indexes False the indexes are built in background.
+        The selector queries that are still not served by an index are reported.
+        """
+        threads = [ensure_indexes(self.collection_in, self.config["openalex_sample"]["database_in"]["indeces"]
+                                  if "indeces" in self.config["openalex_sample"]["database_in"] else [],
+                                  wait=self.wait_indexes, verbose=self.verbose),
+                   ensure_indexes(self.collection_works_out, self.config["openalex_sample"]["database_out"]["indeces"]
+                                  if "indeces" in self.config["openalex_sample"]["database_out"] else [],
+                                  wait=self.wait_indexes, verbose=self.verbose)]
+        if self.wait_indexes or not any(threads):
+            for description in unindexed_queries(self.selector_queries()):
+                print(
+                    f"WARNING: {description} is not served by an index in db {self.db_in.name} collection {self.collection_in.name}")
+
+    def process_works_chunk(self, product_ids):
+        """
+        Method to save a chunk of works given the openalex ids, resolved with a single $in query.
+        Required for parallel processing.
+
+        Parameters:
+        ----------
+        product_ids: list
+            list of openalex work ids.
+
+        Returns:
+        ----------
+        list
+            ids not found in the input database.
+        """
+        found = set()
+        for work in self.collection_in.find({"id": {"$in": product_ids}}, self.selector_projection()):
+            self.process_one_work(work)
+            found.add(self.writer.key(work)["id"])
+        return [product_id for product_id in product_ids if product_id not in found]
 
     def process_works(self):
         """
         process works given the openalex id in the workflow configuration.
+        The ids are resolved in chunks of chunk_size ids with $in queries that run in parallel,
+        the ids not found are reported at the end.
         """
         if "products" in self.config["openalex_sample"] and self.config["openalex_sample"]["products"]:
             product_ids = self.config["openalex_sample"]["products"]
             if self.verbose > 0:
                 print("INFO: Processing products: ", len(product_ids))
-            for product_id in product_ids:
-                if not product_id.startswith("https://openalex.org/W"):
-                    print("ERROR: Invalid product id: ", product_id)
-                    raise Exception("Invalid product id: ", product_id)
-
-                work = self.collection_in.find_one({"id": product_id})
-                if work:
-                    if self.collection_works_out.count_documents({"id": product_id}) == 0:
-                        self.collection_works_out.insert_one(work)
-                    else:
-                        if self.verbose > 2:
-                            print(
-                                f"INFO: Product {product_id} already exists in db {self.db_out.name} collection {self.collection_works_out.name}")
-                else:
-                    if self.verbose > 2:
-                        print(
-                            f"WARNING: Product {product_id} not found in the database {self.db_out.name} collection {self.collection_in.name}")
+            product_ids = list(dict.fromkeys(product_ids))
+            missing = Parallel(n_jobs=self.num_jobs, backend="threading", verbose=10)(
+                delayed(self.process_works_chunk)(chunk) for chunk in chunks(product_ids, self.chunk_size))
+            self.missing_products = [
+                product_id for chunk in missing for product_id in chunk]
+            if self.missing_products:
+                print(
+                    f"WARNING: {len(self.missing_products)} of {len(product_ids)} products not found in the database {self.db_in.name} collection {self.collection_in.name}")
+                if self.verbose > 1:
+                    print(f"WARNING: Products not found: {self.missing_products}")
 
     def process_authors(self):
         """
@@ -80,29 +285,183 @@ class Kahi_openalex_sample(KahiBase):
             if self.verbose > 0:
                 print("INFO: Processing authors: ", len(author_ids))
             for author_id in author_ids:
-                if not author_id.startswith("https://openalex.org/A"):
-                    print("ERROR: Invalid author id: ", author_id)
-                    raise Exception("Invalid author id: ", author_id)
                 if self.verbose > 0:
                     print(
                         f"INFO: Found {self.collection_in.count_documents({'authorships.author.id': author_id})} in db {self.db_in.name} collection {self.collection_in.name} for id   {author_id}")
-                works = self.collection_in.find(
-                    {"authorships.author.id": author_id})
-                Parallel(n_jobs=self.num_jobs, backend="threading", verbose=10)(
-                    delayed(self.process_one_work)(work) for work in works)
+                self.process_query(self.collection_in, {"authorships.author.id": author_id})
+
+    def process_partition(self, collection, query):
+        """
+        Method to save in the output database the works of one partition of a query.
+        Required for parallel processing.
+
+        Parameters:
+        ----------
+        collection: pymongo.collection.Collection
+            input collection.
+        query: dict
+            mongodb query of the partition.
+        """
+        for work in collection.find(query, self.selector_projection()):
+            self.process_one_work(work)
 
-    def process_one_work(self, work):
+    def process_query(self, collection, query):
+        """
+        Method to save in the output database all the works that match a query.
+        With parallel_scan the query is split in num_jobs _id range partitions that are scanned in parallel,
+        each one with its own cursor, otherwise the works of a single cursor are processed in parallel.
+        The collections with less than parallel_scan_min_size documents are not partitioned.
+        With checkpoints every partition has its own checkpoint and its own bulk writer,
+        so the flush of a checkpoint does not wait for the writes of the other partitions.
+
+        Parameters:
+        ----------
+        collection: pymongo.collection.Collection
+            input collection.
+        query: dict
+            mongodb query that returns works.
+        """
+        partitions = [query]
+        if self.parallel_scan and self.num_jobs > 1 and collection.estimated_document_count() >= self.parallel_scan_min_size:
+            partitions = partition_query(collection, query, self.num_jobs)
+        checkpointed = self.checkpoints is not None and not self.collecting_ids
+        if checkpointed and len(partitions) > 1:
+            # every partition is checkpointed as a selector, a resumed run finds the same partitions if the input did not change
+            writers = [self.writer.fork() for _ in partitions]
+            Parallel(n_jobs=self.num_jobs, backend="threading", verbose=10)(
+                delayed(self.process_checkpointed)(collection, partition, 1, writer) for partition, writer in zip(partitions, writers))
+            for writer in writers:
+                self.writer.join(writer)
+        elif checkpointed:
+            self.process_checkpointed(collection, query)
+        elif len(partitions) > 1:
+            Parallel(n_jobs=self.num_jobs, backend="threading", verbose=10)(
+                delayed(self.process_partition)(collection, partition) for partition in partitions)
+        else:
+            works = collection.find(query, self.selector_projection())
+            Parallel(n_jobs=self.num_jobs, backend="threading", verbose=10)(
+                delayed(self.process_one_work)(work) for work in works)
+
+    def process_checkpointed(self, collection, query, n_jobs=None, writer=None):
+        """
+        Method to save in the output database all the works that match a query recording checkpoints.
+        The works are read sorted by _id (after the last checkpoint of the selector in a resumed run)
+        in chunks of checkpoint_size, every chunk is processed in parallel and written
+        before its last _id is saved as the checkpoint of the selector.
+
+        Parameters:
+        ----------
+        collection: pymongo.collection.Collection
+            input collection.
+        query: dict
+            mongodb query that returns works.
+        n_jobs: int
+            threads processing every chunk, by default num_jobs (1 for the partitions of parallel_scan).
+        writer: BulkWriter
+            writer of the works, by default self.writer (every partition of parallel_scan has its own).
+        """
+        n_jobs = self.num_jobs if n_jobs is None else n_jobs
+        writer = self.writer if writer is None else writer
+        selector = self.checkpoints.selector_id(collection, query)
+        if self.checkpoints.is_done(selector):
+            if self.verbose > 0:
+                print(f"INFO: Skipping {selector}, done in a previous run")
+            return
+        works = collection.find(self.checkpoints.resume_query(selector, query), self.projection,
+                                allow_disk_use=True).sort("_id", ASCENDING)
+        for chunk in chunks(works, self.checkpoint_size):
+            Parallel(n_jobs=n_jobs, backend="threading")(
+                delayed(self.process_one_work)(work, writer) for work in chunk)
+            writer.flush()
+            last = chunk[-1]
+            self.checkpoints.save(selector, raw_key(last.raw, ["_id"])["_id"] if isinstance(last, RawBSONDocument) else last["_id"])
+        self.checkpoints.save(selector, done=True)
+
+    def pipeline_done(self, collection, pipeline):
+        """
+        Checks if a pipeline (or a streamed query) selector was finished by a previous run,
+        they can not be resumed from a checkpoint, they are only marked as done.
+
+        Parameters:
+        ----------
+        collection: pymongo.collection.Collection
+            input collection.
+        pipeline: list or dict
+            mongodb pipeline or query of the selector.
+        """
+        if self.checkpoints is None or self.collecting_ids:
+            return False
+        selector = self.checkpoints.selector_id(collection, pipeline)
+        if self.checkpoints.is_done(selector):
+            if self.verbose > 0:
+                print(f"INFO: Skipping {selector}, done in a previous run")
+            return True
+        return False
+
+    def finish_pipeline(self, collection, pipeline):
+        """
+        Marks a pipeline (or a streamed query) selector as done, after writing all its works.
+
+        Parameters:
+        ----------
+        collection: pymongo.collection.Collection
+            input collection.
+        pipeline: list or dict
+            mongodb pipeline or query of the selector.
+        """
+        if self.checkpoints is not None and not self.collecting_ids:
+            self.writer.flush()
+            self.checkpoints.save(self.checkpoints.selector_id(collection, pipeline), done=True)
+
+    def process_one_work(self, work, writer=None):
         """
         Method to process one work and save it in the output database.
         Required for parallel processing.
+        The work is buffered in the bulk writer, works already saved are skipped by the writer.
+        In the first phase of id_first only the id of the work is collected.
         """
-        work_id = {"id": work["id"]}
-        if self.collection_works_out.count_documents(work_id) == 0:
-            self.collection_works_out.insert_one(work)
+        if self.collecting_ids:
+            key = self.writer.key(work)["id"]
+            with self.ids_lock:
+                self.ids.add(key)
         else:
-            if self.verbose > 2:
-                print(
-                    f"INFO: Work  {work_id} already exists in db {self.db_out.name} collection {self.collection_works_out.name} ")
+            (self.writer if writer is None else writer).add(work)
+
+    def process_ids_chunk(self, ids, query=None):
+        """
+        Method to save a chunk of the works collected by id_first (or refresh), resolved with a single $in query.
+        Required for parallel processing.
+
+        Parameters:
+        ----------
+        ids: list
+            list of openalex work ids.
+        query: dict
+            additional filter of the works, None to save all of them.
+        """
+        query = {"$and": [{"id": {"$in": ids}}, query]} if query else {"id": {"$in": ids}}
+        for work in self.collection_in.find(query, self.projection):
+            self.writer.add(work)
+
+    def process_ids(self, ids=None, query=None):
+        """
+        Second phase of id_first (and of refresh), the unique works collected by all the selectors
+        are fetched once in chunks of chunk_size ids with $in queries that run in parallel.
+
+        Parameters:
+        ----------
+        ids: set
+            ids of the works to fetch, by default the ids collected by the selectors.
+        query: dict
+            additional filter of the works, None to fetch all of them.
+        """
+        ids = self.ids if ids is None else ids
+        if self.verbose > 0:
+            print(
+                f"INFO: Fetching {len(ids)} works from db {self.db_in.name} collection {self.collection_in.name}")
+        ensure_indexes(self.collection_in, ["id"], verbose=self.verbose)
+        Parallel(n_jobs=self.num_jobs, backend="threading", verbose=10)(
+            delayed(self.process_ids_chunk)(chunk, query) for chunk in chunks(list(ids), self.chunk_size))
 
     def process_types(self):
         """
@@ -127,9 +486,7 @@ class Kahi_openalex_sample(KahiBase):
                         f"INFO: Found {count} in db {self.db_in.name} collection {self.collection_in.name} for id   {type_id}")
 
                 # there are three levels of nesting in the product_type field
-                works = self.collection_in.find(type_id)
-                Parallel(n_jobs=self.num_jobs, backend="threading", verbose=10)(
-                    delayed(self.process_one_work)(work) for work in works)
+                self.process_query(self.collection_in, type_id)
 
     def process_institutions(self):
         """
@@ -142,17 +499,10 @@ class Kahi_openalex_sample(KahiBase):
             if self.verbose > 0:
                 print("INFO: Processing institutions: ", len(institution_ids))
             for institution_id in institution_ids:
-
-                if not institution_id.startswith("https://openalex.org/I"):
-                    print("ERROR: Invalid institution id: ", institution_id)
-                    raise Exception("Invalid institution id: ", institution_id)
                 if self.verbose > 0:
                     print(
                         f"INFO: Found {self.collection_in.count_documents({'authorships.institutions.id': institution_id})} in db {self.db_in.name} collection {self.collection_in.name} for id   {institution_id}")  # noqa
-                works = self.collection_in.find(
-                    {'authorships.institutions.id': institution_id})
-                Parallel(n_jobs=self.num_jobs, backend="threading", verbose=10)(
-                    delayed(self.process_one_work)(work) for work in works)
+                self.process_query(self.collection_in, {'authorships.institutions.id': institution_id})
 
     def process_custom_queries(self):
         """
@@ -168,9 +518,7 @@ class Kahi_openalex_sample(KahiBase):
                 if self.verbose > 0:
                     print(
                         f"INFO: Found {self.collection_in.count_documents(query)} in db {self.db_in.name} collection {self.collection_in.name} for query   {query}")
-                works = self.collection_in.find(query)
-                Parallel(n_jobs=self.num_jobs, backend="threading", verbose=10)(
-                    delayed(self.process_one_work)(work) for work in works)
+                self.process_query(self.collection_in, query)
 
     def process_custom_pipelines(self):
         """
@@ -183,48 +531,166 @@ class Kahi_openalex_sample(KahiBase):
             if self.verbose > 0:
                 print("INFO: Processing custom pipelines: ", len(pipelines))
             for pipeline in pipelines:
-                works = self.collection_in.aggregate(pipeline)
+                if self.pipeline_done(self.collection_in, pipeline):
+                    continue
+                works = self.collection_in.aggregate(
+                    self.project_pipeline(pipeline, self.selector_projection()))
                 Parallel(n_jobs=self.num_jobs, backend="threading", verbose=10)(
                     delayed(self.process_one_work)(work) for work in works)
+                self.finish_pipeline(self.collection_in, pipeline)
 
-    def save_author(self, aid):
+    def save_entities(self, collection, ids, writer):
         """
-        Utility function to save author in the output database.
-        Check if the author exists in the output database else then it save it.
+        Utility function to save a chunk of entities (authors, sources, institutions etc..) in the output database.
+        When the input and output databases are in the same server the entities are copied
+        server side with a $merge, otherwise they are read with a $in query and saved with the bulk writer.
+        Entities already saved are skipped, with refresh they are replaced keeping their _id.
 
         Parameters:
         ----------
-        aid: str
-            author id to save in the output database.
+        collection: str
+            name of the collection of the entities, the same in the input and output databases.
+        ids: list
+            openalex ids of the entities to save in the output database.
+        writer: BulkWriter
+            bulk writer of the output collection.
+        """
+        if self.database_in_url == self.database_out_url:
+            # the _id of the saved entity can not be changed by the replacement
+            matched = [{"$replaceWith": {"$mergeObjects": ["$$new", {"_id": "$_id"}]}}] if self.refresh else "keepExisting"
+            pipeline = [
+                {"$match": {"id": {"$in": ids}}},
+                {"$merge": {"into": {"db": self.db_out.name, "coll": collection},
+                            "on": "id", "whenMatched": matched, "whenNotMatched": "insert"}}
+            ]
+            self.db_in[collection].aggregate(
+                self.project_pipeline(pipeline, self.entities_projection))
+        else:
+            for entity in self.db_in[collection].find({"id": {"$in": ids}}, self.entities_projection):
+                writer.add(entity)
+
+    def save_referenced(self, collection, ids):
         """
-        author = self.db_in[self.database_collection_authors].find_one({
-                                                                       "id": aid})
-        if author is not None:
-            self.db_out[self.database_collection_authors].insert_one(author)
+        Utility function to save in the output database only the entities referenced by the output works.
+        The ids are saved in chunks of chunk_size in parallel.
+        With refresh the saved entities are replaced and the ones not referenced anymore are removed.
+
+        Parameters:
+        ----------
+        collection: str
+            name of the collection of the entities, the same in the input and output databases.
+        ids: iterable
+            openalex ids of the entities to save in the output database.
+        """
+        self.db_in[collection].create_index("id")
+        if self.refresh:
+            ids = set(ids)
+        # the unique index on the output collection is required by the $merge
+        writer = BulkWriter(self.db_out[collection], ["id"], batch_size=self.bulk_size,
+                            flush_interval=self.flush_interval, verbose=self.verbose, replace=self.refresh)
+        writer.create_index()
+        Parallel(n_jobs=self.num_jobs, verbose=10, backend="threading")(
+            delayed(self.save_entities)(collection, chunk, writer) for chunk in chunks(ids, self.chunk_size))
+        writer.flush()
+        if self.refresh:
+            deleted = writer.delete(writer.saved_ids() - ids, self.chunk_size)
+            if self.verbose > 0:
+                print(f"INFO: Removed {deleted} {collection} not referenced by the output works")
+        return writer
+
+    def get_references(self):
+        """
+        Returns the ids of the concepts, sources, institutions, funders and publishers referenced by the output works,
+        they are gathered in a single pass over the output works the first time this method is called.
+        The publishers are taken from the host organization of the referenced sources.
+
+        Returns:
+        ----------
+        dict
+            dictionary with the collection name as key and the set of referenced ids as value.
+        """
+        with self.references_lock:
+            if self.references is not None:
+                return self.references
+            references = {self.database_collection_concepts: set(),
+                          self.database_collection_sources: set(),
+                          self.database_collection_institutions: set(),
+                          self.database_collection_funders: set(),
+                          self.database_collection_publishers: set()}
+            projection = {"_id": 0, "concepts.id": 1, "primary_location.source.id": 1, "locations.source.id": 1,
+                          "authorships.institutions.id": 1, "grants.funder": 1}
+            print(
+                f"INFO: collecting references from {self.db_out.name}.{self.database_collection_works}")
+            for work in self.collection_works_out.find({}, projection, batch_size=self.chunk_size):
+                for concept in work.get("concepts") or []:
+                    references[self.database_collection_concepts].add(concept.get("id"))
+                locations = [work.get("primary_location")] + (work.get("locations") or [])
+                for location in locations:
+                    if location and location.get("source"):
+                        references[self.database_collection_sources].add(location["source"].get("id"))
+                for authorship in work.get("authorships") or []:
+                    for institution in authorship.get("institutions") or []:
+                        references[self.database_collection_institutions].add(institution.get("id"))
+                for grant in work.get("grants") or []:
+                    references[self.database_collection_funders].add(grant.get("funder"))
+            for chunk in chunks(references[self.database_collection_sources], self.chunk_size):
+                for source in self.db_in[self.database_collection_sources].find(
+                        {"id": {"$in": chunk}}, {"_id": 0, "host_organization": 1, "host_organization_lineage": 1}):
+                    publishers = [source.get("host_organization")] + (source.get("host_organization_lineage") or [])
+                    for publisher in publishers:
+                        if publisher and publisher.startswith("https://openalex.org/P"):
+                            references[self.database_collection_publishers].add(publisher)
+            for ids in references.values():
+                ids.discard(None)
+            if self.verbose > 0:
+                for collection, ids in references.items():
+                    print(f"INFO: Found {len(ids)} {collection} referenced by the output works")
+            self.references = references
+            return self.references
 
     def post_process_authors(self):
         """
         This method saves the authors found in output works in the authors collection.
+        The distinct author ids are streamed from the output works (one document per author)
+        and saved in chunks of chunk_size, so the memory does not depend on the number of authors.
         """
         print(
             f"INFO: processing index from {self.db_in.name}.{self.database_collection_authors} ")
-        self.db_in[self.database_collection_authors].create_index("id")
         pipeline = [
             {"$project": {"_id": 0, "authorships.author.id": 1}},
             {"$unwind": "$authorships"},
-            {"$group": {"_id": None, "authors": {"$addToSet": "$authorships.author.id"}}},
-            {"$unwind": "$authors"},
-            {"$project": {"_id": 0}}
+            {"$group": {"_id": "$authorships.author.id"}},
+            {"$match": {"_id": {"$ne": None}}}
         ]
 
         authors_ids = self.db_out[self.database_collection_works].aggregate(
-            pipeline)
-        authors_ids = list(authors_ids)
+            pipeline, allowDiskUse=True, batchSize=self.chunk_size)
 
         print(
             f"processing authors from {self.db_out.name}.{self.database_collection_works} to {self.db_out.name}.authors filtering from {self.db_in.name}.{self.database_collection_authors}")
-        Parallel(n_jobs=self.num_jobs, verbose=10, backend="threading", batch_size=10)(
-            delayed(self.save_author)(author["authors"]) for author in authors_ids)
+        self.save_referenced(self.database_collection_authors,
+                             (author["_id"] for author in authors_ids))
+
+    def post_process_collection(self, collection):
+        """
+        Method to post process a collection of entities and save it in the output database.
+        With post_process_mode "full" the whole collection is copied with a $out,
+        with "referenced" only the entities referenced by the output works are copied.
+
+        Parameters:
+        ----------
+        collection: str
+            name of the collection, the same in the input and output databases.
+        """
+        if self.post_process_mode == "referenced":
+            self.save_referenced(collection, self.get_references()[collection])
+        else:
+            pipeline = [
+                {"$match": {}},
+                {"$out": {"db": self.db_out.name, "coll": collection}}
+            ]
+            self.db_in[collection].aggregate(
+                self.project_pipeline(pipeline, self.entities_projection))
 
     def post_process_concepts(self):
         """
@@ -232,11 +698,7 @@ class Kahi_openalex_sample(KahiBase):
         """
         # concepts
         print("INFO: processing concepts ")
-        pipeline = [
-            {"$match": {}},
-            {"$out": {"db": self.db_out.name, "coll": self.database_collection_concepts}}
-        ]
-        self.db_in[self.database_collection_concepts].aggregate(pipeline)
+        self.post_process_collection(self.database_collection_concepts)
 
     def post_process_funders(self):
         """
@@ -244,11 +706,7 @@ class Kahi_openalex_sample(KahiBase):
         """
         # funders
         print("INFO: processing funders ")
-        pipeline = [
-            {"$match": {}},
-            {"$out": {"db": self.db_out.name, "coll": self.database_collection_funders}}
-        ]
-        self.db_in[self.database_collection_funders].aggregate(pipeline)
+        self.post_process_collection(self.database_collection_funders)
 
     def post_process_institutions(self):
         """
@@ -256,12 +714,7 @@ class Kahi_openalex_sample(KahiBase):
         """
         # institutions
         print("INFO: processing institutions ")
-        pipeline = [
-            {"$match": {}},
-            {"$out": {"db": self.db_out.name,
-                      "coll": self.database_collection_institutions}}
-        ]
-        self.db_in[self.database_collection_institutions].aggregate(pipeline)
+        self.post_process_collection(self.database_collection_institutions)
 
     def post_process_publishers(self):
         """
@@ -269,11 +722,7 @@ class Kahi_openalex_sample(KahiBase):
         """
         # publishers
         print("INFO: processing publishers ")
-        pipeline = [
-            {"$match": {}},
-            {"$out": {"db": self.db_out.name, "coll": self.database_collection_publishers}}
-        ]
-        self.db_in[self.database_collection_publishers].aggregate(pipeline)
+        self.post_process_collection(self.database_collection_publishers)
 
     def post_process_sources(self):
         """
@@ -281,23 +730,157 @@ class Kahi_openalex_sample(KahiBase):
         """
         # sources
         print("INFO: processing sources ")
-        pipeline = [
-            {"$match": {}},
-            {"$out": {"db": self.db_out.name, "coll": self.database_collection_sources}}
-        ]
-        self.db_in[self.database_collection_sources].aggregate(pipeline)
+        self.post_process_collection(self.database_collection_sources)
 
-    def run(self):
+    def run_stage(self, stage):
+        """
+        Method to run one post processing stage, measuring its wall time and catching its errors.
+        Required for parallel processing.
+
+        Parameters:
+        ----------
+        stage: method
+            post processing method to run.
+
+        Returns:
+        ----------
+        tuple
+            name of the stage, wall time in seconds and the exception raised (None if the stage finished).
+        """
+        start = time()
+        error = None
+        try:
+            stage()
+        except Exception as e:
+            print(f"ERROR: stage {stage.__name__} failed")
+            traceback.print_exc()
+            error = e
+        return stage.__name__, time() - start, error
+
+    def post_process(self):
+        """
+        Method to run the post processing stages concurrently on a pool of at most num_jobs threads.
+        The stages are independent, all of them run even if one fails,
+        the failed stages are reported and raised at the end.
+        """
+        stages = [self.post_process_authors,
+                  self.post_process_publishers,
+                  self.post_process_concepts,
+                  self.post_process_funders,
+                  self.post_process_institutions,
+                  self.post_process_sources]
+        results = Parallel(n_jobs=min(self.num_jobs, len(stages)), backend="threading")(
+            delayed(self.run_stage)(stage) for stage in stages)
+        for name, elapsed, error in results:
+            print(
+                f"INFO: stage {name} {'failed' if error else 'finished'} in {elapsed:.2f} seconds")
+        failed = [(name, error) for name, elapsed, error in results if error]
+        if failed:
+            print(
+                f"ERROR: post processing stages failed: {[name for name, error in failed]}")
+            raise Exception("Post processing stages failed: ", failed)
+
+    def async_selectors(self):
+        """
+        Returns the selectors of the workflow configuration for the asyncio engine,
+        the works projection is applied to the queries and pipelines.
+
+        Returns:
+        ----------
+        list
+            list of tuples (description, url, collection, query or pipeline, projection).
+        """
+        self.validate_selectors()
+        return [(description, self.database_in_url, collection,
+                 self.project_pipeline(query, self.projection) if isinstance(query, list) else query, self.projection)
+                for description, collection, query in self.selector_queries()]
+
+    def process_async(self):
+        """
+        Method to save in the output database the works of all the selectors with the asyncio engine (engine: async).
+        Every selector is an async producer and sink_jobs batch writers save the works with the bulk writer keys,
+        so the output is the same of the threading engine. id_first only applies to the threading engine.
+        """
+        engine = AsyncEngine(self.writer, self.database_out_url, self.compressors, source_jobs=self.num_jobs,
+                             sink_jobs=self.sink_jobs, queue_size=self.queue_size,
+                             cursor_batch_size=self.chunk_size, verbose=self.verbose)
+        engine.run(self.async_selectors())
+
+    def process_selectors(self):
+        """
+        Method to run all the selectors of the workflow configuration with the threading engine.
+        """
+        self.validate_selectors()
         self.process_authors()
         self.process_works()
         self.process_types()
         self.process_institutions()
         self.process_custom_queries()
         self.process_custom_pipelines()
-        self.post_process_authors()
-        self.post_process_publishers()
-        self.post_process_concepts()
-        self.post_process_funders()
-        self.post_process_institutions()
-        self.post_process_sources()
+
+    def process_refresh(self):
+        """
+        Method to refresh the sample in place (refresh: True) instead of building it again.
+        The selectors collect the ids of the works that match now (like the first phase of id_first),
+        the new works are saved, the works already saved are replaced only if their timestamp_field
+        changed since the last refresh, and the works that do not match anymore are removed.
+        """
+        state = self.db_out[self.state_collection]
+        since = None
+        if self.timestamp_field:
+            # taken before the selectors, so the works changed during the refresh are fetched again by the next one
+            timestamp = latest_timestamp(self.collection_in, self.timestamp_field, verbose=self.verbose)
+            since = get_refresh_mark(state, "openalex_sample", self.collection_in)
+        else:
+            print("WARNING: refresh without timestamp_field, all the works are fetched again")
+        self.collecting_ids = True
+        self.process_selectors()
+        self.collecting_ids = False
+        saved = self.writer.saved_ids()
+        new = self.ids - saved
+        kept = self.ids & saved
+        removed = saved - self.ids
+        if self.verbose > 0:
+            print(
+                f"INFO: Refreshing {len(self.ids)} works, {len(new)} new, {len(kept)} already saved and {len(removed)} removed")
+        self.process_ids(new)
+        self.process_ids(kept, {self.timestamp_field: {"$gt": since}} if since is not None else None)
+        self.writer.flush()
+        deleted = self.writer.delete(removed, self.chunk_size)
+        if self.verbose > 0:
+            print(
+                f"INFO: Removed {deleted} works from db {self.writer.collection.database.name} collection {self.writer.collection.name}")
+        if self.timestamp_field and timestamp is not None:
+            set_refresh_mark(state, "openalex_sample", self.collection_in, timestamp)
+
+    def run(self):
+        if not self.selector_queries():
+            # nothing is selected, the output is left as it is and no connection is opened
+            if self.verbose > 0:
+                print("INFO: Nothing selected in the workflow configuration")
+            return 0
+        if self.database_out_drop_database and not self.resume and not self.refresh:
+            self.client.drop_database(self.database_out_name)
+        self.process_indexes()
+        if self.checkpoints is not None:
+            self.checkpoints.start()
+        if self.seen is not None and (self.resume or not self.database_out_drop_database) and not self.refresh:
+            # the works saved by previous runs are skipped too
+            self.writer.warm()
+        if self.refresh:
+            self.process_refresh()
+        elif self.engine == "async":
+            self.process_async()
+        else:
+            # first phase of id_first, the selectors only collect the ids
+            self.collecting_ids = self.id_first
+            self.process_selectors()
+            if self.id_first:
+                self.collecting_ids = False
+                self.process_ids()
+        self.writer.flush()
+        if self.verbose > 0:
+            print(
+                f"INFO: Saved {self.writer.inserted} works in db {self.db_out.name} collection {self.collection_works_out.name}, skipped {self.writer.skipped} already saved")
+        self.post_process()
         return 0
@@ -80,7 +80,9 @@ def main():
         # Dependent packages (distributions)
         # put you packages here
         install_requires=[
-            'kahi'
+            'kahi',
+            'joblib',
+            'pymongo>=4.10'
         ],
     )
 
@@ -1,10 +1,32 @@
 from kahi_impactu_utils.Utils import doi_processor
 from kahi.KahiBase import KahiBase
-from pymongo import MongoClient
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
 from joblib import Parallel, delayed
+from pymongo import ASCENDING
+from threading import Lock
+from kahi_scholar_sample.Utils import AsyncEngine, BulkWriter, Checkpoints, SeenIds, chunks, drop_output_database, ensure_indexes, get_client, get_refresh_mark, latest_timestamp, partition_query, raw_key, set_refresh_mark, unindexed_queries
+from functools import lru_cache
 import re
 
 
+@lru_cache(maxsize=None)
+def normalize_doi(doi):
+    """
+    Returns the DOI as it is saved in the scholar database (without https://doi.org/),
+    or None if it is not a valid DOI. The results are memoized.
+
+    Parameters:
+    ----------
+    doi: str
+        DOI to normalize.
+    """
+    doi = doi_processor(doi)
+    if doi:
+        return re.sub(r"https://doi.org/", "", doi)
+    return None
+
+
 class Kahi_scholar_sample(KahiBase):
     """
     Class to process the Google scholar database and extract works samples based on different criteria.
@@ -14,6 +36,9 @@ class Kahi_scholar_sample(KahiBase):
 
     config = {}
 
+    # characters of the bibtex after the leading "@" kept by the types index
+    bibtex_head_size = 64
+
     def __init__(self, config):
         """
         Initialize the Kahi_scholar_sample plugin.
@@ -23,34 +48,504 @@ class Kahi_scholar_sample(KahiBase):
         self.database_out_name = self.config["scholar_sample"]['database_out']["database_name"]
         self.database_out_drop_database = self.config["scholar_sample"]['database_out']["drop_database"]
 
-        self.client = MongoClient(self.database_out_url)
+        self.num_jobs = self.config["scholar_sample"]["num_jobs"] if "num_jobs" in self.config["scholar_sample"] else 1
+        # wire compressors, ex: "zstd,snappy"
+        self.compressors = self.config["scholar_sample"]["compressors"] if "compressors" in self.config["scholar_sample"] else None
+        self.client = get_client(self.database_out_url, self.num_jobs, self.compressors)
         self.db_out = self.client[self.database_out_name]
 
-        self.num_jobs = self.config["scholar_sample"]["num_jobs"] if "num_jobs" in self.config["scholar_sample"] else 1
-        if self.database_out_drop_database:
-            self.client.drop_database(self.database_out_name)
+        # if True the selectors done by an interrupted run are skipped and the partial ones are resumed
+        self.resume = self.config["scholar_sample"]["resume"] if "resume" in self.config["scholar_sample"] else False
+        # if True the sample is updated in place with the works changed since the last refresh
+        self.refresh = self.config["scholar_sample"]["refresh"] if "refresh" in self.config["scholar_sample"] else False
+        self.timestamp_field = self.config["scholar_sample"]["timestamp_field"] if "timestamp_field" in self.config["scholar_sample"] else None
 
         self.database_in_url = self.config["scholar_sample"]['database_in']["database_url"]
         self.database_in_name = self.config["scholar_sample"]['database_in']["database_name"]
         self.collection_in_name = self.config["scholar_sample"]['database_in']["collection_name"]
-        self.client_in = MongoClient(self.database_in_url)
-        self.db_in = self.client_in[self.database_in_name]
+        self.client_in = get_client(self.database_in_url, self.num_jobs, self.compressors)
+        self.raw = self.config["scholar_sample"]["raw"] if "raw" in self.config["scholar_sample"] else False
+        if self.raw:
+            # works are copied as raw bson, without decoding and encoding them again
+            self.db_in = self.client_in.get_database(
+                self.database_in_name, codec_options=CodecOptions(document_class=RawBSONDocument))
+        else:
+            self.db_in = self.client_in[self.database_in_name]
         self.col_in = self.db_in[self.collection_in_name]
 
         self.verbose = self.config["scholar_sample"]["verbose"] if "verbose" in self.config["scholar_sample"] else 1
+        self.bulk_size = self.config["scholar_sample"]["bulk_size"] if "bulk_size" in self.config["scholar_sample"] else 1000
+        self.flush_interval = self.config["scholar_sample"]["flush_interval"] if "flush_interval" in self.config["scholar_sample"] else 10
+        self.parallel_scan = self.config["scholar_sample"]["parallel_scan"] if "parallel_scan" in self.config["scholar_sample"] else False
+        # collections with fewer documents are scanned with a single cursor, partitioning them costs an extra pass
+        self.parallel_scan_min_size = self.config["scholar_sample"]["parallel_scan_min_size"] if "parallel_scan_min_size" in self.config["scholar_sample"] else 100000
+        self.wait_indexes = self.config["scholar_sample"]["wait_indexes"] if "wait_indexes" in self.config["scholar_sample"] else True
+        self.chunk_size = self.config["scholar_sample"]["chunk_size"] if "chunk_size" in self.config["scholar_sample"] else 1000
+        # batch size of the cursors streamed from the server and maximum number of works in flight
+        self.cursor_batch_size = self.config["scholar_sample"]["cursor_batch_size"] if "cursor_batch_size" in self.config["scholar_sample"] else 1000
+        self.max_in_flight = self.config["scholar_sample"]["max_in_flight"] if "max_in_flight" in self.config["scholar_sample"] else 2 * self.num_jobs
+        # precomputed index of the google scholar profiles of the works
+        self.profile_index = self.config["scholar_sample"]["profile_index"] if "profile_index" in self.config["scholar_sample"] else False
+        # precomputed index of the start of the bibtex of the works
+        self.type_index = self.config["scholar_sample"]["type_index"] if "type_index" in self.config["scholar_sample"] else False
+        # if True the precomputed indexes are rebuilt from scratch instead of refreshed
+        self.rebuild_indexes = self.config["scholar_sample"]["rebuild_indexes"] if "rebuild_indexes" in self.config["scholar_sample"] else False
+        # ids already seen in the run, the duplicated works are skipped without a round trip to the server
+        self.seen_ids = self.config["scholar_sample"]["seen_ids"] if "seen_ids" in self.config["scholar_sample"] else True
+        # bits of the Bloom filter in front of the seen ids, 0 to disable it
+        self.bloom_size = self.config["scholar_sample"]["bloom_size"] if "bloom_size" in self.config["scholar_sample"] else 0
+        # number of ids expected in the sample, the seen ids are allocated once for them
+        self.seen_capacity = self.config["scholar_sample"]["seen_capacity"] if "seen_capacity" in self.config["scholar_sample"] else 0
+        self.seen = SeenIds(expected=self.seen_capacity, bloom_size=self.bloom_size) if self.seen_ids else None
+        self.writer = BulkWriter(self.db_out["stage"], ["cid"], batch_size=self.bulk_size,
+                                 flush_interval=self.flush_interval, verbose=self.verbose, seen=self.seen, replace=self.refresh)
+        # if True the selectors only collect the cids of the works, then every work is fetched once
+        self.id_first = self.config["scholar_sample"]["id_first"] if "id_first" in self.config["scholar_sample"] else False
+        self.collecting_ids = False
+        self.ids = set()
+        self.ids_lock = Lock()
+        # "threading" (joblib threads) or "async" (asyncio producers and batch writers)
+        self.engine = self.config["scholar_sample"]["engine"] if "engine" in self.config["scholar_sample"] else "threading"
+        if self.engine not in ["threading", "async"]:
+            print("ERROR: Invalid engine: ", self.engine)
+            raise Exception("Invalid engine: ", self.engine)
+        # concurrent bulk writes and maximum number of works waiting to be written in the async engine
+        self.sink_jobs = self.config["scholar_sample"]["sink_jobs"] if "sink_jobs" in self.config["scholar_sample"] else self.num_jobs
+        self.queue_size = self.config["scholar_sample"]["queue_size"] if "queue_size" in self.config["scholar_sample"] else 2 * self.bulk_size
+        # checkpoints of the selectors in the state collection of the output database, required by resume
+        self.checkpoint = self.config["scholar_sample"]["checkpoint"] if "checkpoint" in self.config["scholar_sample"] else False
+        self.checkpoint_size = self.config["scholar_sample"]["checkpoint_size"] if "checkpoint_size" in self.config["scholar_sample"] else 10 * self.bulk_size
+        self.state_collection = self.config["scholar_sample"]["state_collection"] if "state_collection" in self.config["scholar_sample"] else "sample_state"
+        self.checkpoints = Checkpoints(self.db_out[self.state_collection], "scholar_sample", resume=self.resume,
+                                       verbose=self.verbose) if self.checkpoint or self.resume else None
+        if self.engine == "async" and self.checkpoints is not None:
+            print("ERROR: checkpoint and resume are not supported by the async engine")
+            raise Exception("checkpoint and resume are not supported by the async engine")
+
+    def selector_projection(self, fields=None):
+        """
+        Returns the projection of the selector queries.
+        In the first phase of id_first only the cid (and the given fields) is returned,
+        so the selectors served by an index on the cid are covered, otherwise None (the whole works).
+
+        Parameters:
+        ----------
+        fields: list
+            additional fields required by the selector.
+        """
+        if self.collecting_ids:
+            projection = {field: 1 for field in ["cid"] + (fields or [])}
+            projection["_id"] = 0
+            return projection
+        return None
+
+    def selector_pipeline(self, pipeline):
+        """
+        Returns the pipeline of a selector, in the first phase of id_first
+        a $project stage is appended so only the cid of the works is returned.
+
+        Parameters:
+        ----------
+        pipeline: list
+            mongodb pipeline that returns works.
+        """
+        if self.collecting_ids:
+            return pipeline + [{"$project": self.selector_projection()}]
+        return pipeline
+
+    def process_partition(self, collection, query):
+        """
+        Method to save in the output database the works of one partition of a query.
+        Required for parallel processing.
+
+        Parameters:
+        ----------
+        collection: pymongo.collection.Collection
+            input collection.
+        query: dict
+            mongodb query of the partition.
+        """
+        for work in collection.find(query, self.selector_projection()):
+            self.process_one_work(work)
+
+    def process_query(self, collection, query):
+        """
+        Method to save in the output database all the works that match a query.
+        With parallel_scan the query is split in num_jobs _id range partitions that are scanned in parallel,
+        each one with its own cursor, otherwise the works of a single cursor are processed in parallel.
+        The collections with less than parallel_scan_min_size documents are not partitioned.
+        With checkpoints every partition has its own checkpoint and its own bulk writer,
+        so the flush of a checkpoint does not wait for the writes of the other partitions.
+
+        Parameters:
+        ----------
+        collection: pymongo.collection.Collection
+            input collection.
+        query: dict
+            mongodb query that returns works.
+        """
+        partitions = [query]
+        if self.parallel_scan and self.num_jobs > 1 and collection.estimated_document_count() >= self.parallel_scan_min_size:
+            partitions = partition_query(collection, query, self.num_jobs)
+        checkpointed = self.checkpoints is not None and not self.collecting_ids
+        if checkpointed and len(partitions) > 1:
+            # every partition is checkpointed as a selector, a resumed run finds the same partitions if the input did not change
+            writers = [self.writer.fork() for _ in partitions]
+            Parallel(n_jobs=self.num_jobs, backend="threading", verbose=10)(
+                delayed(self.process_checkpointed)(collection, partition, 1, writer) for partition, writer in zip(partitions, writers))
+            for writer in writers:
+                self.writer.join(writer)
+        elif checkpointed:
+            self.process_checkpointed(collection, query)
+        elif len(partitions) > 1:
+            Parallel(n_jobs=self.num_jobs, backend="threading", verbose=10)(
+                delayed(self.process_partition)(collection, partition) for partition in partitions)
+        else:
+            works = collection.find(query, self.selector_projection())
+            Parallel(n_jobs=self.num_jobs, backend="threading", verbose=10)(
+                delayed(self.process_one_work)(work) for work in works)
+
+    def process_cursor(self, works):
+        """
+        Method to save in the output database the works of a cursor while they are streamed from the server.
+        The works are processed in parallel with at most max_in_flight works dispatched at the same time,
+        so the cursor is never loaded in memory.
+
+        Parameters:
+        ----------
+        works: pymongo.cursor.Cursor or pymongo.command_cursor.CommandCursor
+            cursor that returns works.
+
+        Returns:
+        ----------
+        int
+            number of works streamed from the cursor.
+        """
+        count = 0
 
-    def process_one_work(self, work):
+        def counted():
+            # the generator is consumed only by the dispatching thread of joblib
+            nonlocal count
+            for work in works:
+                count += 1
+                yield work
+        Parallel(n_jobs=self.num_jobs, backend="threading", verbose=10, pre_dispatch=self.max_in_flight)(
+            delayed(self.process_one_work)(work) for work in counted())
+        return count
+
+    def process_checkpointed(self, collection, query, n_jobs=None, writer=None):
+        """
+        Method to save in the output database all the works that match a query recording checkpoints.
+        The works are read sorted by _id (after the last checkpoint of the selector in a resumed run)
+        in chunks of checkpoint_size, every chunk is processed in parallel and written
+        before its last _id is saved as the checkpoint of the selector.
+
+        Parameters:
+        ----------
+        collection: pymongo.collection.Collection
+            input collection.
+        query: dict
+            mongodb query that returns works.
+        n_jobs: int
+            threads processing every chunk, by default num_jobs (1 for the partitions of parallel_scan).
+        writer: BulkWriter
+            writer of the works, by default self.writer (every partition of parallel_scan has its own).
+        """
+        n_jobs = self.num_jobs if n_jobs is None else n_jobs
+        writer = self.writer if writer is None else writer
+        selector = self.checkpoints.selector_id(collection, query)
+        if self.checkpoints.is_done(selector):
+            if self.verbose > 0:
+                print(f"INFO: Skipping {selector}, done in a previous run")
+            return
+        works = collection.find(self.checkpoints.resume_query(selector, query), None,
+                                allow_disk_use=True).sort("_id", ASCENDING)
+        for chunk in chunks(works, self.checkpoint_size):
+            Parallel(n_jobs=n_jobs, backend="threading")(
+                delayed(self.process_one_work)(work, writer) for work in chunk)
+            writer.flush()
+            last = chunk[-1]
+            self.checkpoints.save(selector, raw_key(last.raw, ["_id"])["_id"] if isinstance(last, RawBSONDocument) else last["_id"])
+        self.checkpoints.save(selector, done=True)
+
+    def pipeline_done(self, collection, pipeline):
+        """
+        Checks if a pipeline (or a streamed query) selector was finished by a previous run,
+        they can not be resumed from a checkpoint, they are only marked as done.
+
+        Parameters:
+        ----------
+        collection: pymongo.collection.Collection
+            input collection.
+        pipeline: list or dict
+            mongodb pipeline or query of the selector.
+        """
+        if self.checkpoints is None or self.collecting_ids:
+            return False
+        selector = self.checkpoints.selector_id(collection, pipeline)
+        if self.checkpoints.is_done(selector):
+            if self.verbose > 0:
+                print(f"INFO: Skipping {selector}, done in a previous run")
+            return True
+        return False
+
+    def finish_pipeline(self, collection, pipeline):
+        """
+        Marks a pipeline (or a streamed query) selector as done, after writing all its works.
+
+        Parameters:
+        ----------
+        collection: pymongo.collection.Collection
+            input collection.
+        pipeline: list or dict
+            mongodb pipeline or query of the selector.
+        """
+        if self.checkpoints is not None and not self.collecting_ids:
+            self.writer.flush()
+            self.checkpoints.save(self.checkpoints.selector_id(collection, pipeline), done=True)
+
+    def process_one_work(self, work, writer=None):
         """
         Method to process one work and save it in the output database.
         Required for parallel processing.
+        The work is buffered in the bulk writer, works already saved are skipped by the writer.
+        In the first phase of id_first only the cid of the work is collected.
         """
-        work_id = {"cid": work["cid"]}
-        if self.db_out["stage"].count_documents(work_id) == 0:
-            self.db_out["stage"].insert_one(work)
+        if self.collecting_ids:
+            key = self.writer.key(work)["cid"]
+            with self.ids_lock:
+                self.ids.add(key)
         else:
-            if self.verbose > 2:
+            (self.writer if writer is None else writer).add(work)
+
+    def process_ids_chunk(self, ids, query=None):
+        """
+        Method to save a chunk of the works collected by id_first (or refresh), resolved with a single $in query.
+        Required for parallel processing.
+
+        Parameters:
+        ----------
+        ids: list
+            list of cids.
+        query: dict
+            additional filter of the works, None to save all of them.
+        """
+        query = {"$and": [{"cid": {"$in": ids}}, query]} if query else {"cid": {"$in": ids}}
+        for work in self.col_in.find(query):
+            self.writer.add(work)
+
+    def process_ids(self, ids=None, query=None):
+        """
+        Second phase of id_first (and of refresh), the unique works collected by all the selectors
+        are fetched once in chunks of chunk_size cids with $in queries that run in parallel.
+
+        Parameters:
+        ----------
+        ids: set
+            cids of the works to fetch, by default the cids collected by the selectors.
+        query: dict
+            additional filter of the works, None to fetch all of them.
+        """
+        ids = self.ids if ids is None else ids
+        if self.verbose > 0:
+            print(
+                f"INFO: Fetching {len(ids)} works from db {self.db_in.name} collection {self.col_in.name}")
+        ensure_indexes(self.col_in, ["cid"], verbose=self.verbose)
+        Parallel(n_jobs=self.num_jobs, backend="threading", verbose=10)(
+            delayed(self.process_ids_chunk)(chunk, query) for chunk in chunks(list(ids), self.chunk_size))
+
+    def refresh_index_collection(self, index, stages, source_id="_id"):
+        """
+        Method to build or refresh a precomputed index collection of the input collection.
+        Only the works inserted after the last refresh (greater _id) are indexed,
+        and with timestamp_field also the works edited after the last refresh (ex: new profiles or bibtex),
+        whose entries are removed and indexed again, the mark is saved in the state collection of the output database.
+        The index is rebuilt if its last work is not in the input collection anymore (ex: reloaded),
+        or if after the refresh an index with an entry per work (source_id "_id") and the input collection have different sizes.
+        Without timestamp_field the works edited in place are only indexed again with rebuild_indexes,
+        that drops the index collection and builds it from scratch.
+
+        Parameters:
+        ----------
+        index: pymongo.collection.Collection
+            index collection, in the input database.
+        stages: list
+            pipeline stages that compute the index documents from the works,
+            the _id of the work has to be kept in the source_id field.
+        source_id: str
+            field of the index documents with the _id of the work.
+        """
+        state = self.db_out[self.state_collection]
+        timestamp = None
+        since = None
+        if self.timestamp_field:
+            # taken before the merge, so the works edited during it are indexed again by the next refresh
+            timestamp = latest_timestamp(self.col_in, self.timestamp_field, verbose=self.verbose)
+            since = get_refresh_mark(state, "scholar_sample", index)
+        for rebuild in [self.rebuild_indexes, True]:
+            last = index.find_one({}, {source_id: 1}, sort=[(source_id, -1)])
+            removed = last is not None and self.col_in.find_one({"_id": last[source_id]}, {"_id": 1}) is None
+            # an index without mark can have stale entries, it is rebuilt once
+            if rebuild or (self.timestamp_field and since is None) or removed:
+                index.drop()
+                last = None
+            ensure_indexes(index, [source_id], verbose=self.verbose)
+            if self.verbose > 0:
                 print(
-                    f"INFO: Work {work_id} already exists in db {self.db_out.name} collection {self.db_out['stage'].name}")
+                    f"INFO: {'Refreshing' if last else 'Building'} index db {self.db_in.name} collection {index.name}")
+            match = {"_id": {"$gt": last[source_id]}} if last else {}
+            if last and since is not None:
+                changed = {self.timestamp_field: {"$gt": since}}
+                # the entries of the edited works are removed, the merge adds their current entries
+                works = self.col_in.find(changed, {"_id": 1}, batch_size=self.chunk_size)
+                for chunk in chunks(works, self.chunk_size):
+                    index.delete_many({source_id: {"$in": [work["_id"] for work in chunk]}})
+                match = {"$or": [match, changed]}
+            pipeline = [{"$match": match}] + stages + [
+                {"$merge": {"into": index.name, "on": "_id", "whenMatched": "replace", "whenNotMatched": "insert"}}]
+            self.col_in.aggregate(pipeline, allowDiskUse=True)
+            if source_id != "_id" or index.estimated_document_count() == self.col_in.estimated_document_count():
+                break
+        if timestamp is not None:
+            set_refresh_mark(state, "scholar_sample", index, timestamp)
+
+    def process_profile_index(self):
+        """
+        Method to build or refresh the inverted index of the google scholar profiles,
+        the collection <collection_name>_profiles in the input database with a document
+        per work and profile with the profile_id, the cid and the work_id (_id of the work).
+        """
+        index = self.db_in[self.col_in.name + "_profiles"]
+        stages = [
+            {"$project": {"cid": 1, "profiles": {"$objectToArray": {"$ifNull": ["$profiles", {}]}}}},
+            {"$unwind": "$profiles"},
+            {"$project": {"_id": {"work_id": "$_id", "key": "$profiles.k"},
+                          "work_id": "$_id", "cid": 1, "profile_id": "$profiles.v"}}
+        ]
+        self.refresh_index_collection(index, stages, "work_id")
+        ensure_indexes(index, ["profile_id"], verbose=self.verbose)
+        return index
+
+    def process_type_index(self):
+        """
+        Method to build or refresh the index of the bibtex entry types,
+        the collection <collection_name>_bibtex_heads in the input database with the _id of every work
+        and the bibtex_head_size characters that follow the leading "@" of its bibtex (ex: "Article{key," for "@Article{key,...").
+        The types are matched on the index with the same case insensitive regex used on the bibtex.
+        """
+        index = self.db_in[self.col_in.name + "_bibtex_heads"]
+        bibtex = {"$cond": [{"$eq": [{"$type": "$bibtex"}, "string"]}, "$bibtex", ""]}
+        stages = [
+            {"$project": {"bibtex_head": {"$cond": [
+                {"$eq": [{"$substrCP": [bibtex, 0, 1]}, "@"]},
+                {"$substrCP": [bibtex, 1, self.bibtex_head_size]}, None]}}}
+        ]
+        self.refresh_index_collection(index, stages)
+        # the types are resolved with covered scans of this index
+        ensure_indexes(index, [["bibtex_head", "_id"]], verbose=self.verbose)
+        return index
+
+    def type_query(self, type_, index=False):
+        """
+        Returns the query of a bibtex entry type, a case insensitive regex on the start of the bibtex.
+
+        Parameters:
+        ----------
+        type_: str
+            bibtex entry type from the workflow configuration, ex: "article".
+        index: bool
+            if True the query is for the types index (bibtex_head field) instead of the works.
+        """
+        if index:
+            return {"bibtex_head": {"$regex": f"^{type_}*", "$options": "i"}}
+        return {"bibtex": {"$regex": f"^@{type_}*", "$options": "i"}}
+
+    def types_index_query(self, types):
+        """
+        Returns the query of the types index that matches any of the given bibtex entry types.
+
+        Parameters:
+        ----------
+        types: list
+            bibtex entry types from the workflow configuration.
+        """
+        return {"$or": [self.type_query(type_, index=True) for type_ in types]}
+
+    def process_works_chunk(self, work_ids):
+        """
+        Method to save a chunk of works given their _id, resolved with a single $in query.
+        Required for parallel processing.
+
+        Parameters:
+        ----------
+        work_ids: list
+            list of _id of the works.
+        """
+        for work in self.col_in.find({"_id": {"$in": work_ids}}, self.selector_projection()):
+            self.process_one_work(work)
+
+    def author_pipeline(self, author_ids):
+        """
+        Returns the pipeline that matches the works with any of the given google scholar ids in the profiles.
+
+        Parameters:
+        ----------
+        author_ids: list
+            google scholar profile ids.
+        """
+        return [
+            {'$match': {
+                '$expr': {'$gt': [{'$size': {'$filter': {'input': {'$objectToArray': '$profiles'}, 'as': 'profile', 'cond': {'$in': ['$$profile.v', author_ids]}}}}, 0]}}}]
+
+    def selector_queries(self):
+        """
+        Returns the queries and pipelines of the selectors in the workflow configuration.
+
+        Returns:
+        ----------
+        list
+            list of tuples (description, collection, query or pipeline).
+        """
+        config = self.config["scholar_sample"]
+        queries = []
+        if "authors" in config and config["authors"]:
+            if self.profile_index:
+                queries.append(("authors", self.db_in[self.col_in.name + "_profiles"],
+                                {"profile_id": {"$in": config["authors"]}}))
+            else:
+                queries.append(("authors", self.col_in, self.author_pipeline(config["authors"])))
+        if "products" in config and config["products"]:
+            cids = [product["cid"] for product in config["products"] if "cid" in product and product["cid"]]
+            if cids:
+                queries.append(("products", self.col_in, {"cid": {"$in": cids}}))
+        if "types" in config and config["types"] and self.type_index:
+            queries.append(("types", self.db_in[self.col_in.name + "_bibtex_heads"], self.types_index_query(config["types"])))
+        elif "types" in config and config["types"]:
+            queries += [(f"type {type_}", self.col_in, self.type_query(type_)) for type_ in config["types"]]
+        if "custom_queries" in config and config["custom_queries"]:
+            queries += [(f"custom query {query}", self.col_in, query) for query in config["custom_queries"]]
+        if "custom_pipelines" in config and config["custom_pipelines"]:
+            queries += [(f"custom pipeline {pipeline}", self.col_in, pipeline)
+                        for pipeline in config["custom_pipelines"]]
+        return queries
+
+    def process_indexes(self):
+        """
+        Method to create the indexes of the indeces tag of database_in and database_out
+        in the workflow configuration, the indexes that already exist are skipped.
+        With wait_indexes False the indexes are built in background.
+        The selector queries that are still not served by an index are reported.
+        """
+        threads = [ensure_indexes(self.col_in, self.config["scholar_sample"]["database_in"]["indeces"]
+                                  if "indeces" in self.config["scholar_sample"]["database_in"] else [],
+                                  wait=self.wait_indexes, verbose=self.verbose),
+                   ensure_indexes(self.db_out["stage"], self.config["scholar_sample"]["database_out"]["indeces"]
+                                  if "indeces" in self.config["scholar_sample"]["database_out"] else [],
+                                  wait=self.wait_indexes, verbose=self.verbose)]
+        if self.wait_indexes or not any(threads):
+            for description in unindexed_queries(self.selector_queries()):
+                print(
+                    f"WARNING: {description} is not served by an index in db {self.db_in.name} collection {self.col_in.name}")
 
     def process_authors(self):
         """
@@ -61,53 +556,111 @@ class Kahi_scholar_sample(KahiBase):
             author_ids = self.config["scholar_sample"]["authors"]
             if self.verbose > 0:
                 print("INFO: Processing authors: ", len(author_ids))
-            for author_id in author_ids:
-                pipeline = [
-                    {'$match': {
-                        '$expr': {'$gt': [{'$size': {'$filter': {'input': {'$objectToArray': '$profiles'}, 'as': 'profile', 'cond': {'$eq': ['$$profile.v', author_id]}}}}, 0]}}}]
-                works = list(self.col_in.aggregate(pipeline, allowDiskUse=True))
+            if self.profile_index:
+                index = self.process_profile_index()
+                work_ids = {}
+                for profile in index.find({"profile_id": {"$in": author_ids}}, {"_id": 0, "work_id": 1, "profile_id": 1}):
+                    work_ids.setdefault(profile["profile_id"], set()).add(profile["work_id"])
                 if self.verbose > 0:
-                    print(
-                        f"INFO: Found {len(works)} works in db {self.db_in.name} collection {self.col_in.name} for id {author_id}")
+                    for author_id in author_ids:
+                        print(
+                            f"INFO: Found {len(work_ids.get(author_id, []))} works in db {self.db_in.name} collection {self.col_in.name} for id {author_id}")
+                work_ids = set(work_id for ids in work_ids.values() for work_id in ids)
                 Parallel(n_jobs=self.num_jobs, backend="threading", verbose=10)(
-                    delayed(self.process_one_work)(work) for work in works)
+                    delayed(self.process_works_chunk)(chunk) for chunk in chunks(work_ids, self.chunk_size))
+            else:
+                # all the authors are matched in a single scan of the collection
+                pipeline = self.author_pipeline(author_ids)
+                if self.pipeline_done(self.col_in, pipeline):
+                    return
+                works = self.col_in.aggregate(self.selector_pipeline(pipeline), allowDiskUse=True, batchSize=self.cursor_batch_size)
+                count = self.process_cursor(works)
+                self.finish_pipeline(self.col_in, pipeline)
+                if self.verbose > 0:
+                    print(
+                        f"INFO: Found {count} works in db {self.db_in.name} collection {self.col_in.name} for ids {author_ids}")
+
+    def process_products_chunk(self, field, product_ids):
+        """
+        Method to save a chunk of works given their cid or doi, resolved with a single $in query.
+        Required for parallel processing.
+
+        Parameters:
+        ----------
+        field: str
+            field of the ids, "cid" or "doi".
+        product_ids: list
+            list of cids or dois.
+
+        Returns:
+        ----------
+        list
+            ids not found in the input database.
+        """
+        found = set()
+        for work in self.col_in.find({field: {"$in": product_ids}}, self.selector_projection([field])):
+            if isinstance(work, RawBSONDocument):
+                found.add(raw_key(work.raw, [field]).get(field))
+            else:
+                found.add(work.get(field))
+            self.process_one_work(work)
+        return [product_id for product_id in product_ids if product_id not in found]
 
     def process_products(self):
         """
         process products given the cid or DOI in the workflow configuration.
+        The DOIs are normalized once, the cids and DOIs are resolved in chunks of chunk_size
+        with $in queries that run in parallel and the ids not found are reported at the end.
         """
         if "products" in self.config["scholar_sample"] and self.config["scholar_sample"]["products"]:
-            product_ids = []
-            for product in self.config["scholar_sample"]["products"]:
-                if "cid" in product and product["cid"]:
-                    product_ids.append(product["cid"])
-                elif "doi" in product and product["doi"]:
-                    doi = doi_processor(product["doi"])
-                    if doi:
-                        doi = re.sub(r"https://doi.org/", "", doi)
-                        product_ids.append(doi)
-            for product_id in product_ids:
-                work = self.col_in.find_one({"cid": product_id})
-                if not work:
-                    work = self.col_in.find_one({"doi": product_id})
-                if work:
-                    if self.verbose > 0:
-                        print(
-                            f"INFO: work found in db {self.db_in.name} collection {self.col_in.name} for id {product_id}")
-                    self.db_out["stage"].insert_one(work)
+            products = self.config["scholar_sample"]["products"]
+            cids = [product["cid"] for product in products if "cid" in product and product["cid"]]
+            dois = [product["doi"] for product in products
+                    if not ("cid" in product and product["cid"]) and "doi" in product and product["doi"]]
+            normalized = [normalize_doi(doi) for doi in dict.fromkeys(dois)]
+            invalid = [doi for doi, normalized_doi in zip(dict.fromkeys(dois), normalized) if not normalized_doi]
+            product_ids = [("cid", chunk) for chunk in chunks(dict.fromkeys(cids), self.chunk_size)]
+            product_ids += [("doi", chunk) for chunk in chunks(dict.fromkeys(doi for doi in normalized if doi), self.chunk_size)]
+            if self.verbose > 0:
+                print(f"INFO: Processing products: {len(cids)} cids and {len(dois)} dois")
+            missing = Parallel(n_jobs=self.num_jobs, backend="threading", verbose=10)(
+                delayed(self.process_products_chunk)(field, chunk) for field, chunk in product_ids)
+            self.missing_products = invalid + [product_id for chunk in missing for product_id in chunk]
+            if self.missing_products:
+                print(
+                    f"WARNING: {len(self.missing_products)} of {len(cids) + len(dois)} products not found in db {self.db_in.name} collection {self.col_in.name}")
+                if self.verbose > 1:
+                    print(f"WARNING: Products not found or invalid: {self.missing_products}")
 
     def process_types(self):
         """
         Process works types given the in the workflow configuration.
+        Every type is matched with a case insensitive regex on the start of the bibtex,
+        with type_index the works of all the types are resolved with a single query on the precomputed index.
         """
         if "types" in self.config["scholar_sample"] and self.config["scholar_sample"]["types"]:
-            for type_ in self.config["scholar_sample"]["types"]:
-                works = list(self.col_in.find({"bibtex": {"$regex": f"^@{type_}*", "$options": "i"}}))
-                if len(works) > 0:
-                    if self.verbose > 0:
-                        print("INFO: Processing {} works of type: {}".format(len(works), type_))
-                    Parallel(n_jobs=self.num_jobs, backend="threading", verbose=10)(
-                        delayed(self.process_one_work)(work) for work in works)
+            if self.type_index:
+                index = self.process_type_index()
+                types = self.config["scholar_sample"]["types"]
+                if self.verbose > 0:
+                    for type_ in types:
+                        count = index.count_documents(self.type_query(type_, index=True))
+                        print("INFO: Processing {} works of type: {}".format(count, type_))
+                work_ids = (work["_id"] for work in index.find(
+                    self.types_index_query(types), {"_id": 1}, batch_size=self.chunk_size))
+                Parallel(n_jobs=self.num_jobs, backend="threading", verbose=10)(
+                    delayed(self.process_works_chunk)(chunk) for chunk in chunks(work_ids, self.chunk_size))
+            else:
+                for type_ in self.config["scholar_sample"]["types"]:
+                    query = self.type_query(type_)
+                    if self.pipeline_done(self.col_in, query):
+                        continue
+                    works = self.col_in.find(query, self.selector_projection(), batch_size=self.cursor_batch_size)
+                    count = self.process_cursor(works)
+                    self.finish_pipeline(self.col_in, query)
+                    if count > 0:
+                        if self.verbose > 0:
+                            print("INFO: Processed {} works of type: {}".format(count, type_))
 
     def process_custom_queries(self):
         """
@@ -121,9 +674,7 @@ class Kahi_scholar_sample(KahiBase):
                 if self.verbose > 0:
                     print(
                         f"INFO: Found {self.col_in.count_documents(query)} in db {self.db_in.name} collection {self.col_in.name} for query {query}")
-                works = self.col_in.find(query)
-                Parallel(n_jobs=self.num_jobs, backend="threading", verbose=10)(
-                    delayed(self.process_one_work)(work) for work in works)
+                self.process_query(self.col_in, query)
 
     def process_custom_pipelines(self):
         """
@@ -134,17 +685,150 @@ class Kahi_scholar_sample(KahiBase):
             if self.verbose > 0:
                 print("INFO: Processing custom pipelines: ", len(pipelines))
             for pipeline in pipelines:
-                works = list(self.col_in.aggregate(pipeline))
+                if self.pipeline_done(self.col_in, pipeline):
+                    continue
+                works = self.col_in.aggregate(self.selector_pipeline(pipeline), allowDiskUse=True, batchSize=self.cursor_batch_size)
+                count = self.process_cursor(works)
+                self.finish_pipeline(self.col_in, pipeline)
                 if self.verbose > 0:
                     print(
-                        f"INFO: Found {len(works)} in db {self.db_in.name} collection {self.col_in.name} for pipeline {pipeline}")
-                Parallel(n_jobs=self.num_jobs, backend="threading", verbose=10)(
-                    delayed(self.process_one_work)(work) for work in works)
+                        f"INFO: Found {count} in db {self.db_in.name} collection {self.col_in.name} for pipeline {pipeline}")
 
-    def run(self):
+    def async_selectors(self):
+        """
+        Returns the selectors of the workflow configuration for the asyncio engine.
+        The authors with profile_index and the types with type_index are joined from the
+        precomputed indexes like the threading engine, so the selectors return the works.
+
+        Returns:
+        ----------
+        list
+            list of tuples (description, url, collection, query or pipeline, projection).
+        """
+        config = self.config["scholar_sample"]
+        url = self.database_in_url
+        selectors = []
+        if "authors" in config and config["authors"] and self.profile_index:
+            index = self.process_profile_index()
+            pipeline = [
+                {"$match": {"profile_id": {"$in": config["authors"]}}},
+                {"$group": {"_id": "$work_id"}},
+                {"$lookup": {"from": self.col_in.name, "localField": "_id", "foreignField": "_id", "as": "work"}},
+                {"$unwind": "$work"},
+                {"$replaceRoot": {"newRoot": "$work"}}
+            ]
+            selectors.append(("authors", url, index, pipeline, None))
+        elif "authors" in config and config["authors"]:
+            selectors.append(("authors", url, self.col_in, self.author_pipeline(config["authors"]), None))
+        if "products" in config and config["products"]:
+            cids = [product["cid"] for product in config["products"] if "cid" in product and product["cid"]]
+            dois = [normalize_doi(product["doi"]) for product in config["products"]
+                    if not ("cid" in product and product["cid"]) and "doi" in product and product["doi"]]
+            if cids:
+                selectors.append(("products cid", url, self.col_in, {"cid": {"$in": cids}}, None))
+            if any(dois):
+                selectors.append(("products doi", url, self.col_in, {"doi": {"$in": [doi for doi in dois if doi]}}, None))
+        if "types" in config and config["types"] and self.type_index:
+            index = self.process_type_index()
+            pipeline = [
+                {"$match": self.types_index_query(config["types"])},
+                {"$lookup": {"from": self.col_in.name, "localField": "_id", "foreignField": "_id", "as": "work"}},
+                {"$unwind": "$work"},
+                {"$replaceRoot": {"newRoot": "$work"}}
+            ]
+            selectors.append(("types", url, index, pipeline, None))
+        elif "types" in config and config["types"]:
+            selectors += [(f"type {type_}", url, self.col_in, self.type_query(type_), None) for type_ in config["types"]]
+        if "custom_queries" in config and config["custom_queries"]:
+            selectors += [(f"custom query {query}", url, self.col_in, query, None) for query in config["custom_queries"]]
+        if "custom_pipelines" in config and config["custom_pipelines"]:
+            selectors += [(f"custom pipeline {pipeline}", url, self.col_in, pipeline, None)
+                          for pipeline in config["custom_pipelines"]]
+        return selectors
+
+    def process_async(self):
+        """
+        Method to save in the output database the works of all the selectors with the asyncio engine (engine: async).
+        Every selector is an async producer and sink_jobs batch writers save the works with the bulk writer keys,
+        so the output is the same of the threading engine. id_first only applies to the threading engine.
+        """
+        engine = AsyncEngine(self.writer, self.database_out_url, self.compressors, source_jobs=self.num_jobs,
+                             sink_jobs=self.sink_jobs, queue_size=self.queue_size,
+                             cursor_batch_size=self.cursor_batch_size, verbose=self.verbose)
+        engine.run(self.async_selectors())
+
+    def process_selectors(self):
+        """
+        Method to run all the selectors of the workflow configuration with the threading engine.
+        """
         self.process_authors()
         self.process_products()
         self.process_types()
         self.process_custom_queries()
         self.process_custom_pipelines()
+
+    def process_refresh(self):
+        """
+        Method to refresh the sample in place (refresh: True) instead of building it again.
+        The selectors collect the ids of the works that match now (like the first phase of id_first),
+        the new works are saved, the works already saved are replaced only if their timestamp_field
+        changed since the last refresh, and the works that do not match anymore are removed.
+        """
+        state = self.db_out[self.state_collection]
+        since = None
+        if self.timestamp_field:
+            # taken before the selectors, so the works changed during the refresh are fetched again by the next one
+            timestamp = latest_timestamp(self.col_in, self.timestamp_field, verbose=self.verbose)
+            since = get_refresh_mark(state, "scholar_sample", self.col_in)
+        else:
+            print("WARNING: refresh without timestamp_field, all the works are fetched again")
+        self.collecting_ids = True
+        self.process_selectors()
+        self.collecting_ids = False
+        saved = self.writer.saved_ids()
+        new = self.ids - saved
+        kept = self.ids & saved
+        removed = saved - self.ids
+        if self.verbose > 0:
+            print(
+                f"INFO: Refreshing {len(self.ids)} works, {len(new)} new, {len(kept)} already saved and {len(removed)} removed")
+        self.process_ids(new)
+        self.process_ids(kept, {self.timestamp_field: {"$gt": since}} if since is not None else None)
+        self.writer.flush()
+        deleted = self.writer.delete(removed, self.chunk_size)
+        if self.verbose > 0:
+            print(
+                f"INFO: Removed {deleted} works from db {self.writer.collection.database.name} collection {self.writer.collection.name}")
+        if self.timestamp_field and timestamp is not None:
+            set_refresh_mark(state, "scholar_sample", self.col_in, timestamp)
+
+    def run(self):
+        if not self.selector_queries():
+            # nothing is selected, the output is left as it is and no connection is opened
+            if self.verbose > 0:
+                print("INFO: Nothing selected in the workflow configuration")
+            return 0
+        if self.database_out_drop_database and not self.resume and not self.refresh:
+            drop_output_database(self.client, self.database_out_name, self.state_collection)
+        self.process_indexes()
+        if self.checkpoints is not None:
+            self.checkpoints.start()
+        if self.seen is not None and (self.resume or not self.database_out_drop_database) and not self.refresh:
+            # the works saved by previous runs are skipped too
+            self.writer.warm()
+        if self.refresh:
+            self.process_refresh()
+        elif self.engine == "async":
+            self.process_async()
+        else:
+            # first phase of id_first, the selectors only collect the cids
+            self.collecting_ids = self.id_first
+            self.process_selectors()
+            if self.id_first:
+                self.collecting_ids = False
+                self.process_ids()
+        self.writer.flush()
+        if self.verbose > 0:
+            print(
+                f"INFO: Saved {self.writer.inserted} works in db {self.db_out.name} collection {self.db_out['stage'].name}, skipped {self.writer.skipped} already saved")
         return 0
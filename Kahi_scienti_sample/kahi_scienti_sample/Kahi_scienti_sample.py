@@ -1,6 +1,10 @@
 from kahi.KahiBase import KahiBase
-from pymongo import MongoClient
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
 from joblib import Parallel, delayed
+from pymongo import ASCENDING
+from threading import Lock
+from kahi_scienti_sample.Utils import AsyncEngine, BulkWriter, Checkpoints, SeenIds, chunks, drop_output_database, ensure_indexes, get_client, get_refresh_mark, latest_timestamp, partition_query, raw_key, set_refresh_mark, unindexed_queries
 
 
 class Kahi_scienti_sample(KahiBase):
@@ -23,53 +27,388 @@ class Kahi_scienti_sample(KahiBase):
         self.database_out_collection = self.config["scienti_sample"]['database_out']["collection_name"]
         self.database_out_drop_database = self.config["scienti_sample"]['database_out']["drop_database"]
 
-        self.client = MongoClient(self.database_out_url)
+        self.num_jobs = self.config["scienti_sample"]["num_jobs"] if "num_jobs" in self.config["scienti_sample"] else 1
+        # wire compressors, ex: "zstd,snappy"
+        self.compressors = self.config["scienti_sample"]["compressors"] if "compressors" in self.config["scienti_sample"] else None
+        self.client = get_client(self.database_out_url, self.num_jobs, self.compressors)
         self.db = self.client[self.database_out_name]
         self.collection = self.db[self.database_out_collection]
 
-        self.num_jobs = self.config["scienti_sample"]["num_jobs"] if "num_jobs" in self.config["scienti_sample"] else 1
-        if self.database_out_drop_database:
-            self.client.drop_database(self.database_out_name)
+        # if True the selectors done by an interrupted run are skipped and the partial ones are resumed
+        self.resume = self.config["scienti_sample"]["resume"] if "resume" in self.config["scienti_sample"] else False
+        # if True the sample is updated in place with the works changed since the last refresh
+        self.refresh = self.config["scienti_sample"]["refresh"] if "refresh" in self.config["scienti_sample"] else False
+        self.timestamp_field = self.config["scienti_sample"]["timestamp_field"] if "timestamp_field" in self.config["scienti_sample"] else None
         self.dbs_in = []
+        self.raw = self.config["scienti_sample"]["raw"] if "raw" in self.config["scienti_sample"] else False
 
         for db in self.config["scienti_sample"]['databases']:
-            client_in = MongoClient(db["database_url"])
-            db_in = client_in[db["database_name"]]
+            client_in = get_client(db["database_url"], self.num_jobs, self.compressors)
+            if self.raw:
+                # works are copied as raw bson, without decoding and encoding them again
+                db_in = client_in.get_database(
+                    db["database_name"], codec_options=CodecOptions(document_class=RawBSONDocument))
+            else:
+                db_in = client_in[db["database_name"]]
             collection_in = db_in[db["collection_name"]]
 
             self.dbs_in.append(
-                {"client": client_in, "db": db_in, "collection": collection_in})
+                {"client": client_in, "url": db["database_url"], "db": db_in, "collection": collection_in,
+                 "indeces": db["indeces"] if "indeces" in db else []})
         self.verbose = self.config["scienti_sample"]["verbose"] if "verbose" in self.config["scienti_sample"] else 1
+        self.bulk_size = self.config["scienti_sample"]["bulk_size"] if "bulk_size" in self.config["scienti_sample"] else 1000
+        self.flush_interval = self.config["scienti_sample"]["flush_interval"] if "flush_interval" in self.config["scienti_sample"] else 10
+        self.parallel_scan = self.config["scienti_sample"]["parallel_scan"] if "parallel_scan" in self.config["scienti_sample"] else False
+        # collections with fewer documents are scanned with a single cursor, partitioning them costs an extra pass
+        self.parallel_scan_min_size = self.config["scienti_sample"]["parallel_scan_min_size"] if "parallel_scan_min_size" in self.config["scienti_sample"] else 100000
+        self.wait_indexes = self.config["scienti_sample"]["wait_indexes"] if "wait_indexes" in self.config["scienti_sample"] else True
+        # threads per input collection, all the input collections are processed concurrently
+        self.source_jobs = self.config["scienti_sample"]["source_jobs"] if "source_jobs" in self.config["scienti_sample"] else self.num_jobs
+        self.chunk_size = self.config["scienti_sample"]["chunk_size"] if "chunk_size" in self.config["scienti_sample"] else 1000
+        # batch size of the cursors streamed from the server and maximum number of works in flight
+        self.cursor_batch_size = self.config["scienti_sample"]["cursor_batch_size"] if "cursor_batch_size" in self.config["scienti_sample"] else 1000
+        self.max_in_flight = self.config["scienti_sample"]["max_in_flight"] if "max_in_flight" in self.config["scienti_sample"] else 2 * self.source_jobs
+        # precomputed index of the product types of every input collection
+        self.type_index = self.config["scienti_sample"]["type_index"] if "type_index" in self.config["scienti_sample"] else False
+        # if True the precomputed indexes are rebuilt from scratch instead of refreshed
+        self.rebuild_indexes = self.config["scienti_sample"]["rebuild_indexes"] if "rebuild_indexes" in self.config["scienti_sample"] else False
+        # ids already seen in the run, the duplicated works are skipped without a round trip to the server
+        self.seen_ids = self.config["scienti_sample"]["seen_ids"] if "seen_ids" in self.config["scienti_sample"] else True
+        # bits of the Bloom filter in front of the seen ids, 0 to disable it
+        self.bloom_size = self.config["scienti_sample"]["bloom_size"] if "bloom_size" in self.config["scienti_sample"] else 0
+        # number of ids expected in the sample, the seen ids are allocated once for them
+        self.seen_capacity = self.config["scienti_sample"]["seen_capacity"] if "seen_capacity" in self.config["scienti_sample"] else 0
+        self.seen = SeenIds(expected=self.seen_capacity, bloom_size=self.bloom_size) if self.seen_ids else None
+        self.writer = BulkWriter(self.collection, ["COD_RH", "COD_PRODUCTO"], batch_size=self.bulk_size,
+                                 flush_interval=self.flush_interval, verbose=self.verbose, seen=self.seen, replace=self.refresh)
+        # if True the selectors only collect the COD_RH and COD_PRODUCTO of the works, then every work is fetched once
+        self.id_first = self.config["scienti_sample"]["id_first"] if "id_first" in self.config["scienti_sample"] else False
+        self.collecting_ids = False
+        self.ids = set()
+        self.ids_lock = Lock()
+        # "threading" (joblib threads) or "async" (asyncio producers and batch writers)
+        self.engine = self.config["scienti_sample"]["engine"] if "engine" in self.config["scienti_sample"] else "threading"
+        if self.engine not in ["threading", "async"]:
+            print("ERROR: Invalid engine: ", self.engine)
+            raise Exception("Invalid engine: ", self.engine)
+        # concurrent bulk writes and maximum number of works waiting to be written in the async engine
+        self.sink_jobs = self.config["scienti_sample"]["sink_jobs"] if "sink_jobs" in self.config["scienti_sample"] else self.num_jobs
+        self.queue_size = self.config["scienti_sample"]["queue_size"] if "queue_size" in self.config["scienti_sample"] else 2 * self.bulk_size
+        # checkpoints of the selectors in the state collection of the output database, required by resume
+        self.checkpoint = self.config["scienti_sample"]["checkpoint"] if "checkpoint" in self.config["scienti_sample"] else False
+        self.checkpoint_size = self.config["scienti_sample"]["checkpoint_size"] if "checkpoint_size" in self.config["scienti_sample"] else 10 * self.bulk_size
+        self.state_collection = self.config["scienti_sample"]["state_collection"] if "state_collection" in self.config["scienti_sample"] else "sample_state"
+        self.checkpoints = Checkpoints(self.db[self.state_collection], "scienti_sample", resume=self.resume,
+                                       verbose=self.verbose) if self.checkpoint or self.resume else None
+        if self.engine == "async" and self.checkpoints is not None:
+            print("ERROR: checkpoint and resume are not supported by the async engine")
+            raise Exception("checkpoint and resume are not supported by the async engine")
 
-    def process_products(self):
+    def selector_projection(self):
         """
-        process products given the COD_RH and COD_PRODUCTO in the workflow configuration.
+        Returns the projection of the selector queries.
+        In the first phase of id_first only the COD_RH and COD_PRODUCTO are returned,
+        so the selectors served by the compound index of the products are covered, otherwise None (the whole works).
         """
-        if "products" in self.config["scienti_sample"] and self.config["scienti_sample"]["products"]:
-            product_ids = []
-            for product in self.config["scienti_sample"]["products"]:
+        if self.collecting_ids:
+            return {"COD_RH": 1, "COD_PRODUCTO": 1, "_id": 0}
+        return None
+
+    def selector_pipeline(self, pipeline):
+        """
+        Returns the pipeline of a selector, in the first phase of id_first
+        a $project stage is appended so only the COD_RH and COD_PRODUCTO of the works are returned.
+
+        Parameters:
+        ----------
+        pipeline: list
+            mongodb pipeline that returns works.
+        """
+        if self.collecting_ids:
+            return pipeline + [{"$project": self.selector_projection()}]
+        return pipeline
+
+    def type_query(self, type_id):
+        """
+        Returns the query of a product type,
+        there are three levels of nesting in the product_type field.
+
+        Parameters:
+        ----------
+        type_id: dict
+            product type, ex: {"COD_TIPO_PRODUCTO": "111"}.
+        """
+        return {"$or": [{"product_type": {"$elemMatch": type_id}},
+                        {"product_type.product_type": {
+                            "$elemMatch": type_id}},
+                        {"product_type.product_type.product_type": {"$elemMatch": type_id}}]}
+
+    def type_codes_expression(self):
+        """
+        Returns the aggregation expression with all the COD_TIPO_PRODUCTO found
+        at any of the three levels of nesting in the product_type field.
+        """
+        levels = []
+        for depth in range(3):
+            expression = {"$ifNull": [
+                "$" + ".".join(["product_type"] * (depth + 1) + ["COD_TIPO_PRODUCTO"]), []]}
+            expression = {"$cond": [{"$isArray": expression}, expression, [expression]]}
+            # every level of nesting adds a level of arrays
+            for _ in range(depth + 1):
+                expression = {"$reduce": {"input": expression, "initialValue": [],
+                                          "in": {"$concatArrays": ["$$value", {"$cond": [{"$isArray": "$$this"}, "$$this", ["$$this"]]}]}}}
+            levels.append(expression)
+        return {"$setUnion": levels}
+
+    def process_type_index(self, db):
+        """
+        Method to build or refresh the product types index of an input collection.
+        The index is the collection <collection_name>_product_types in the input database,
+        with the _id, COD_RH and COD_PRODUCTO of every product and the flattened list of its types codes.
+        Only the products inserted after the last refresh (greater _id) are indexed,
+        and with timestamp_field also the products edited after the last refresh,
+        whose mark is saved in the state collection of the output database.
+        If after that the index and the input collection have different sizes the index is rebuilt.
+        Without timestamp_field the types edited in place are only indexed again with rebuild_indexes.
+        Required for parallel processing.
+
+        Parameters:
+        ----------
+        db: dict
+            input database from self.dbs_in.
+        """
+        index = db["db"][db["collection"].name + "_product_types"]
+        state = self.db[self.state_collection]
+        timestamp = None
+        since = None
+        if self.timestamp_field:
+            # taken before the merge, so the products edited during it are indexed again by the next refresh
+            timestamp = latest_timestamp(db["collection"], self.timestamp_field, verbose=self.verbose)
+            since = get_refresh_mark(state, "scienti_sample", index)
+        for rebuild in [self.rebuild_indexes, True]:
+            last = index.find_one({}, {"_id": 1}, sort=[("_id", -1)])
+            # an index without mark can have stale types, it is rebuilt once
+            if rebuild or (last and self.timestamp_field and since is None):
+                print(
+                    f"INFO: Rebuilding types index db {db['db'].name} collection {index.name}")
+                index.drop()
+                last = None
+            match = {"_id": {"$gt": last["_id"]}} if last else {}
+            if last and since is not None:
+                match = {"$or": [match, {self.timestamp_field: {"$gt": since}}]}
+            pipeline = [
+                {"$match": match},
+                {"$project": {"COD_RH": 1, "COD_PRODUCTO": 1, "types": self.type_codes_expression()}},
+                {"$merge": {"into": index.name, "on": "_id", "whenMatched": "replace", "whenNotMatched": "insert"}}
+            ]
+            db["collection"].aggregate(pipeline, allowDiskUse=True)
+            if index.estimated_document_count() == db["collection"].estimated_document_count():
+                break
+        if timestamp is not None:
+            set_refresh_mark(state, "scienti_sample", index, timestamp)
+        ensure_indexes(index, ["types", ["COD_RH", "COD_PRODUCTO"]], verbose=self.verbose)
+
+    def process_source_type(self, db, type_code):
+        """
+        Method to save in the output database the works of one input collection with the given type code,
+        the works are resolved with the product types index in chunks of chunk_size _ids.
+        Required for parallel processing.
+
+        Parameters:
+        ----------
+        db: dict
+            input database from self.dbs_in.
+        type_code: str
+            COD_TIPO_PRODUCTO to process.
+        """
+        index = db["db"][db["collection"].name + "_product_types"]
+        if self.verbose > 0:
+            print(
+                f"INFO: Found {index.count_documents({'types': type_code})} in db {db['db'].name} collection {db['collection'].name} for id {type_code}")
+        ids = index.find({"types": type_code}, {"_id": 1}, batch_size=self.chunk_size)
+        for chunk in chunks(ids, self.chunk_size):
+            works = db["collection"].find({"_id": {"$in": [work["_id"] for work in chunk]}}, self.selector_projection())
+            Parallel(n_jobs=self.source_jobs, backend="threading")(
+                delayed(self.process_one_work)(work) for work in works)
+
+    def selector_queries(self):
+        """
+        Returns the queries and pipelines of the selectors in the workflow configuration for every input collection.
+
+        Returns:
+        ----------
+        list
+            list of tuples (description, collection, query or pipeline).
+        """
+        config = self.config["scienti_sample"]
+        queries = []
+        for db in self.dbs_in:
+            name = f"in db {db['db'].name} collection {db['collection'].name}"
+            if "authors" in config and config["authors"]:
+                queries += [(f"author {author_id} {name}", db["collection"], {"COD_RH": author_id})
+                            for author_id in config["authors"]]
+            if "products" in config and config["products"]:
+                queries.append((f"products {name}", db["collection"], {"$or": [dict(product) for product in config["products"]]}))
+            if "types" in config and config["types"]:
+                queries += [(f"type {type_id} {name}", db["collection"], self.type_query(dict(type_id)))
+                            for type_id in config["types"]]
+            if "groups" in config and config["groups"]:
+                queries += [(f"group {group_id} {name}", db["collection"], {"group": {"$elemMatch": group_id}})
+                            for group_id in config["groups"]]
+            if "institutions" in config and config["institutions"]:
+                queries += [(f"institution {institution_id} {name}", db["collection"], {"institution": {"$elemMatch": institution_id}})
+                            for institution_id in config["institutions"]]
+            if "custom_queries" in config and config["custom_queries"]:
+                queries += [(f"custom query {query} {name}", db["collection"], query)
+                            for query in config["custom_queries"]]
+            if "custom_pipelines" in config and config["custom_pipelines"]:
+                queries += [(f"custom pipeline {pipeline} {name}", db["collection"], pipeline)
+                            for pipeline in config["custom_pipelines"]]
+            if "categories" in config and config["categories"]:
+                queries += [(f"category {category_id} {name}", db["collection"], category_id)
+                            for category_id in config["categories"]]
+        return queries
+
+    def validate_selectors(self):
+        """
+        Method to check the required keys of the products, types, groups and institutions in the workflow configuration,
+        it is called by both engines before any selector runs.
+        """
+        config = self.config["scienti_sample"]
+        if "products" in config and config["products"]:
+            for product in config["products"]:
                 if "COD_RH" not in product and "COD_PRODUCTO" not in product:
                     print(
                         "ERROR: COD_RH and COD_PRODUCTO are required in the product configuration")
                     raise Exception(
                         "COD_RH and COD_PRODUCTO are required in the product configuration")
+        if "types" in config and config["types"]:
+            for type_id in config["types"]:
+                if "COD_TIPO_PRODUCTO" not in type_id:
+                    print(
+                        "ERROR: COD_TIPO_PRODUCTO is required in the type configuration")
+                    raise Exception(
+                        "COD_TIPO_PRODUCTO is required in the type configuration")
+        if "groups" in config and config["groups"]:
+            for group_id in config["groups"]:
+                if "NRO_ID_GRUPO" not in group_id and "COD_ID_GRUPO" not in group_id:
+                    print(
+                        "ERROR: NRO_ID_GRUPO or COD_ID_GRUPO are required in the group configuration")
+                    raise Exception(
+                        "NRO_ID_GRUPO or COD_ID_GRUPO are required in the group configuration")
+        if "institutions" in config and config["institutions"]:
+            for institution_id in config["institutions"]:
+                if "COD_INST" not in institution_id and ("TXT_NIT" not in institution_id and "TXT_DIGITO_VERIFICADOR" not in institution_id):
+                    print(
+                        "ERROR: COD_INST or TXT_NIT and TXT_DIGITO_VERIFICADOR are required in the institution configuration")
+                    raise Exception(
+                        "COD_INST or TXT_NIT and TXT_DIGITO_VERIFICADOR are required in the institution configuration")
+
+    def process_indexes(self):
+        """
+        Method to create the indexes of the indeces tag of every input database and of database_out
+        in the workflow configuration, the indexes that already exist are skipped.
+        With wait_indexes False the indexes are built in background.
+        The selector queries that are still not served by an index are reported.
+        """
+        threads = [ensure_indexes(db["collection"], db["indeces"], wait=self.wait_indexes, verbose=self.verbose)
+                   for db in self.dbs_in]
+        threads.append(ensure_indexes(self.collection, self.config["scienti_sample"]["database_out"]["indeces"]
+                                      if "indeces" in self.config["scienti_sample"]["database_out"] else [],
+                                      wait=self.wait_indexes, verbose=self.verbose))
+        if self.wait_indexes or not any(threads):
+            for description in unindexed_queries(self.selector_queries()):
+                print(f"WARNING: {description} is not served by an index")
+
+    def process_products_chunk(self, db, products, query=None):
+        """
+        Method to save in the output database the works of one input collection that match a chunk of products,
+        resolved with a single $or query.
+        Required for parallel processing.
+
+        Parameters:
+        ----------
+        db: dict
+            input database from self.dbs_in.
+        products: list
+            list of products, dicts with COD_RH and COD_PRODUCTO.
+        query: dict
+            additional filter of the works, None to save all of them.
+
+        Returns:
+        ----------
+        list
+            (COD_RH, COD_PRODUCTO) of the works found.
+        """
+        found = []
+        query = {"$and": [{"$or": products}, query]} if query else {"$or": products}
+        for work in db["collection"].find(query, self.selector_projection()):
+            key = self.writer.key(work)
+            found.append((key["COD_RH"], key["COD_PRODUCTO"]))
+            self.process_one_work(work)
+        return found
+
+    def process_source_products(self, db, products, query=None):
+        """
+        Method to save in the output database the works of one input collection that match the products,
+        the products are resolved in chunks of chunk_size with at most source_jobs threads.
+        Required for parallel processing.
+
+        Parameters:
+        ----------
+        db: dict
+            input database from self.dbs_in.
+        products: list
+            list of products, dicts with COD_RH and COD_PRODUCTO.
+        query: dict
+            additional filter of the works, None to save all of them.
+
+        Returns:
+        ----------
+        list
+            (COD_RH, COD_PRODUCTO) of the works found.
+        """
+        ensure_indexes(db["collection"], [["COD_RH", "COD_PRODUCTO"]], verbose=self.verbose)
+        found = Parallel(n_jobs=self.source_jobs, backend="threading")(
+            delayed(self.process_products_chunk)(db, chunk, query) for chunk in chunks(products, self.chunk_size))
+        found = [key for chunk in found for key in chunk]
+        if self.verbose > 0:
+            print(
+                f"INFO: Found {len(found)} products in db {db['db'].name} collection {db['collection'].name}")
+        return found
+
+    def process_products(self):
+        """
+        process products given the COD_RH and COD_PRODUCTO in the workflow configuration.
+        The products are resolved in chunks of chunk_size with $or queries on all the input collections concurrently,
+        the products not found in any input collection are reported at the end.
+        """
+        if "products" in self.config["scienti_sample"] and self.config["scienti_sample"]["products"]:
+            product_ids = []
+            for product in self.config["scienti_sample"]["products"]:
                 product_ids.append(dict(product))
             if self.verbose > 0:
                 print("INFO: Processing products: ", len(product_ids))
+            found = Parallel(n_jobs=len(self.dbs_in), backend="threading")(
+                delayed(self.process_source_products)(db, product_ids) for db in self.dbs_in)
+            found_pairs = set(key for source in found for key in source)
+            found_rh = set(key[0] for key in found_pairs)
+            found_products = set(key[1] for key in found_pairs)
+            self.missing_products = []
             for product_id in product_ids:
-                for db in self.dbs_in:
-                    work = db["collection"].find_one(product_id)
-                    if work:
-                        if self.collection.count_documents(product_id) == 0:
-                            self.collection.insert_one(work)
-                        else:
-                            if self.verbose > 2:
-                                print(
-                                    f"INFO: Product {product_id} already exists in db {self.db.name} collection {self.collection.name}")
-                    else:
-                        if self.verbose > 2:
-                            print(
-                                f"WARNING: Product {product_id} not found in the database {db['db'].name} collection {db['collection'].name}")
+                if "COD_RH" in product_id and "COD_PRODUCTO" in product_id:
+                    exists = (product_id["COD_RH"], product_id["COD_PRODUCTO"]) in found_pairs
+                elif "COD_RH" in product_id:
+                    exists = product_id["COD_RH"] in found_rh
+                else:
+                    exists = product_id["COD_PRODUCTO"] in found_products
+                if not exists:
+                    self.missing_products.append(product_id)
+            if self.missing_products:
+                print(
+                    f"WARNING: {len(self.missing_products)} of {len(product_ids)} products not found in the input databases")
+                if self.verbose > 1:
+                    print(f"WARNING: Products not found: {self.missing_products}")
 
     def process_authors(self):
         """
@@ -81,27 +420,237 @@ class Kahi_scienti_sample(KahiBase):
             if self.verbose > 0:
                 print("INFO: Processing authors: ", len(author_ids))
             for author_id in author_ids:
-                for db in self.dbs_in:
-                    if self.verbose > 0:
-                        print(
-                            f"INFO: Found {db['collection'].count_documents({'COD_RH': author_id})} in db {db['db'].name} collection {db['collection'].name} for id   {author_id}")
-                    works = db["collection"].find({"COD_RH": author_id})
-                    Parallel(n_jobs=self.num_jobs, backend="threading", verbose=10)(
-                        delayed(self.process_one_work)(work) for work in works)
+                self.process_sources({"COD_RH": author_id}, f"id {author_id}")
 
-    def process_one_work(self, work):
+    def process_partition(self, collection, query):
         """
-        Method to process one work and save it in the output database.
+        Method to save in the output database the works of one partition of a query.
+        Required for parallel processing.
+
+        Parameters:
+        ----------
+        collection: pymongo.collection.Collection
+            input collection.
+        query: dict
+            mongodb query of the partition.
+        """
+        for work in collection.find(query, self.selector_projection()):
+            self.process_one_work(work)
+
+    def process_query(self, collection, query):
+        """
+        Method to save in the output database all the works that match a query.
+        With parallel_scan the query is split in source_jobs _id range partitions that are scanned in parallel,
+        each one with its own cursor, otherwise the works of a single cursor are processed in parallel.
+        The collections with less than parallel_scan_min_size documents are not partitioned.
+        With checkpoints every partition has its own checkpoint and its own bulk writer,
+        so the flush of a checkpoint does not wait for the writes of the other partitions.
+
+        Parameters:
+        ----------
+        collection: pymongo.collection.Collection
+            input collection.
+        query: dict
+            mongodb query that returns works.
+        """
+        partitions = [query]
+        if self.parallel_scan and self.source_jobs > 1 and collection.estimated_document_count() >= self.parallel_scan_min_size:
+            partitions = partition_query(collection, query, self.source_jobs)
+        checkpointed = self.checkpoints is not None and not self.collecting_ids
+        if checkpointed and len(partitions) > 1:
+            # every partition is checkpointed as a selector, a resumed run finds the same partitions if the input did not change
+            writers = [self.writer.fork() for _ in partitions]
+            Parallel(n_jobs=self.source_jobs, backend="threading", verbose=10)(
+                delayed(self.process_checkpointed)(collection, partition, 1, writer) for partition, writer in zip(partitions, writers))
+            for writer in writers:
+                self.writer.join(writer)
+        elif checkpointed:
+            self.process_checkpointed(collection, query)
+        elif len(partitions) > 1:
+            Parallel(n_jobs=self.source_jobs, backend="threading", verbose=10)(
+                delayed(self.process_partition)(collection, partition) for partition in partitions)
+        else:
+            works = collection.find(query, self.selector_projection())
+            Parallel(n_jobs=self.source_jobs, backend="threading", verbose=10)(
+                delayed(self.process_one_work)(work) for work in works)
+
+    def process_source(self, db, query, description):
+        """
+        Method to save in the output database the works of one input collection that match a query or a pipeline.
         Required for parallel processing.
+
+        Parameters:
+        ----------
+        db: dict
+            input database from self.dbs_in.
+        query: dict or list
+            mongodb query or pipeline that returns works.
+        description: str
+            description of the selector for the logs.
         """
-        work_id = {"COD_RH": work["COD_RH"],
-                   "COD_PRODUCTO": work["COD_PRODUCTO"]}
-        if self.collection.count_documents(work_id) == 0:
-            self.collection.insert_one(work)
+        if isinstance(query, list):
+            if self.pipeline_done(db["collection"], query):
+                return
+            works = db["collection"].aggregate(self.selector_pipeline(query), allowDiskUse=True, batchSize=self.cursor_batch_size)
+            count = self.process_cursor(works)
+            self.finish_pipeline(db["collection"], query)
+            if self.verbose > 0:
+                print(
+                    f"INFO: Found {count} in db {db['db'].name} collection {db['collection'].name} for {description}")
         else:
-            if self.verbose > 2:
+            if self.verbose > 0:
                 print(
-                    f"INFO: Work  {work_id} already exists in db {self.db.name} collection {self.collection.name} ")
+                    f"INFO: Found {db['collection'].count_documents(query)} in db {db['db'].name} collection {db['collection'].name} for {description}")
+            self.process_query(db["collection"], query)
+
+    def process_sources(self, query, description):
+        """
+        Method to save in the output database the works that match a query or a pipeline in all the input collections.
+        The input collections are queried concurrently and their works are merged in the output writer,
+        every input collection is processed with at most source_jobs threads.
+
+        Parameters:
+        ----------
+        query: dict or list
+            mongodb query or pipeline that returns works.
+        description: str
+            description of the selector for the logs.
+        """
+        Parallel(n_jobs=len(self.dbs_in), backend="threading")(
+            delayed(self.process_source)(db, query, description) for db in self.dbs_in)
+
+    def process_cursor(self, works):
+        """
+        Method to save in the output database the works of a cursor while they are streamed from the server.
+        The works are processed in parallel with at most max_in_flight works dispatched at the same time,
+        so the cursor is never loaded in memory.
+
+        Parameters:
+        ----------
+        works: pymongo.cursor.Cursor or pymongo.command_cursor.CommandCursor
+            cursor that returns works.
+
+        Returns:
+        ----------
+        int
+            number of works streamed from the cursor.
+        """
+        count = 0
+
+        def counted():
+            # the generator is consumed only by the dispatching thread of joblib
+            nonlocal count
+            for work in works:
+                count += 1
+                yield work
+        Parallel(n_jobs=self.source_jobs, backend="threading", verbose=10, pre_dispatch=self.max_in_flight)(
+            delayed(self.process_one_work)(work) for work in counted())
+        return count
+
+    def process_checkpointed(self, collection, query, n_jobs=None, writer=None):
+        """
+        Method to save in the output database all the works that match a query recording checkpoints.
+        The works are read sorted by _id (after the last checkpoint of the selector in a resumed run)
+        in chunks of checkpoint_size, every chunk is processed in parallel and written
+        before its last _id is saved as the checkpoint of the selector.
+
+        Parameters:
+        ----------
+        collection: pymongo.collection.Collection
+            input collection.
+        query: dict
+            mongodb query that returns works.
+        n_jobs: int
+            threads processing every chunk, by default source_jobs (1 for the partitions of parallel_scan).
+        writer: BulkWriter
+            writer of the works, by default self.writer (every partition of parallel_scan has its own).
+        """
+        n_jobs = self.source_jobs if n_jobs is None else n_jobs
+        writer = self.writer if writer is None else writer
+        selector = self.checkpoints.selector_id(collection, query)
+        if self.checkpoints.is_done(selector):
+            if self.verbose > 0:
+                print(f"INFO: Skipping {selector}, done in a previous run")
+            return
+        works = collection.find(self.checkpoints.resume_query(selector, query), None,
+                                allow_disk_use=True).sort("_id", ASCENDING)
+        for chunk in chunks(works, self.checkpoint_size):
+            Parallel(n_jobs=n_jobs, backend="threading")(
+                delayed(self.process_one_work)(work, writer) for work in chunk)
+            writer.flush()
+            last = chunk[-1]
+            self.checkpoints.save(selector, raw_key(last.raw, ["_id"])["_id"] if isinstance(last, RawBSONDocument) else last["_id"])
+        self.checkpoints.save(selector, done=True)
+
+    def pipeline_done(self, collection, pipeline):
+        """
+        Checks if a pipeline (or a streamed query) selector was finished by a previous run,
+        they can not be resumed from a checkpoint, they are only marked as done.
+
+        Parameters:
+        ----------
+        collection: pymongo.collection.Collection
+            input collection.
+        pipeline: list or dict
+            mongodb pipeline or query of the selector.
+        """
+        if self.checkpoints is None or self.collecting_ids:
+            return False
+        selector = self.checkpoints.selector_id(collection, pipeline)
+        if self.checkpoints.is_done(selector):
+            if self.verbose > 0:
+                print(f"INFO: Skipping {selector}, done in a previous run")
+            return True
+        return False
+
+    def finish_pipeline(self, collection, pipeline):
+        """
+        Marks a pipeline (or a streamed query) selector as done, after writing all its works.
+
+        Parameters:
+        ----------
+        collection: pymongo.collection.Collection
+            input collection.
+        pipeline: list or dict
+            mongodb pipeline or query of the selector.
+        """
+        if self.checkpoints is not None and not self.collecting_ids:
+            self.writer.flush()
+            self.checkpoints.save(self.checkpoints.selector_id(collection, pipeline), done=True)
+
+    def process_one_work(self, work, writer=None):
+        """
+        Method to process one work and save it in the output database.
+        Required for parallel processing.
+        The work is buffered in the bulk writer, works already saved are skipped by the writer.
+        In the first phase of id_first only the COD_RH and COD_PRODUCTO of the work are collected.
+        """
+        if self.collecting_ids:
+            key = self.writer.key(work)
+            with self.ids_lock:
+                self.ids.add((key["COD_RH"], key["COD_PRODUCTO"]))
+        else:
+            (self.writer if writer is None else writer).add(work)
+
+    def process_ids(self, ids=None, queries=None):
+        """
+        Second phase of id_first (and of refresh), the unique works collected by all the selectors
+        are fetched once from every input collection in chunks of chunk_size products with $or queries.
+
+        Parameters:
+        ----------
+        ids: set
+            (COD_RH, COD_PRODUCTO) of the works to fetch, by default the ones collected by the selectors.
+        queries: list
+            additional filter of the works for every input collection in self.dbs_in, None to fetch all of them.
+        """
+        ids = self.ids if ids is None else ids
+        queries = queries or [None] * len(self.dbs_in)
+        if self.verbose > 0:
+            print(f"INFO: Fetching {len(ids)} works from the input databases")
+        products = [{"COD_RH": cod_rh, "COD_PRODUCTO": cod_producto} for cod_rh, cod_producto in ids]
+        Parallel(n_jobs=len(self.dbs_in), backend="threading")(
+            delayed(self.process_source_products)(db, products, query) for db, query in zip(self.dbs_in, queries))
 
     def process_types(self):
         """
@@ -113,32 +662,18 @@ class Kahi_scienti_sample(KahiBase):
         if "types" in self.config["scienti_sample"] and self.config["scienti_sample"]["types"]:
             type_ids = []
             for type_id in self.config["scienti_sample"]["types"]:
-                if "COD_TIPO_PRODUCTO" not in type_id:
-                    print(
-                        "ERROR: COD_TIPO_PRODUCTO is required in the type configuration")
-                    raise Exception(
-                        "COD_TIPO_PRODUCTO is required in the type configuration")
                 type_ids.append(dict(type_id))
             if self.verbose > 0:
                 print("INFO: Processing types: ", len(type_ids))
+            if self.type_index:
+                Parallel(n_jobs=len(self.dbs_in), backend="threading")(
+                    delayed(self.process_type_index)(db) for db in self.dbs_in)
             for type_id in type_ids:
-                for db in self.dbs_in:
-                    if self.verbose > 0:
-                        count = db["collection"].count_documents({"$or": [{"product_type": {"$elemMatch": type_id}},
-                                                                          {"product_type.product_type": {
-                                                                              "$elemMatch": type_id}},
-                                                                          {"product_type.product_type.product_type": {"$elemMatch": type_id}}]})
-
-                        print(
-                            f"INFO: Found {count} in db {db['db'].name} collection {db['collection'].name} for id   {type_id}")
-
-                    # there are three levels of nesting in the product_type field
-                    works = db["collection"].find({"$or": [{"product_type": {"$elemMatch": type_id}},
-                                                           {"product_type.product_type": {
-                                                               "$elemMatch": type_id}},
-                                                           {"product_type.product_type.product_type": {"$elemMatch": type_id}}]})
-                    Parallel(n_jobs=self.num_jobs, backend="threading", verbose=10)(
-                        delayed(self.process_one_work)(work) for work in works)
+                if self.type_index and list(type_id.keys()) == ["COD_TIPO_PRODUCTO"]:
+                    Parallel(n_jobs=len(self.dbs_in), backend="threading")(
+                        delayed(self.process_source_type)(db, type_id["COD_TIPO_PRODUCTO"]) for db in self.dbs_in)
+                else:
+                    self.process_sources(self.type_query(type_id), f"id {type_id}")
 
     def process_groups(self):
         """
@@ -151,19 +686,7 @@ class Kahi_scienti_sample(KahiBase):
             if self.verbose > 0:
                 print("INFO: Processing groups: ", len(group_ids))
             for group_id in group_ids:
-                if "NRO_ID_GRUPO" not in group_id and "COD_ID_GRUPO" not in group_id:
-                    print(
-                        "ERROR: NRO_ID_GRUPO or COD_ID_GRUPO are required in the group configuration")
-                    raise Exception(
-                        "NRO_ID_GRUPO or COD_ID_GRUPO are required in the group configuration")
-                for db in self.dbs_in:
-                    if self.verbose > 0:
-                        print(
-                            f"INFO: Found {db['collection'].count_documents({'group': {'$elemMatch': group_id}})} in db {db['db'].name} collection {db['collection'].name} for id {group_id}")
-                    works = db["collection"].find(
-                        {'group': {"$elemMatch": group_id}})
-                    Parallel(n_jobs=self.num_jobs, backend="threading", verbose=10)(
-                        delayed(self.process_one_work)(work) for work in works)
+                self.process_sources({'group': {"$elemMatch": group_id}}, f"id {group_id}")
 
     def process_institutions(self):
         """
@@ -176,20 +699,7 @@ class Kahi_scienti_sample(KahiBase):
             if self.verbose > 0:
                 print("INFO: Processing institutions: ", len(institution_ids))
             for institution_id in institution_ids:
-                if "COD_INST" not in institution_id and ("TXT_NIT" not in institution_id and "TXT_DIGITO_VERIFICADOR" not in institution_id):
-                    print(
-                        "ERROR: COD_INST or TXT_NIT and TXT_DIGITO_VERIFICADOR are required in the institution configuration")
-                    raise Exception(
-                        "COD_INST or TXT_NIT and TXT_DIGITO_VERIFICADOR are required in the institution configuration")
-
-                for db in self.dbs_in:
-                    if self.verbose > 0:
-                        print(
-                            f"INFO: Found {db['collection'].count_documents({'institution': {'$elemMatch': institution_id}})} in db {db['db'].name} collection {db['collection'].name} for id {institution_id}")  # noqa: E501
-                    works = db["collection"].find(
-                        {'institution': {"$elemMatch": institution_id}})
-                    Parallel(n_jobs=self.num_jobs, backend="threading", verbose=10)(
-                        delayed(self.process_one_work)(work) for work in works)
+                self.process_sources({'institution': {"$elemMatch": institution_id}}, f"id {institution_id}")
 
     def process_custom_queries(self):
         """
@@ -202,13 +712,7 @@ class Kahi_scienti_sample(KahiBase):
             if self.verbose > 0:
                 print("INFO: Processing custom queries: ", len(queries))
             for query in queries:
-                for db in self.dbs_in:
-                    if self.verbose > 0:
-                        print(
-                            f"INFO: Found {db['collection'].count_documents(query)} in db {db['db'].name} collection {db['collection'].name} for query   {query}")
-                    works = db["collection"].find(query)
-                    Parallel(n_jobs=self.num_jobs, backend="threading", verbose=10)(
-                        delayed(self.process_one_work)(work) for work in works)
+                self.process_sources(query, f"query {query}")
 
     def process_custom_pipelines(self):
         """
@@ -221,13 +725,7 @@ class Kahi_scienti_sample(KahiBase):
             if self.verbose > 0:
                 print("INFO: Processing custom queries: ", len(pipelines))
             for pipeline in pipelines:
-                for db in self.dbs_in:
-                    works = list(db["collection"].aggregate(pipeline))
-                    if self.verbose > 0:
-                        print(
-                            f"INFO: Found {len(works)} in db {db['db'].name} collection {db['collection'].name} for query {pipeline}")
-                    Parallel(n_jobs=self.num_jobs, backend="threading", verbose=10)(
-                        delayed(self.process_one_work)(work) for work in works)
+                self.process_sources(pipeline, f"query {pipeline}")
 
     def process_categories(self):
         """
@@ -240,15 +738,73 @@ class Kahi_scienti_sample(KahiBase):
             if self.verbose > 0:
                 print("INFO: Processing categories: ", len(category_ids))
             for category_id in category_ids:
-                for db in self.dbs_in:
-                    if self.verbose > 0:
-                        print(
-                            f"INFO: Found {db['collection'].count_documents(category_id)} in db {db['db'].name} collection {db['collection'].name} for id   {category_id}")
-                    works = db["collection"].find(category_id)
-                    Parallel(n_jobs=self.num_jobs, backend="threading", verbose=10)(
-                        delayed(self.process_one_work)(work) for work in works)
+                self.process_sources(category_id, f"id {category_id}")
 
-    def run(self):
+    def type_index_pipeline(self, db, type_code):
+        """
+        Returns the pipeline that resolves the works of one input collection with the given type code
+        through the product types index, it runs on the index collection.
+
+        Parameters:
+        ----------
+        db: dict
+            input database from self.dbs_in.
+        type_code: str
+            COD_TIPO_PRODUCTO to process.
+        """
+        return [
+            {"$match": {"types": type_code}},
+            {"$project": {"_id": 1}},
+            {"$lookup": {"from": db["collection"].name, "localField": "_id", "foreignField": "_id", "as": "work"}},
+            {"$unwind": "$work"},
+            {"$replaceRoot": {"newRoot": "$work"}}
+        ]
+
+    def async_selectors(self):
+        """
+        Returns the selectors of the workflow configuration for the asyncio engine, one per input collection.
+        With type_index the types selectors read the product types index like the threading engine.
+
+        Returns:
+        ----------
+        list
+            list of tuples (description, url, collection, query or pipeline, projection).
+        """
+        self.validate_selectors()
+        config = self.config["scienti_sample"]
+        indexed = []
+        if self.type_index and "types" in config and config["types"]:
+            Parallel(n_jobs=len(self.dbs_in), backend="threading")(
+                delayed(self.process_type_index)(db) for db in self.dbs_in)
+            indexed = [dict(type_id) for type_id in config["types"] if list(dict(type_id).keys()) == ["COD_TIPO_PRODUCTO"]]
+        selectors = []
+        for db in self.dbs_in:
+            for description, collection, query in self.selector_queries():
+                if collection is not db["collection"]:
+                    continue
+                type_id = next((type_id for type_id in indexed if query == self.type_query(type_id)), None)
+                if type_id is not None:
+                    collection = db["db"][db["collection"].name + "_product_types"]
+                    query = self.type_index_pipeline(db, type_id["COD_TIPO_PRODUCTO"])
+                selectors.append((description, db["url"], collection, query, None))
+        return selectors
+
+    def process_async(self):
+        """
+        Method to save in the output database the works of all the selectors with the asyncio engine (engine: async).
+        Every selector is an async producer and sink_jobs batch writers save the works with the bulk writer keys,
+        so the output is the same of the threading engine. id_first only applies to the threading engine.
+        """
+        engine = AsyncEngine(self.writer, self.database_out_url, self.compressors, source_jobs=self.source_jobs,
+                             sink_jobs=self.sink_jobs, queue_size=self.queue_size,
+                             cursor_batch_size=self.cursor_batch_size, verbose=self.verbose)
+        engine.run(self.async_selectors())
+
+    def process_selectors(self):
+        """
+        Method to run all the selectors of the workflow configuration with the threading engine.
+        """
+        self.validate_selectors()
         self.process_authors()
         self.process_products()
         self.process_types()
@@ -257,4 +813,74 @@ class Kahi_scienti_sample(KahiBase):
         self.process_custom_queries()
         self.process_custom_pipelines()
         self.process_categories()
+
+    def process_refresh(self):
+        """
+        Method to refresh the sample in place (refresh: True) instead of building it again.
+        The selectors collect the ids of the works that match now (like the first phase of id_first),
+        the new works are saved, the works already saved are replaced only if their timestamp_field
+        changed since the last refresh of their input collection, and the works that do not match anymore are removed.
+        """
+        state = self.db[self.state_collection]
+        timestamps = [None] * len(self.dbs_in)
+        queries = [None] * len(self.dbs_in)
+        if self.timestamp_field:
+            # taken before the selectors, so the works changed during the refresh are fetched again by the next one
+            for i, db in enumerate(self.dbs_in):
+                timestamps[i] = latest_timestamp(db["collection"], self.timestamp_field, verbose=self.verbose)
+                since = get_refresh_mark(state, "scienti_sample", db["collection"])
+                if since is not None:
+                    queries[i] = {self.timestamp_field: {"$gt": since}}
+        else:
+            print("WARNING: refresh without timestamp_field, all the works are fetched again")
+        self.collecting_ids = True
+        self.process_selectors()
+        self.collecting_ids = False
+        saved = self.writer.saved_ids()
+        new = self.ids - saved
+        kept = self.ids & saved
+        removed = saved - self.ids
+        if self.verbose > 0:
+            print(
+                f"INFO: Refreshing {len(self.ids)} works, {len(new)} new, {len(kept)} already saved and {len(removed)} removed")
+        self.process_ids(new)
+        self.process_ids(kept, queries)
+        self.writer.flush()
+        deleted = self.writer.delete(removed, self.chunk_size)
+        if self.verbose > 0:
+            print(
+                f"INFO: Removed {deleted} works from db {self.db.name} collection {self.collection.name}")
+        for db, timestamp in zip(self.dbs_in, timestamps):
+            if timestamp is not None:
+                set_refresh_mark(state, "scienti_sample", db["collection"], timestamp)
+
+    def run(self):
+        if not self.selector_queries():
+            # nothing is selected, the output is left as it is and no connection is opened
+            if self.verbose > 0:
+                print("INFO: Nothing selected in the workflow configuration")
+            return 0
+        if self.database_out_drop_database and not self.resume and not self.refresh:
+            drop_output_database(self.client, self.database_out_name, self.state_collection)
+        self.process_indexes()
+        if self.checkpoints is not None:
+            self.checkpoints.start()
+        if self.seen is not None and (self.resume or not self.database_out_drop_database) and not self.refresh:
+            # the works saved by previous runs are skipped too
+            self.writer.warm()
+        if self.refresh:
+            self.process_refresh()
+        elif self.engine == "async":
+            self.process_async()
+        else:
+            # first phase of id_first, the selectors only collect the COD_RH and COD_PRODUCTO
+            self.collecting_ids = self.id_first
+            self.process_selectors()
+            if self.id_first:
+                self.collecting_ids = False
+                self.process_ids()
+        self.writer.flush()
+        if self.verbose > 0:
+            print(
+                f"INFO: Saved {self.writer.inserted} works in db {self.db.name} collection {self.collection.name}, skipped {self.writer.skipped} already saved")
         return 0
@@ -81,7 +81,7 @@ def main():
         # put you packages here
         install_requires=[
             'kahi',
-            'pymongo',
+            'pymongo>=4.10',
             'joblib'
         ],
     )